@@ -4,8 +4,6 @@ from telegram import (
     InlineKeyboardMarkup, 
     Update, 
     Document,
-    ChatMember, 
-    ChatMemberUpdated,
 )
 from telegram.ext import (
     CommandHandler,
@@ -13,57 +11,94 @@ from telegram.ext import (
     CallbackQueryHandler,
     ConversationHandler,
     ChatMemberHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
-from utils.storage import (
-    log_stat,
-    get_user_stats_all,
-    get_user_stats_nice,
-    get_leaderboard,
-    get_last_update,
-    update_last_timestamp,
-    delete_chat_data,
-    get_chat_stats_all,
-    get_users_all,
-)
 from utils.firestore import (
-    log_stat as firestore_log_stat,
-    get_user_stats_all as firestore_get_user_stats_all,
-    get_user_stats_nice as firestore_get_user_stats_nice,
-    get_leaderboard as firestore_get_leaderboard,
     get_last_update as firestore_get_last_update,
     update_last_timestamp as firestore_update_last_timestamp,
     delete_chat_data as firestore_delete_chat_data,
-    get_chat_stats_all as firestore_get_chat_stats_all,
-    get_users_all as firestore_get_users_all,
-    get_user_last_update as firestore_get_user_last_update,
     bulk_log_stat as firestore_bulk_log_stat,
+    bump_history_generation as firestore_bump_history_generation,
+    get_chat_shard_count as firestore_get_chat_shard_count,
+    set_chat_shard_count as firestore_set_chat_shard_count,
+    get_message_count as firestore_get_message_count,
 )
-
-import re, json
-from datetime import datetime, date
-from collections import defaultdict
+from utils.chat_store import (
+    get_user_stats_views as store_get_user_stats_views,
+    format_user_stats_page,
+    get_leaderboard as store_get_leaderboard,
+    evict_chat as store_evict_chat,
+)
+from utils.chatstats import get_chat_stats
+from utils.globalboard import get_global_board
+from utils.singleflight import render_cache
+from utils.admission import admission, admitted_render, format_admission_stats, BUSY_MESSAGE, STALE_NOTE
+from utils.outbox import outbox
+from bot.ingest import enqueue_stat
+from utils.clean_chat_history_json import extract_stat
+from utils.dedupe import StatSorter, dedupe_batches
+from utils.import_chat_history import iter_export_messages
+from utils.export import export_to_file, EXPORT_KINDS, EXPORT_FORMATS
+from utils.profiling import profiled, start_profiling, stop_profiling, is_profiling, PROFILE_MODES, PROFILE_MAX_SECONDS
+
+import os, re, io, time, asyncio
+from dotenv import load_dotenv
+from datetime import datetime
 import logging
 logger = logging.getLogger(__name__)
 
+# Load environment variables
+load_dotenv()
+
 GAYNESS_RE = re.compile(r'I am (\d+)% gay')
 SELECT_STATS_MODE = 1
 
+# /mystats starts computing while the user picks a mode; the result is kept this long
+MYSTATS_PREFETCH_TTL = float(os.getenv("MYSTATS_PREFETCH_TTL", "60"))
+# An unanswered /mystats keyboard is abandoned (and its prefetch cancelled) after this long
+MYSTATS_TIMEOUT = float(os.getenv("MYSTATS_TIMEOUT", "300"))
+PREFETCH_KEY = "mystats_prefetch"  # context.user_data key: chat_id -> (task, expires_at)
+HISTOGRAM_KEY = "mystats_histogram"  # context.user_data key: chat_id -> (counts, expires_at), serves "All" pages
+STATS_PAGE_SIZE = 20
+STATS_ERROR_MESSAGE = "Error retrieving stats."
+
+# Telegram user IDs allowed to run admin commands, e.g. ADMIN_USER_IDS=12345,67890
+ADMIN_USER_IDS = {int(uid) for uid in os.getenv("ADMIN_USER_IDS", "").split(",") if uid.strip()}
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024  # Bots can send files up to 50 MB
+MAX_CHAT_SHARDS = 64
+
+def is_admin(update: Update):
+    return update.effective_user is not None and update.effective_user.id in ADMIN_USER_IDS
+
 def setup_handlers(app):
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("leaderboard", leaderboard))
+    # Every handler is wrapped for /profile; the wrapper is a single check while profiling is off
+    app.add_handler(CommandHandler("start", profiled(start)))
+    # Expensive commands run as tasks (block=False), so updates behind them, stats included,
+    # are not held up; utils/admission.py bounds how many run at once
+    app.add_handler(CommandHandler("leaderboard", profiled(leaderboard), block=False))
+    app.add_handler(CommandHandler("chatstats", profiled(chatstats), block=False))
+    app.add_handler(CommandHandler("globalboard", profiled(globalboard), block=False))
     app.add_handler(ConversationHandler(
-        entry_points=[CommandHandler("mystats", mystats)],
+        entry_points=[CommandHandler("mystats", profiled(mystats))],
         states={
-            SELECT_STATS_MODE: [CallbackQueryHandler(handle_stats_mode)],
+            SELECT_STATS_MODE: [CallbackQueryHandler(profiled(handle_stats_mode), pattern=r"^(all|nice)$", block=False)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, mystats_timeout)],
         },
         fallbacks=[],
+        conversation_timeout=MYSTATS_TIMEOUT,
     ))
-    app.add_handler(CommandHandler("backfill", backfill))
-    app.add_handler(MessageHandler(filters.Document.FileExtension("json"), handle_json_upload))
-    app.add_handler(MessageHandler(filters.TEXT, process_message))
-    app.add_handler(ChatMemberHandler(handle_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    app.add_handler(CallbackQueryHandler(profiled(handle_stats_page), pattern=r"^allpage:"))
+    app.add_handler(CommandHandler("backfill", profiled(backfill)))
+    app.add_handler(CommandHandler("export", profiled(export)))
+    app.add_handler(CommandHandler("profile", profile))
+    app.add_handler(CommandHandler("admission", admission_stats))
+    app.add_handler(CommandHandler("shards", shards))
+    app.add_handler(MessageHandler(filters.Document.FileExtension("json"), profiled(handle_json_upload, trace_memory=True), block=False))
+    app.add_handler(MessageHandler(filters.TEXT, profiled(process_message)))
+    app.add_handler(ChatMemberHandler(profiled(handle_chat_member), ChatMemberHandler.MY_CHAT_MEMBER))
     
 # === COMMAND HANDLERS ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -82,18 +117,56 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "*Commands:*\n"
         "/mystats — View your own stats\n"
         "/leaderboard — See the group's leaderboard\n"
+        "/chatstats — See the group's overall stats\n"
+        "/globalboard — See the leaderboard across all groups\n"
         "/backfill — (Optional) Upload chat history JSON to update the database\n"
     )
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    outbox.reply_text(update.message, msg, parse_mode="Markdown")
 
     
+def fetch_user_stats_views(chat_id: str, user_id: int):
+    # Both views in one pass; concurrent identical requests share one computation and
+    # the result is cached until the chat logs a new stat
+    # Returns (views or None if shed, stale)
+    return admitted_render("mystats", chat_id, ("mystats", chat_id, user_id),
+                           lambda: asyncio.to_thread(store_get_user_stats_views, chat_id, user_id))
+
+async def load_user_stats_views(context: ContextTypes.DEFAULT_TYPE, chat_id: str, user_id: int):
+    # The /mystats prefetch if it is still fresh and went through, otherwise a fetch of its own
+    # Returns (views or None if shed, stale); raises if the fetch fails
+    prefetch = context.user_data.get(PREFETCH_KEY, {}).pop(chat_id, None)
+    if prefetch and prefetch[1] > time.monotonic() and not prefetch[0].cancelled():
+        try:
+            views, stale = await prefetch[0]
+            if views is not None:
+                return views, stale
+        except Exception as e:
+            logger.warning(f"Prefetched stats of user {user_id} in chat {chat_id} failed: {e}")
+    elif prefetch:
+        prefetch[0].cancel()
+    return await fetch_user_stats_views(chat_id, user_id)
+
+def cancel_prefetch(context: ContextTypes.DEFAULT_TYPE, chat_id: str):
+    prefetch = context.user_data.get(PREFETCH_KEY, {}).pop(chat_id, None)
+    if prefetch:
+        prefetch[0].cancel()
+    
 async def mystats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ask user whether to see all stats or only nice ones."""
+    chat_id = str(update.effective_chat.id)
+    user_id = update.effective_user.id
+
+    # Start computing both views right away, so the mode callback can answer instantly
+    cancel_prefetch(context, chat_id)
+    task = context.application.create_task(fetch_user_stats_views(chat_id, user_id))
+    context.user_data.setdefault(PREFETCH_KEY, {})[chat_id] = (task, time.monotonic() + MYSTATS_PREFETCH_TTL)
+
     keyboard = [
         [InlineKeyboardButton("All", callback_data="all")],
         [InlineKeyboardButton("Nice numbers only", callback_data="nice")],
     ]
-    await update.message.reply_text(
+    outbox.reply_text(
+        update.message,
         "Which stats do you want to see?",
         reply_markup=InlineKeyboardMarkup(keyboard),
     )
@@ -113,128 +186,274 @@ async def handle_stats_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # logger.debug(f"All stats: {get_chat_stats_all()}")
     # logger.debug(f"All users: {get_users_all()}")
 
-    # logger.debug(f"All stats: {firestore_get_chat_stats_all()}")
-    # logger.debug(f"All users: {firestore_get_users_all()}")
-
     # stats = get_user_stats_nice(chat_id, user_id) if nice_only else get_user_stats_all(chat_id, user_id)
-    stats = firestore_get_user_stats_nice(chat_id, user_id) if nice_only else firestore_get_user_stats_all(chat_id, user_id)
-    
-    await query.edit_message_text(stats or "No stats yet! Start using @HowGayBot to log your gayness.")
+    try:
+        views, stale = await load_user_stats_views(context, chat_id, user_id)
+    except Exception as e:
+        logger.error(f"Failed to retrieve stats of user {user_id} in chat {chat_id}: {e}")
+        outbox.edit_message_text(query, STATS_ERROR_MESSAGE)
+        return ConversationHandler.END
+
+    if views is None:
+        outbox.edit_message_text(query, BUSY_MESSAGE)
+        return ConversationHandler.END
+
+    if nice_only:
+        text = views['nice'] or "No stats yet! Start using @HowGayBot to log your gayness."
+        outbox.edit_message_text(query, text + STALE_NOTE if stale else text)
+        return ConversationHandler.END
+
+    counts = views['histogram']
+    if not counts:
+        outbox.edit_message_text(query, "No stats yet! Start using @HowGayBot to log your gayness.")
+        return ConversationHandler.END
+
+    # Keep the histogram so paging/sorting never goes back to the store or backend
+    context.user_data.setdefault(HISTOGRAM_KEY, {})[chat_id] = (counts, time.monotonic() + MYSTATS_TIMEOUT)
+    text, markup = render_stats_page(counts, user_id, 0, "percent")
+    outbox.edit_message_text(query, text + STALE_NOTE if stale else text, reply_markup=markup)
     return ConversationHandler.END
 
+def render_stats_page(counts: list, user_id: int, page: int, sort_by: str):
+    """Formats a page of the "All" view with its navigation keyboard."""
+    text, page, pages = format_user_stats_page(counts, page, sort_by, STATS_PAGE_SIZE)
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀ Prev", callback_data=f"allpage:{user_id}:{page - 1}:{sort_by}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("Next ▶", callback_data=f"allpage:{user_id}:{page + 1}:{sort_by}"))
+    other_sort = "count" if sort_by == "percent" else "percent"
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton(f"Sort by {other_sort}", callback_data=f"allpage:{user_id}:0:{other_sort}")])
+
+    return f"{text}\n\nPage {page + 1}/{pages}", InlineKeyboardMarkup(keyboard)
+
+def parse_stats_page(data: str):
+    # Returns (owner_id, page, sort_by) of an "allpage:" callback, or None if it is malformed
+    try:
+        _, owner_id, page, sort_by = data.split(":")
+        owner_id, page = int(owner_id), int(page)
+    except ValueError:
+        return None
+    if sort_by not in ("percent", "count"):
+        return None
+    # 101 percentages: never more pages than that
+    return owner_id, min(max(page, 0), 100), sort_by
+
+async def handle_stats_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    parsed = parse_stats_page(query.data)
+    if parsed is None:
+        await query.answer("This button is no longer valid, use /mystats.")
+        return
+    owner_id, page, sort_by = parsed
+    if query.from_user.id != owner_id:
+        await query.answer("These are not your stats, use /mystats.")
+        return
+    await query.answer()
+
+    chat_id = str(query.message.chat.id)
+    cached = context.user_data.get(HISTOGRAM_KEY, {}).get(chat_id)
+    if cached and cached[1] > time.monotonic():
+        counts = cached[0]
+    else:
+        # Expired: rebuild from the in-memory chat store, within the /mystats admission limits
+        try:
+            views, _ = await fetch_user_stats_views(chat_id, owner_id)
+        except Exception as e:
+            logger.error(f"Failed to retrieve stats of user {owner_id} in chat {chat_id}: {e}")
+            outbox.edit_message_text(query, STATS_ERROR_MESSAGE)
+            return
+        if views is None:
+            outbox.edit_message_text(query, BUSY_MESSAGE)
+            return
+        counts = views['histogram']
+        if not counts:
+            outbox.edit_message_text(query, "No stats yet! Start using @HowGayBot to log your gayness.")
+            return
+        context.user_data.setdefault(HISTOGRAM_KEY, {})[chat_id] = (counts, time.monotonic() + MYSTATS_TIMEOUT)
+
+    text, markup = render_stats_page(counts, owner_id, page, sort_by)
+    outbox.edit_message_text(query, text, reply_markup=markup)
+
+async def mystats_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # The user never picked a mode: drop the speculative work
+    cancel_prefetch(context, str(update.effective_chat.id))
+
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
     # output = get_leaderboard(chat_id)
-    output = firestore_get_leaderboard(chat_id)
+    output, stale = await admitted_render("leaderboard", chat_id, ("leaderboard", chat_id),
+                                          lambda: asyncio.to_thread(store_get_leaderboard, chat_id))
+    if output is None:
+        output = BUSY_MESSAGE
+    elif stale:
+        output += STALE_NOTE
+
+    outbox.reply_text(update.message, output)
+
+async def chatstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = str(update.effective_chat.id)
+    output, stale = await admitted_render("chatstats", chat_id, ("chatstats", chat_id),
+                                          lambda: asyncio.to_thread(get_chat_stats, chat_id))
+    if output is None:
+        output = BUSY_MESSAGE
+    elif stale:
+        output += STALE_NOTE
+
+    outbox.reply_text(update.message, output)
 
-    await update.message.reply_text(output)
+async def globalboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Same text for every chat: one cached render serves them all
+    output = await render_cache.run(("globalboard", "global"), lambda: asyncio.to_thread(get_global_board))
+
+    outbox.reply_text(update.message, output)
     
 # Allow for backfill of data from exported Telegram chat JSON
 async def backfill(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Please upload the exported Telegram chat JSON file.")
+    outbox.reply_text(update.message, "Please upload the exported Telegram chat JSON file.")
 
 # Handle the uploaded JSON file
 async def handle_json_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.document:
-        await update.message.reply_text("Please upload a valid JSON file.")
+        outbox.reply_text(update.message, "Please upload a valid JSON file.")
         return
 
     document: Document = update.message.document
 
     if not document.file_name.endswith(".json"):
-        await update.message.reply_text("Only .json files are supported.")
+        outbox.reply_text(update.message, "Only .json files are supported.")
         return
 
-    file = await document.get_file()
     chat_id = str(update.effective_chat.id)
-    content = await file.download_as_bytearray()
-    data = json.loads(content)
-
-
-    count = 0
-    skipped = 0
-    local_user_last_updates = defaultdict(int)  # To track last updates per user
-    local_user_data = defaultdict(dict)  # To store user data
-    bulk_messages = []
-    for message in data.get("messages", []):
-        if message.get("via_bot") != "@HowGayBot":
-            continue
-
-        # Extracting info from json messages
-
-        # (1) message_id
-        message_id = message.get("id", 0)
-
-        # (2) percent
-        text = message.get("text", "")
-        if isinstance(text, list):  # Mixed entity case
-            text = "".join(t["text"] if isinstance(t, dict) else str(t) for t in text)
-
-        m = GAYNESS_RE.search(text)
-        if not m:
-            continue
-
-        percent = int(m.group(1))
-
-        # (3) timestamp
-        timestamp = int(message["date_unixtime"]) # Change to unixtime for easier comparison
-        
-        # (4) user_id
-        from_id = message.get("from_id", "unknown")
-        if isinstance(from_id, str) and from_id.startswith("user"):
-            user_id = int(from_id.replace("user", ""))
-        elif isinstance(from_id, int):
-            user_id = from_id
-        else:
-            user_id = "unknown"
-            
-        # (5) name
-        name = message.get("from", "")
-
-        # (6) username
-        username = ""  # Not included in Telegram export
-
-        # FILTER OUT DUPES WHILE BACKFILLING
-        # NEED TO CONFIRM THAT BACKFILLED MESSAGES ARE INSERTED IN CHRONOLOGICAL ORDER
-        # References local dictionary to track last updates per user
-        user_last_update = local_user_last_updates.get(user_id, 0)
-        if user_last_update and (timestamp - user_last_update < 60):
-            skipped += 1
-            continue
+    async with admission['backfill'].admit(chat_id) as admitted:
+        if not admitted:
+            outbox.reply_text(update.message, BUSY_MESSAGE)
+            return
+
+        file = await document.get_file()
+        content = await file.download_as_bytearray()
+        # Parsing and writing a whole export is slow: keep it off the event loop
+        count, skipped = await asyncio.to_thread(backfill_export, chat_id, content)
+
+    store_evict_chat(chat_id)
+    render_cache.invalidate(chat_id)
+
+    outbox.reply_text(update.message, f"Backfill complete. {count} messages added. {skipped} duplicates removed.")
+
+def backfill_export(chat_id: str, content: bytes):
+    """Parses an uploaded export, dedupes its stats and writes them. Returns (added, duplicates removed)."""
+    stats = (stat for stat in map(extract_stat, iter_export_messages(io.BytesIO(content))) if stat)
+
+    # FILTER OUT DUPES WHILE BACKFILLING
+    # Export order does not matter: same result as deduping the stats in chronological order
+    added = skipped = 0
+    try:
+        with StatSorter() as sorter:
+            sorter.extend(stats)
+            # Kept stats are written batch by batch, never all held at once
+            for bulk_messages, bulk_users, batch_skipped in dedupe_batches(sorter):
+                firestore_bulk_log_stat(
+                    chat_id=chat_id,
+                    messages=bulk_messages,
+                    users=bulk_users,
+                    bump_generation=False
+                )
+                added += len(bulk_messages)
+                skipped += batch_skipped
+    finally:
+        if added:
+            firestore_bump_history_generation(chat_id)
+    return added, skipped
+    
+# === ADMIN COMMANDS ===
+# Export all chats' messages or users as a compressed file: /export [messages|users] [ndjson|csv]
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    kind = context.args[0] if len(context.args) > 0 else "messages"
+    fmt = context.args[1] if len(context.args) > 1 else "ndjson"
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        outbox.reply_text(
+            update.message,
+            f"Usage: /export [{'|'.join(EXPORT_KINDS)}] [{'|'.join(EXPORT_FORMATS)}]"
+        )
+        return
+
+    outbox.reply_text(update.message, f"Exporting {kind} as {fmt}...")
+    try:
+        # Streaming export runs off the event loop so message ingestion keeps going
+        path, count = await asyncio.to_thread(export_to_file, kind, fmt, EXPORT_DIR)
+    except Exception as e:
+        logger.error(f"Failed to export {kind}: {e}")
+        outbox.reply_text(update.message, "Export failed.")
+        return
+
+    if os.path.getsize(path) > TELEGRAM_DOCUMENT_LIMIT:
+        outbox.reply_text(update.message, f"Exported {count} {kind}. File too large to send, saved at {path}.")
+        return
+
+    outbox.reply_document(update.message, path, filename=os.path.basename(path), caption=f"Exported {count} {kind}.")
+
+# Profile the live handlers for a while and receive the reports: /profile [seconds] [cprofile|sample], /profile stop
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    if context.args and context.args[0] == "stop":
+        if not is_profiling():
+            outbox.reply_text(update.message, "Profiling is not running.")
         else:
-            count += 1
-            # Update local tracking
-            local_user_last_updates[user_id] = timestamp
-            local_user_data[user_id] = {
-                'username': username,
-                'name': name,
-            }
-
-            # Prepare bulk insert data
-            bulk_messages.append({
-                'message_id': message_id,
-                'user_id': user_id,
-                'percentage': percent,
-                'timestamp': timestamp,
-            })
-
-    bulk_users = []    
-    for user_id in local_user_last_updates:
-        bulk_users.append({
-            'user_id': user_id,
-            'last_update': local_user_last_updates[user_id],
-            'username': local_user_data[user_id].get('username', ''),
-            'name': local_user_data[user_id].get('name', ''),
-        })
-        
-    firestore_bulk_log_stat(
-        chat_id=chat_id,
-        messages=bulk_messages,
-        users=bulk_users
-    )
+            await stop_profiling()
+        return
+
+    try:
+        seconds = int(context.args[0]) if len(context.args) > 0 else 60
+    except ValueError:
+        seconds = 0
+    mode = context.args[1] if len(context.args) > 1 else "cprofile"
+    if seconds <= 0 or mode not in PROFILE_MODES:
+        outbox.reply_text(update.message, f"Usage: /profile [seconds] [{'|'.join(PROFILE_MODES)}] or /profile stop")
+        return
+
+    message = update.message
+    async def send_reports(paths):
+        for path in paths:
+            outbox.reply_document(message, path, filename=os.path.basename(path))
+
+    if not start_profiling(seconds, mode, on_report=send_reports):
+        outbox.reply_text(update.message, "Profiling is already running, use /profile stop first.")
+        return
+    outbox.reply_text(update.message, f"Profiling ({mode}) for {min(seconds, PROFILE_MAX_SECONDS)}s...")
+
+# Concurrency and load shedding counters of the expensive commands: /admission
+async def admission_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    outbox.reply_text(update.message, format_admission_stats())
+
+# Watermark/counter shards of the current chat: /shards shows them, /shards <count> changes them
+async def shards(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    chat_id = str(update.effective_chat.id)
+    if context.args:
+        try:
+            shard_count = int(context.args[0])
+        except ValueError:
+            shard_count = 0
+        if not 1 <= shard_count <= MAX_CHAT_SHARDS:
+            outbox.reply_text(update.message, f"Usage: /shards [1-{MAX_CHAT_SHARDS}]")
+            return
+        await asyncio.to_thread(firestore_set_chat_shard_count, chat_id, shard_count)
+
+    shard_count = await asyncio.to_thread(firestore_get_chat_shard_count, chat_id)
+    message_count = await asyncio.to_thread(firestore_get_message_count, chat_id)
+    outbox.reply_text(update.message, f"Chat {chat_id}: {shard_count} shards, {message_count} messages logged live.")
 
-    await update.message.reply_text(f"Backfill complete. {count} messages added. {skipped} duplicates removed.")
-    
 # === MAIN MESSAGE HANDLER ===
 async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message.text
@@ -257,40 +476,16 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     percent = int(m.group(1))
 
-    # Check if the user's last update, skip if previous update is less than 60s ago
-    user_last_update = firestore_get_user_last_update(chat_id, user.id)
-    if user_last_update and (message_time - user_last_update < 60):
-        logger.debug(f"Skipping message from {user.id} in chat {chat_id} due to rate limit.")
-        return
-
-    # last_ts = get_last_update(chat_id)
-    last_ts = firestore_get_last_update(chat_id)
-
-    # Only process newer messages
-    if message_time < last_ts:
-        logger.debug(f"Skipping message from {user.id} in chat {chat_id} due to outdated timestamp.")
-        return
-
-    # log_stat(
-    #     chat_id=chat_id,
-    #     user_id=user.id,
-    #     username=user.username or "",
-    #     name=user.full_name,
-    #     percent=percent,
-    #     ts=message_time
-    # )
-    firestore_log_stat(
-        chat_id=chat_id,
-        message_id=msg_id,
-        user_id=user.id,
-        username=user.username or "",
-        name=user.full_name,
-        percent=percent,
-        timestamp=message_time
-    )
-
-    # update_last_timestamp(chat_id, message_time)
-    firestore_update_last_timestamp(chat_id, message_time)
+    # Spool the stat and return; the replayer applies it to Firestore in the background
+    enqueue_stat({
+        'chat_id': chat_id,
+        'message_id': msg_id,
+        'user_id': user.id,
+        'username': user.username or "",
+        'name': user.full_name,
+        'percent': percent,
+        'timestamp': message_time,
+    })
     
 # === CHAT MEMBER HANDLER ===
 ## if bot is removed from a chat, delete its data
@@ -300,9 +495,7 @@ async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
         chat_id = update.effective_chat.id
         # delete_chat_data(chat_id)
         firestore_delete_chat_data(chat_id)
+        store_evict_chat(chat_id)
+        render_cache.invalidate(chat_id, keep_stale=False)
         logger.info(f"Bot removed from chat {chat_id}, data deleted")
-
-        try :
-            await context.bot.send_message(chat_id=chat_id, text="Bot removed, data deleted.")
-        except Exception as e:
-            logger.warning(f"Could not send removal message to chat {chat_id}: {e}")
\ No newline at end of file
+        outbox.send_message(context.bot, chat_id, "Bot removed, data deleted.")
\ No newline at end of file
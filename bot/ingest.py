@@ -0,0 +1,104 @@
+## Module that applies logged stats to the backend, behind the local write-ahead spool
+## process_message only appends to the spool; the replayer calls apply_stat for each entry.
+import os
+from dotenv import load_dotenv
+from utils.firestore import (
+    log_stat as firestore_log_stat,
+    get_cached_last_update as firestore_get_cached_last_update,
+    get_user_doc as firestore_get_user_doc,
+    message_exists as firestore_message_exists,
+)
+from utils.chat_store import record_stat as store_record_stat, get_user_rolls as store_get_user_rolls
+from utils.records import RECORDS_UTC_OFFSET_HOURS, UserRecords, records_of
+from utils.globalboard import global_board_writes
+from utils.spool import Spool, Replayer
+from utils.singleflight import render_cache
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+SPOOL_PATH = os.getenv("SPOOL_PATH", "data/spool.db")
+# Chats whose stats are applied at once (each chat's stats stay in order)
+SPOOL_REPLAY_CONCURRENCY = int(os.getenv("SPOOL_REPLAY_CONCURRENCY", "8"))
+
+os.makedirs(os.path.dirname(SPOOL_PATH) or ".", exist_ok=True)
+spool = Spool(SPOOL_PATH)
+
+def _next_records(chat_id: int, user_id: str, user_doc: dict, percent: int, timestamp: int):
+    """
+    Returns the user's records including a new roll, and whether they were rebuilt.
+    Stored records are updated in O(1) unless they were computed with another UTC offset,
+    invalidated by a backfill, or the roll is older than them: then they are rebuilt from
+    the chat's messages.
+    """
+    stored = user_doc.get('records') or {}
+    if not user_doc or stored.get('utc_offset') == RECORDS_UTC_OFFSET_HOURS:
+        records = UserRecords.from_doc(stored)
+        if records.add(percent, timestamp):
+            # A new user's records are complete: store them with the offset
+            return records, not user_doc
+    logger.info(f"Rebuilding records of user {user_id} in chat {chat_id}.")
+    return records_of(store_get_user_rolls(chat_id, user_id) + [(percent, timestamp)]), True
+
+def apply_stat(entry: dict):
+    """
+    Applies one spooled stat to Firestore (and the in-memory chat store).
+    Raises if the write fails, so the replayer retries it later.
+
+    Parameters:
+        entry (dict): chat_id, message_id, user_id, username, name, percent, timestamp
+    """
+    chat_id = entry['chat_id']
+    user_id = entry['user_id']
+    message_time = entry['timestamp']
+
+    # Check if the user's last update, skip if previous update is less than 60s ago
+    user_doc = firestore_get_user_doc(chat_id, user_id)
+    user_last_update = user_doc.get('last_update', 0)
+    if user_last_update and (message_time - user_last_update < 60):
+        # A replay of this very stat (its write went through, a later step or the ack did not):
+        # finish applying it instead of dropping it as rate limited
+        if not firestore_message_exists(chat_id, entry['message_id']):
+            logger.debug(f"Skipping message from {user_id} in chat {chat_id} due to rate limit.")
+            return
+        logger.info(f"Resuming already logged message {entry['message_id']} in chat {chat_id}.")
+    else:
+        # Kept in memory per chat: one read per message (the user document)
+        last_ts = firestore_get_cached_last_update(chat_id)
+
+        # Only process newer messages
+        if message_time < last_ts:
+            logger.debug(f"Skipping message from {user_id} in chat {chat_id} due to outdated timestamp.")
+            return
+
+        records, exact_records = _next_records(chat_id, user_id, user_doc, entry['percent'], message_time)
+
+        # One atomic write: the message, the chat's sharded watermark/counter, the user and their global totals
+        firestore_log_stat(
+            chat_id=chat_id,
+            message_id=entry['message_id'],
+            user_id=user_id,
+            username=entry['username'],
+            name=entry['name'],
+            percent=entry['percent'],
+            timestamp=message_time,
+            records=records,
+            exact_records=exact_records,
+            extra_writes=global_board_writes(user_id, entry['username'] or entry['name'], entry['percent']),
+        )
+    # Idempotent: a stat the chat store already holds is not appended again
+    store_record_stat(chat_id, user_id, entry['username'], entry['name'], entry['percent'], message_time)
+
+def on_stat_applied(entry: dict):
+    # Cached /leaderboard, /mystats and /chatstats texts of the chat are now outdated
+    render_cache.invalidate(entry['chat_id'])
+
+replayer = Replayer(spool, apply_stat, on_applied=on_stat_applied,
+                    key=lambda entry: entry.get('chat_id'), concurrency=SPOOL_REPLAY_CONCURRENCY)
+
+def enqueue_stat(entry: dict):
+    """Durably records a stat for the replayer; returns without waiting for Firestore."""
+    spool.append(entry)
+    replayer.wake()
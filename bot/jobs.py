@@ -0,0 +1,77 @@
+## Module that schedules the bot's background jobs
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+from telegram.ext import Application, ContextTypes
+from utils.snapshot import save_snapshot
+from utils.archive import archive_cutoff
+from utils.firestore import compact_all_chats
+from utils.globalboard import reconcile_global_board
+from bot.ingest import replayer, spool
+from utils.outbox import outbox
+from utils.profiling import start_profiling, stop_profiling, PROFILE_ON_START, PROFILE_MODE
+from utils.admission import log_admission_stats
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Snapshot of the in-memory chat store, reloaded at boot (empty path disables snapshots)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "data/chat_snapshot.bin")
+SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "300"))
+# Messages older than this many days (rounded down to whole months) are compacted into archives (0 disables)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+COMPACTION_INTERVAL_SECONDS = int(os.getenv("COMPACTION_INTERVAL_SECONDS", "86400"))
+# Exact recount of the /globalboard totals (0 disables)
+GLOBAL_BOARD_RECONCILE_SECONDS = int(os.getenv("GLOBAL_BOARD_RECONCILE_SECONDS", "86400"))
+# How often queued/shed command counters are logged, when they changed (0 disables)
+ADMISSION_LOG_SECONDS = int(os.getenv("ADMISSION_LOG_SECONDS", "300"))
+
+def setup_jobs(app: Application):
+    if SNAPSHOT_PATH:
+        app.job_queue.run_repeating(snapshot_job, interval=SNAPSHOT_INTERVAL_SECONDS, first=SNAPSHOT_INTERVAL_SECONDS)
+    if ARCHIVE_AFTER_DAYS > 0:
+        app.job_queue.run_repeating(compaction_job, interval=COMPACTION_INTERVAL_SECONDS, first=60)
+    if GLOBAL_BOARD_RECONCILE_SECONDS > 0:
+        app.job_queue.run_repeating(global_board_job, interval=GLOBAL_BOARD_RECONCILE_SECONDS, first=GLOBAL_BOARD_RECONCILE_SECONDS)
+    if ADMISSION_LOG_SECONDS > 0:
+        app.job_queue.run_repeating(admission_log_job, interval=ADMISSION_LOG_SECONDS, first=ADMISSION_LOG_SECONDS)
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    # Packed under store_lock (stats are appended from the replayer's thread), off the event loop
+    await asyncio.to_thread(save_snapshot, SNAPSHOT_PATH)
+
+async def compaction_job(context: ContextTypes.DEFAULT_TYPE):
+    # Firestore-bound and slow on first run: keep it off the event loop
+    await asyncio.to_thread(compact_all_chats, archive_cutoff(time.time(), ARCHIVE_AFTER_DAYS))
+
+async def global_board_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await asyncio.to_thread(reconcile_global_board)
+    except Exception as e:
+        logger.error(f"Failed to reconcile global board: {e}")
+
+async def admission_log_job(context: ContextTypes.DEFAULT_TYPE):
+    log_admission_stats()
+
+async def on_startup(app: Application):
+    # Drain stats spooled by process_message (including any left over from the last run)
+    replayer.start()
+    if PROFILE_ON_START:
+        start_profiling(PROFILE_ON_START, PROFILE_MODE)
+
+async def on_stop(app: Application):
+    # The bot can still send here: give queued replies a chance to go out
+    # Keep the reports of a window still open at shutdown (sent before the flush)
+    await stop_profiling()
+    await outbox.flush()
+
+async def on_shutdown(app: Application):
+    # Pending entries stay in the spool and are replayed on the next start
+    # stop() waits for a stat being applied, so the snapshot includes it
+    await replayer.stop()
+    spool.close()
+    if SNAPSHOT_PATH:
+        await asyncio.to_thread(save_snapshot, SNAPSHOT_PATH)
@@ -2,7 +2,11 @@ import os
 from dotenv import load_dotenv
 from telegram.ext import ApplicationBuilder
 from bot.handlers import setup_handlers
+from bot.jobs import setup_jobs, on_startup, on_stop, on_shutdown, SNAPSHOT_PATH
+from utils.coherence import enable_cache_coherence
 from utils.logger import init_logger
+from utils.snapshot import load_snapshot
+from utils.transport import configure_transport, TELEGRAM_POLL_TIMEOUT
 
 # Load environment variables
 load_dotenv()
@@ -16,8 +20,15 @@ if not TOKEN:
 init_logger("logs/gayness_bot_stats.log")
 
 # Build the Telegram bot application
-app = ApplicationBuilder().token(TOKEN).build()
+app = configure_transport(ApplicationBuilder().token(TOKEN)).post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown).build()
 setup_handlers(app)
+setup_jobs(app)
+
+enable_cache_coherence()
+
+# Warm the chat store from the last snapshot; chats catch up with Firestore on first use
+if SNAPSHOT_PATH:
+    load_snapshot(SNAPSHOT_PATH)
 
 if __name__ == "__main__":
-    app.run_polling()
+    app.run_polling(timeout=TELEGRAM_POLL_TIMEOUT)
@@ -0,0 +1,29 @@
+## Test setup: utils/firestore.py connects at import, so give it a throwaway service account.
+## Nothing is sent to Firestore: the client is lazy, and tests patch the functions they need.
+import json
+import os
+import sys
+import tempfile
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# bot/ingest.py opens its spool at import
+os.environ.setdefault("SPOOL_PATH", os.path.join(tempfile.mkdtemp(), "spool.db"))
+
+if not os.getenv("FIREBASE_CREDENTIALS"):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    os.environ["FIREBASE_CREDENTIALS"] = json.dumps({
+        "type": "service_account",
+        "project_id": "test-project",
+        "private_key_id": "test",
+        "private_key": key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode(),
+        "client_email": "test@test-project.iam.gserviceaccount.com",
+        "client_id": "1",
+        "token_uri": "https://oauth2.googleapis.com/token",
+    })
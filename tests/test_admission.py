@@ -0,0 +1,104 @@
+## Tests of utils/admission.py: concurrency limits, queueing and shedding of expensive commands
+import asyncio
+import pytest
+import utils.admission as admission_module
+from utils.admission import AdmissionController, admitted_render
+from utils.singleflight import SingleFlight
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_per_chat_and_global_limits():
+    async def main():
+        controller = AdmissionController("test", per_chat=1, global_limit=2, queue_timeout=0)
+        assert await controller.acquire("1")
+        assert not await controller.acquire("1")  # Over the chat's limit
+        assert await controller.acquire("2")
+        assert not await controller.acquire("3")  # Over the global limit
+        controller.release("1")
+        assert await controller.acquire("3")
+        assert (controller.running, controller.admitted, controller.shed) == (2, 3, 2)
+    run(main())
+
+def test_waiter_gets_released_slot():
+    async def main():
+        controller = AdmissionController("test", per_chat=1, global_limit=1, queue_timeout=5)
+        assert await controller.acquire("1")
+        waiter = asyncio.ensure_future(controller.acquire("2"))
+        await asyncio.sleep(0)
+        assert controller.queued == 1 and not waiter.done()
+        controller.release("1")
+        assert await waiter
+        assert controller.running_by_chat == {"2": 1}
+    run(main())
+
+def test_waiter_of_busy_chat_does_not_block_others():
+    async def main():
+        controller = AdmissionController("test", per_chat=1, global_limit=2, queue_timeout=5)
+        assert await controller.acquire("1")
+        assert await controller.acquire("2")
+        same_chat = asyncio.ensure_future(controller.acquire("1"))
+        other_chat = asyncio.ensure_future(controller.acquire("3"))
+        await asyncio.sleep(0)
+        controller.release("2")
+        assert await other_chat
+        assert not same_chat.done()
+        controller.release("1")
+        assert await same_chat
+    run(main())
+
+def test_queue_timeout_and_bound():
+    async def main():
+        controller = AdmissionController("test", per_chat=1, global_limit=1, max_queued=1, queue_timeout=0.05)
+        assert await controller.acquire("1")
+        waiter = asyncio.ensure_future(controller.acquire("1"))
+        await asyncio.sleep(0)
+        assert not await controller.acquire("2")  # Queue full: shed at once
+        assert not await waiter                    # Timed out
+        assert controller.shed == 2 and not controller._waiters
+        controller.release("1")
+        assert controller.running == 0
+    run(main())
+
+def test_cancelled_waiter_leaves_queue():
+    async def main():
+        controller = AdmissionController("test", per_chat=1, global_limit=1, queue_timeout=5)
+        assert await controller.acquire("1")
+        waiter = asyncio.ensure_future(controller.acquire("1"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not controller._waiters
+        controller.release("1")
+        assert controller.running == 0 and not controller.running_by_chat
+    run(main())
+
+@pytest.fixture
+def render(monkeypatch):
+    cache = SingleFlight(ttl=30)
+    controller = AdmissionController("leaderboard", per_chat=1, global_limit=1, queue_timeout=0)
+    monkeypatch.setattr(admission_module, "render_cache", cache)
+    monkeypatch.setattr(admission_module, "admission", {'leaderboard': controller})
+    return cache, controller
+
+def test_admitted_render_sheds_to_stale(render):
+    cache, controller = render
+
+    async def compute(value):
+        return value
+
+    async def main():
+        key = ('leaderboard', "1")
+        assert await admitted_render('leaderboard', "1", key, lambda: compute("v1")) == ("v1", False)
+        cache.invalidate("1")
+        assert await controller.acquire("1")  # Another render of the chat is running
+        assert await admitted_render('leaderboard', "1", key, lambda: compute("v2")) == ("v1", True)
+        assert await admitted_render('leaderboard', "1", ('leaderboard', "1", 'other'), lambda: compute("v3")) == (None, False)
+        assert controller.served_stale == 1
+        controller.release("1")
+        assert await admitted_render('leaderboard', "1", key, lambda: compute("v2")) == ("v2", False)
+        # Cached results are served without a slot
+        assert await controller.acquire("1")
+        assert await admitted_render('leaderboard', "1", key, lambda: compute("v3")) == ("v2", False)
+    run(main())
@@ -0,0 +1,52 @@
+## Tests of utils/archive.py: packed monthly archives must unpack to the same messages and stay under the size cap
+import random
+from datetime import datetime, timezone
+import utils.archive as archive
+from utils.archive import (pack_archive_parts, unpack_archive, archived_message_ids, month_key, month_bounds,
+                           archive_cutoff, archive_doc_id)
+
+def month_rows(month: str, n: int, seed: int = 0):
+    rng = random.Random(seed)
+    start, end = month_bounds(month)
+    users = [1, 2, 10**12, -100123]
+    return [(rng.randint(1, 2**40), rng.choice(users), rng.randint(0, 100), rng.randrange(start, end)) for _ in range(n)]
+
+def test_round_trip():
+    rows = month_rows("2024-02", 1000)
+    parts = pack_archive_parts("2024-02", rows)
+    assert len(parts) == 1
+    doc_id, data = parts[0]
+    assert doc_id == "2024-02" and data['count'] == 1000
+    assert sorted(unpack_archive(data)) == sorted(rows)
+    assert archived_message_ids(data) == {row[0] for row in rows}
+
+def test_nice_counts():
+    rows = [(1, 5, 100, 1717200000), (2, 5, 100, 1717200001), (3, 5, 69, 1717200002), (4, 6, 50, 1717200003)]
+    _, data = pack_archive_parts("2024-06", rows)[0]
+    assert data['nice_counts'] == {'5': {'100': 2, '69': 1}}
+
+def test_split_under_size_cap(monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_MAX_BYTES", 100 * archive.BYTES_PER_MESSAGE)
+    rows = month_rows("2023-12", 550, seed=1)
+    parts = pack_archive_parts("2023-12", rows, first_part=2)
+    assert [doc_id for doc_id, _ in parts] == [archive_doc_id("2023-12", part) for part in range(2, 2 + len(parts))]
+    assert parts[0][0] == "2023-12-p2"
+    for _, data in parts:
+        packed = sum(len(data[field]) for field in ('message_ids', 'user_index', 'percentages', 'timestamps'))
+        assert packed <= archive.ARCHIVE_MAX_BYTES
+    unpacked = [row for _, data in parts for row in unpack_archive(data)]
+    assert unpacked == sorted(rows, key=lambda row: row[3])
+
+def test_oversized_message_still_archived(monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_MAX_BYTES", 1)
+    parts = pack_archive_parts("2024-01", month_rows("2024-01", 3))
+    assert [data['count'] for _, data in parts] == [1, 1, 1]
+
+def test_months():
+    assert month_key(0) == "1970-01"
+    assert month_bounds("2023-12") == (1701388800, 1704067200)
+    start, end = month_bounds("2024-02")
+    assert (end - start) == 29 * 86400
+    assert month_key(start) == "2024-02" and month_key(end - 1) == "2024-02" and month_key(end) == "2024-03"
+    now = datetime(2024, 5, 10, tzinfo=timezone.utc).timestamp()
+    assert archive_cutoff(now, 30) == month_bounds("2024-04")[0]
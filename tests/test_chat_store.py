@@ -0,0 +1,93 @@
+## Tests of utils/chat_store.py: lazy hydration, appends, reconciliation and eviction of in-memory chats
+## (the Firestore reads are replaced by in-memory messages)
+from collections import OrderedDict
+import pytest
+import utils.chat_store as chat_store
+
+class Backend:
+    def __init__(self):
+        self.messages = {}    # chat_id -> [(user_id, percent, timestamp)]
+        self.users = {}       # chat_id -> {str(user_id): user doc}
+        self.generation = {}  # chat_id -> history generation
+        self.reads = []       # (chat_id, since) of every messages read
+
+    def get_chat_messages(self, chat_id, since=None):
+        self.reads.append((chat_id, since))
+        return [row for row in self.messages.get(chat_id, []) if since is None or row[2] >= since]
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = Backend()
+    monkeypatch.setattr(chat_store, "get_chat_messages", backend.get_chat_messages)
+    monkeypatch.setattr(chat_store, "get_chat_users", lambda chat_id: backend.users.get(chat_id, {}))
+    monkeypatch.setattr(chat_store, "get_history_generation", lambda chat_id: backend.generation.get(chat_id, 0))
+    monkeypatch.setattr(chat_store, "_stores", OrderedDict())
+    monkeypatch.setattr(chat_store, "_loading", {})
+    monkeypatch.setattr(chat_store, "_residency_hooks", [])
+    return backend
+
+def test_hydrated_once(backend):
+    backend.messages["1"] = [(5, 69, 100), (6, 100, 200), (5, 69, 300)]
+    backend.users["1"] = {"5": {'username': "five", 'name': "Five", 'last_update': 300}}
+    store = chat_store.get_store(1)
+    assert chat_store.get_store("1") is store
+    assert backend.reads == [("1", None)]
+    user = store.get_user(5)
+    assert (user.counts[69], user.last_seen[69], user.display_name) == (2, 300, "five")
+    assert store.get_user(6).display_name == "Unknown"
+    assert chat_store.get_user_histogram(1, 5)[69] == 2
+
+def test_record_stat(backend):
+    chat_store.record_stat(1, 5, "five", "Five", 50, 100)
+    assert chat_store.peek_store(1) is None  # Not resident: picked up by hydration instead
+    store = chat_store.get_store(1)
+    chat_store.record_stat(1, 5, "five", "Five", 50, 100)
+    chat_store.record_stat(1, 5, "five", "Five", 50, 100)  # Replayed
+    chat_store.record_stat(1, 6, "", "Six", 100, 200)
+    assert len(store) == 2
+    assert store.get_user(5).counts[50] == 1 and store.get_user(6).name == "Six"
+
+def test_reconcile_fetches_only_newer_messages(backend):
+    backend.messages["1"] = [(5, 10, 100)]
+    store = chat_store.get_store(1)
+    # Another instance wrote these; the last one was already appended here too
+    backend.messages["1"] += [(6, 20, 200), (5, 30, 300)]
+    chat_store.record_stat(1, 5, "", "", 30, 300)
+    chat_store.mark_stale(1, 150)
+    chat_store.mark_stale(1, 250)  # The earliest point is kept
+    assert chat_store.get_store(1) is store
+    assert backend.reads[-1] == ("1", 150)
+    assert sorted(zip(store.timestamps, store.percentages)) == [(100, 10), (200, 20), (300, 30)]
+    assert store.reconcile_from is None
+
+def test_rewritten_history_is_hydrated_again(backend):
+    backend.messages["1"] = [(5, 10, 100)]
+    store = chat_store.get_store(1)
+    backend.messages["1"].insert(0, (5, 20, 50))  # Backfill of older messages
+    backend.generation["1"] = 1
+    chat_store.invalidate_history(1, 1)
+    assert chat_store.peek_store(1) is None
+    reloaded = chat_store.get_store(1)
+    assert reloaded is not store and len(reloaded) == 2 and reloaded.generation == 1
+
+def test_least_recently_used_chat_evicted(backend, monkeypatch):
+    evicted = []
+    chat_store.add_residency_hook(lambda chat_id: None, evicted.append)
+    for chat_id in ("1", "2", "3"):
+        backend.messages[chat_id] = [(5, 10, 100)]
+    one = chat_store.get_store(1)
+    chat_store.get_store(2)
+    monkeypatch.setattr(chat_store, "CHAT_STORE_MAX_BYTES", 2 * one.nbytes())
+    chat_store.get_store(1)  # Most recently used again
+    chat_store.get_store(3)
+    assert evicted == ["2"]
+    assert [store.chat_id for store in chat_store.resident_stores()] == ["1", "3"]
+
+def test_leaderboard_and_nice_stats(backend):
+    backend.messages["1"] = [(5, 100, 100), (6, 100, 200), (6, 100, 300), (5, 69, 400)]
+    backend.users["1"] = {"5": {'username': "five"}, "6": {'username': "six"}}
+    board = chat_store.get_leaderboard(1)
+    assert board.index("@six x2") < board.index("@five x1")
+    assert "→ 1 times" in chat_store.get_user_stats_nice(1, 5)
+    assert chat_store.get_user_stats_nice(1, 7) == "No nice stats yet!"
+    assert chat_store.get_leaderboard(2).startswith("No leaderboard yet!")
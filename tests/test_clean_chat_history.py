@@ -0,0 +1,45 @@
+## Tests of utils/clean_chat_history_json.py: parsing of exported rolls and the bot's per-user dedupe
+from utils.clean_chat_history_json import extract_stat, dedupe_stats, DEDUPE_WINDOW_SECONDS
+
+def message(**fields):
+    base = {'id': 10, 'via_bot': "@HowGayBot", 'from': "Alice", 'from_id': "user42",
+            'text': "I am 69% gay", 'date_unixtime': "1700000000"}
+    base.update(fields)
+    return base
+
+def stat(user_id, timestamp, name="A"):
+    return {'message_id': timestamp, 'user_id': user_id, 'name': name, 'percentage': 50, 'timestamp': timestamp}
+
+def test_extract_stat():
+    assert extract_stat(message()) == {'message_id': 10, 'user_id': 42, 'name': "Alice",
+                                       'percentage': 69, 'timestamp': 1700000000}
+
+def test_extract_formatted_text_and_ids():
+    formatted = message(text=["🏳️‍🌈 I am ", {'type': "bold", 'text': "100"}, "% gay!"], from_id=7)
+    assert extract_stat(formatted)['percentage'] == 100
+    assert extract_stat(formatted)['user_id'] == 7
+    assert extract_stat(message(from_id="channel5"))['user_id'] == "unknown"
+    assert extract_stat(message(from_id=None))['user_id'] == "unknown"
+
+def test_extract_ignores_other_messages():
+    assert extract_stat(message(via_bot="@OtherBot")) is None
+    assert extract_stat(message(via_bot=None)) is None
+    assert extract_stat(message(text="I am very gay")) is None
+
+def test_dedupe_window_is_per_user():
+    stats = [stat(1, 1000), stat(2, 1010), stat(1, 1000 + DEDUPE_WINDOW_SECONDS - 1),
+             stat(1, 1000 + DEDUPE_WINDOW_SECONDS, name="B")]
+    kept, users, skipped = dedupe_stats(stats)
+    assert [(s['user_id'], s['timestamp']) for s in kept] == [(1, 1000), (2, 1010), (1, 1000 + DEDUPE_WINDOW_SECONDS)]
+    assert skipped == 1
+    assert {user['user_id']: (user['last_update'], user['name']) for user in users} == {
+        1: (1000 + DEDUPE_WINDOW_SECONDS, "B"), 2: (1010, "A")}
+
+def test_dedupe_measures_from_last_kept_roll():
+    # 30s apart each: every other roll is a minute after the last kept one
+    kept, _, skipped = dedupe_stats([stat(1, 1000 + 30 * i) for i in range(5)])
+    assert [s['timestamp'] for s in kept] == [1000, 1060, 1120]
+    assert skipped == 2
+
+def test_dedupe_empty():
+    assert dedupe_stats([]) == ([], [], 0)
@@ -0,0 +1,43 @@
+## Tests of utils/coherence.py listener callbacks (the chat store and Firestore helpers are replaced)
+from types import SimpleNamespace
+import pytest
+import utils.coherence as coherence
+
+@pytest.fixture
+def chat(monkeypatch):
+    chat = SimpleNamespace(store=SimpleNamespace(watermark=1000), own=0, stale=[], evicted=[], forgotten=[], generations=[])
+    monkeypatch.setattr(coherence, "peek_store", lambda chat_id: chat.store)
+    monkeypatch.setattr(coherence, "get_own_last_update", lambda chat_id: chat.own)
+    monkeypatch.setattr(coherence, "mark_stale", lambda chat_id, since: chat.stale.append(since))
+    monkeypatch.setattr(coherence, "evict_chat", chat.evicted.append)
+    monkeypatch.setattr(coherence, "forget_chat", chat.forgotten.append)
+    monkeypatch.setattr(coherence, "invalidate_history", lambda chat_id, generation: chat.generations.append(generation))
+    return chat
+
+def test_other_writer_marks_stale(chat):
+    coherence._on_watermark_change("1", 1001)
+    assert chat.stale == [1000 - coherence.COHERENCE_SLACK_SECONDS]
+
+def test_known_watermark_is_ignored(chat):
+    coherence._on_watermark_change("1", 1000)
+    coherence._on_watermark_change("1", 10)
+    assert chat.stale == []
+
+def test_own_write_before_append_is_ignored(chat):
+    # Written by this instance, not appended to the store yet
+    chat.own = 1005
+    coherence._on_watermark_change("1", 1005)
+    assert chat.stale == []
+    coherence._on_watermark_change("1", 1006)
+    assert len(chat.stale) == 1
+
+def test_non_resident_chat_is_ignored(chat):
+    chat.store = None
+    coherence._on_watermark_change("1", 5000)
+    assert chat.stale == []
+
+def test_chat_changes(chat):
+    coherence._on_chat_change("1", {'history_generation': 3, 'last_update': 2000})
+    assert chat.generations == [3] and len(chat.stale) == 1
+    coherence._on_chat_change("1", None)
+    assert chat.evicted == ["1"] and chat.forgotten == ["1"]
@@ -0,0 +1,102 @@
+## Property tests of utils/dedupe.py: whatever the order of the stats and however they are
+## spilled or batched, the result must be the one of the reference chronological pass
+import random
+import pytest
+from utils.dedupe import StatSorter, dedupe_batches, dedupe_reference, dedupe_unordered
+
+USER_IDS = [1, 2, 3, "unknown", 10**12, -5]
+
+def make_stats(rng: random.Random, n: int, span: int, users: list):
+    stats = []
+    for i in range(n):
+        # Some rolls at timestamp 0, which dedupe_stats treats as "no previous roll"
+        timestamp = 0 if rng.random() < 0.05 else rng.randint(1, span)
+        stats.append({
+            'message_id': i,
+            'user_id': rng.choice(users),
+            'name': f"name{i}",
+            'percentage': rng.randint(0, 100),
+            'timestamp': timestamp,
+        })
+    return stats
+
+def arrange(rng: random.Random, stats: list, order: str):
+    stats = list(stats)
+    if order == "sorted":
+        stats.sort(key=lambda stat: stat['timestamp'])
+    elif order == "reversed":
+        stats.sort(key=lambda stat: stat['timestamp'], reverse=True)
+    elif order == "rotated":
+        # Ordered runs concatenated out of order, like overlapping export files
+        stats.sort(key=lambda stat: stat['timestamp'])
+        k = rng.randint(0, len(stats))
+        stats = stats[k:] + stats[:k]
+    elif order == "shuffled":
+        rng.shuffle(stats)
+    return stats
+
+def normalized(result):
+    kept, users, skipped = result
+    kept = sorted(kept, key=lambda stat: stat['message_id'])
+    users = sorted(((str(user['user_id']), user['last_update'], user['name']) for user in users))
+    return kept, users, skipped
+
+@pytest.mark.parametrize("order", ["random", "sorted", "reversed", "rotated", "shuffled"])
+@pytest.mark.parametrize("run_size", [1, 2, 7, 64, 100000])
+def test_matches_reference(order, run_size):
+    rng = random.Random(f"{order}-{run_size}")
+    for _ in range(100):
+        users = USER_IDS[:rng.randint(1, len(USER_IDS))]
+        span = rng.choice([60, 300, 3000, 10**8])
+        stats = arrange(rng, make_stats(rng, rng.randint(0, 200), span, users), order)
+
+        expected = normalized(dedupe_reference(stats))
+        assert normalized(dedupe_unordered(iter(stats), run_size=run_size)) == expected
+
+@pytest.mark.parametrize("batch_size", [1, 3, 50])
+def test_batches_match_reference(batch_size):
+    rng = random.Random(batch_size)
+    for _ in range(100):
+        stats = arrange(rng, make_stats(rng, rng.randint(0, 200), 3000, USER_IDS), "shuffled")
+
+        kept, users, skipped = [], [], 0
+        with StatSorter(run_size=16) as sorter:
+            sorter.extend(stats)
+            for batch_kept, batch_users, batch_skipped in dedupe_batches(sorter, batch_size=batch_size):
+                assert len(batch_kept) <= batch_size
+                kept += batch_kept
+                users += batch_users
+                skipped += batch_skipped
+        assert normalized((kept, users, skipped)) == normalized(dedupe_reference(stats))
+
+def test_equal_timestamps_keep_arrival_order():
+    stats = [{'message_id': i, 'user_id': 7, 'name': str(i), 'percentage': i, 'timestamp': 1000} for i in range(5)]
+    for run_size in (1, 2, 10):
+        kept, users, skipped = dedupe_unordered(stats, run_size=run_size)
+        assert [stat['message_id'] for stat in kept] == [0]
+        assert skipped == 4
+        assert users == [{'user_id': 7, 'last_update': 1000, 'username': "", 'name': "0"}]
+
+def test_string_ids_kept_apart():
+    stats = [
+        {'message_id': 1, 'user_id': "unknown", 'name': "a", 'percentage': 1, 'timestamp': 100},
+        {'message_id': 2, 'user_id': "other", 'name': "b", 'percentage': 2, 'timestamp': 110},
+        {'message_id': 3, 'user_id': "unknown", 'name': "a", 'percentage': 3, 'timestamp': 120},
+        {'message_id': 4, 'user_id': 1, 'name': "c", 'percentage': 4, 'timestamp': 130},
+    ]
+    for run_size in (1, 2, 10):
+        assert normalized(dedupe_unordered(reversed(stats), run_size=run_size)) == normalized(dedupe_reference(stats))
+
+def test_timestamp_zero_is_no_previous_roll():
+    stats = [
+        {'message_id': 1, 'user_id': 1, 'name': "a", 'percentage': 1, 'timestamp': 0},
+        {'message_id': 2, 'user_id': 1, 'name': "a", 'percentage': 2, 'timestamp': 30},
+        {'message_id': 3, 'user_id': 1, 'name': "a", 'percentage': 3, 'timestamp': 50},
+    ]
+    kept, _, skipped = dedupe_unordered(stats, run_size=1)
+    assert [stat['message_id'] for stat in kept] == [1, 2]
+    assert skipped == 1
+    assert normalized((kept, _, skipped)) == normalized(dedupe_reference(stats))
+
+def test_empty():
+    assert dedupe_unordered([], run_size=1) == ([], [], 0)
@@ -0,0 +1,44 @@
+## Tests of utils/export.py: streamed gzip NDJSON/CSV export files
+import csv
+import gzip
+import json
+import pytest
+import utils.export as export
+import utils.firestore as fs
+from utils.export import write_rows, export_to_file
+
+COLUMNS = ['chat_id', 'user_id', 'username', 'name', 'last_update']
+ROWS = [{'chat_id': "-100", 'user_id': "5", 'username': "five", 'name': "Fïve, \"the\" user", 'last_update': 1700000000},
+        {'chat_id': "7", 'user_id': "6", 'username': "", 'name': "Six\nlines", 'last_update': 0}]
+
+def test_ndjson(tmp_path):
+    path = str(tmp_path / "users.ndjson.gz")
+    assert write_rows(iter(ROWS), path, 'ndjson', COLUMNS) == 2
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        assert [json.loads(line) for line in f] == ROWS
+
+def test_csv(tmp_path):
+    path = str(tmp_path / "users.csv.gz")
+    assert write_rows(iter(ROWS), path, 'csv', COLUMNS) == 2
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert rows == [{key: str(value) for key, value in row.items()} for row in ROWS]
+
+def test_export_to_file(tmp_path, monkeypatch):
+    def rows():
+        yield from ROWS
+    monkeypatch.setitem(export.EXPORT_KINDS, 'users', (rows, COLUMNS))
+    path, count = export_to_file('users', 'ndjson', str(tmp_path / "exports"))
+    assert count == 2 and path.endswith(".ndjson.gz") and path.startswith(str(tmp_path / "exports"))
+    with pytest.raises(ValueError):
+        export_to_file('chats', 'csv', str(tmp_path))
+    with pytest.raises(ValueError):
+        export_to_file('users', 'xml', str(tmp_path))
+
+def test_user_rows(monkeypatch):
+    pages = [("1", "5", {'username': "five", 'name': "Five", 'last_update': 3}), ("1", "6", {})]
+    monkeypatch.setattr(fs, "iter_collection_group", lambda collection, fields, page_size: iter(pages))
+    assert list(fs.iter_user_rows()) == [
+        {'chat_id': "1", 'user_id': "5", 'username': "five", 'name': "Five", 'last_update': 3},
+        {'chat_id': "1", 'user_id': "6", 'username': "UNKNOWN", 'name': "UNKNOWN", 'last_update': 0},
+    ]
@@ -0,0 +1,57 @@
+## Tests of utils/globalboard.py: the writes batched with each stat and how the board adds up
+## the base and its shards (Firestore documents are replaced by plain objects)
+from types import SimpleNamespace
+import utils.globalboard as globalboard
+
+def doc(doc_id, data):
+    return SimpleNamespace(id=doc_id, to_dict=lambda: data)
+
+class FakeBoard:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def stream(self):
+        return iter(self.docs)
+
+    def document(self, doc_id):
+        return SimpleNamespace(id=doc_id)
+
+def test_other_percentages_write_nothing():
+    assert globalboard.global_board_writes(1, "a", 50) == []
+
+def test_contenders_are_added_up_on_a_shard(monkeypatch):
+    monkeypatch.setattr(globalboard, "board", FakeBoard([]))
+    monkeypatch.setattr(globalboard, "_is_contender", lambda key, percent: key == "1")
+
+    writes = globalboard.global_board_writes(1, "a", 100)
+    assert len(writes) == 2
+    user_ref, user_data = writes[0]
+    assert user_ref.id == "1"
+    assert user_data['counts']['100'].value == 1
+    shard_ref, shard_data = writes[1]
+    assert shard_ref.id.startswith("shard-")
+    assert shard_data['top']['100']['1']['delta'].value == 1
+
+    # Others only get their totals counted
+    assert len(globalboard.global_board_writes(2, "b", 100)) == 1
+
+def test_contenders_read_failure_still_counts(monkeypatch):
+    def fail(key, percent):
+        raise RuntimeError("unavailable")
+    monkeypatch.setattr(globalboard, "_is_contender", fail)
+    assert len(globalboard.global_board_writes(1, "a", 0)) == 1
+
+def test_board_adds_shard_rolls_to_base(monkeypatch):
+    monkeypatch.setattr(globalboard, "board", FakeBoard([
+        doc("base", {'top': {'100': {'1': {'count': 5, 'name': "a"}, '2': {'count': 7, 'name': "b"}}}}),
+        doc("shard-0", {'top': {'100': {'1': {'delta': 2}, '3': {'delta': 9}}}}),
+        doc("shard-1", {'top': {'100': {'1': {'delta': 1}}, '0': {'2': {'delta': 4}}}}),
+    ]))
+    top, shards = globalboard._read_board()
+    assert top[100] == {'1': (8, "a"), '2': (7, "b")}
+    # Users not on the base are ignored until the next reconciliation
+    assert 0 not in top or not top[0]
+    assert [shard.id for shard in shards] == ["shard-0", "shard-1"]
+
+    text = globalboard.get_global_board()
+    assert text.index("@a x8") < text.index("@b x7")
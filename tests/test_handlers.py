@@ -0,0 +1,142 @@
+## Tests of the /mystats handlers in bot/handlers.py, with the renders and the outbox replaced
+import asyncio
+import time
+from types import SimpleNamespace
+import pytest
+import bot.handlers as handlers
+from utils.admission import BUSY_MESSAGE
+
+VIEWS = {'histogram': [0] * 50 + [3] + [0] * 50, 'nice': "💯 x1"}
+
+def run(coro):
+    return asyncio.run(coro)
+
+class Query:
+    def __init__(self, data, user_id=7, chat_id=1):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = SimpleNamespace(chat=SimpleNamespace(id=chat_id))
+        self.answers = []
+
+    async def answer(self, text=None):
+        self.answers.append(text)
+
+@pytest.fixture
+def edits(monkeypatch):
+    edits = []
+    monkeypatch.setattr(handlers.outbox, "edit_message_text", lambda query, text, **kwargs: edits.append(text))
+    return edits
+
+def make_update(query):
+    return SimpleNamespace(callback_query=query)
+
+def make_context():
+    return SimpleNamespace(user_data={})
+
+def prefetched(context, coro):
+    task = asyncio.ensure_future(coro)
+    context.user_data[handlers.PREFETCH_KEY] = {"1": (task, time.monotonic() + 60)}
+    return task
+
+def fetches(monkeypatch, *results):
+    """Replaces fetch_user_stats_views by one returning (or raising) each result in turn."""
+    results = list(results)
+    calls = []
+
+    async def fetch(chat_id, user_id):
+        calls.append((chat_id, user_id))
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    monkeypatch.setattr(handlers, "fetch_user_stats_views", fetch)
+    return calls
+
+async def failing():
+    raise RuntimeError("store unavailable")
+
+async def value(result):
+    return result
+
+def test_prefetch_is_used(monkeypatch, edits):
+    async def main():
+        calls = fetches(monkeypatch)
+        context = make_context()
+        prefetched(context, value((VIEWS, False)))
+        await handlers.handle_stats_mode(make_update(Query("nice")), context)
+        assert edits == ["💯 x1"] and calls == []
+    run(main())
+
+def test_failed_prefetch_falls_back_to_fetch(monkeypatch, edits):
+    async def main():
+        calls = fetches(monkeypatch, (VIEWS, False))
+        context = make_context()
+        prefetched(context, failing())
+        await handlers.handle_stats_mode(make_update(Query("nice")), context)
+        assert edits == ["💯 x1"] and calls == [("1", 7)]
+    run(main())
+
+def test_busy_only_if_fetch_is_shed_too(monkeypatch, edits):
+    async def main():
+        calls = fetches(monkeypatch, (None, False))
+        context = make_context()
+        prefetched(context, value((None, False)))
+        await handlers.handle_stats_mode(make_update(Query("all")), context)
+        assert edits == [BUSY_MESSAGE] and len(calls) == 1
+    run(main())
+
+def test_fetch_error_is_reported(monkeypatch, edits):
+    async def main():
+        fetches(monkeypatch, RuntimeError("store unavailable"))
+        context = make_context()
+        prefetched(context, failing())
+        await handlers.handle_stats_mode(make_update(Query("all")), context)
+        assert edits == [handlers.STATS_ERROR_MESSAGE]
+    run(main())
+
+@pytest.mark.parametrize("data, expected", [
+    ("allpage:7:2:count", (7, 2, "count")),
+    ("allpage:7:-3:percent", (7, 0, "percent")),
+    ("allpage:7:99999999999999:percent", (7, 100, "percent")),
+    ("allpage:7:x:percent", None),
+    ("allpage:7:1", None),
+    ("allpage:7:1:sideways", None),
+    ("allpage:a:1:count", None),
+])
+def test_parse_stats_page(data, expected):
+    assert handlers.parse_stats_page(data) == expected
+
+def test_format_user_stats_page():
+    counts = [0] * 101
+    for percent in range(0, 101, 4):
+        counts[percent] = percent + 1
+    text, page, pages = handlers.format_user_stats_page(counts, 0, "percent", 10)
+    assert (page, pages) == (0, 3)
+    assert text.splitlines()[0] == "0% Gay: 1 times"
+    text, page, _ = handlers.format_user_stats_page(counts, 50, "count", 10)
+    assert page == 2
+    assert text.splitlines()[0] == "20% Gay: 21 times"
+    assert len(text.splitlines()) == 6
+
+def test_bad_page_data_is_answered(edits):
+    query = Query("allpage:7:oops:percent")
+    run(handlers.handle_stats_page(make_update(query), make_context()))
+    assert query.answers == ["This button is no longer valid, use /mystats."]
+    assert edits == []
+
+@pytest.mark.parametrize("result, message", [
+    ((None, False), BUSY_MESSAGE),
+    (RuntimeError("store unavailable"), handlers.STATS_ERROR_MESSAGE),
+    (({'histogram': None, 'nice': ""}, False), "No stats yet! Start using @HowGayBot to log your gayness."),
+])
+def test_expired_page_fetch(monkeypatch, edits, result, message):
+    fetches(monkeypatch, result)
+    run(handlers.handle_stats_page(make_update(Query("allpage:7:1:count")), make_context()))
+    assert edits == [message]
+
+def test_expired_page_is_rendered(monkeypatch, edits):
+    fetches(monkeypatch, (VIEWS, False))
+    context = make_context()
+    run(handlers.handle_stats_page(make_update(Query("allpage:7:5:count")), context))
+    assert edits == ["50% Gay: 3 times\n\nPage 1/1"]
+    assert "1" in context.user_data[handlers.HISTOGRAM_KEY]
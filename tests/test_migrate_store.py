@@ -0,0 +1,65 @@
+## Tests of utils/migrate_store.py conversions between the SQLite and Firestore formats
+import importlib
+import sqlite3
+import pytest
+import utils.migrate_store as migrate
+from utils.migrate_store import (iso_to_unix, unix_to_iso, parse_id, synthetic_message_id, load_checkpoint,
+                                 save_checkpoint, write_sqlite_messages)
+
+def test_timestamps():
+    assert unix_to_iso(1700000000) == "2023-11-14T22:13:20"
+    assert iso_to_unix("2023-11-14T22:13:20") == 1700000000
+    # Explicit offsets are honoured, naive values are UTC
+    assert iso_to_unix("2023-11-15T06:13:20+08:00") == 1700000000
+    for timestamp in (0, 1, 1700000000, 2**31 - 1):
+        assert iso_to_unix(unix_to_iso(timestamp)) == timestamp
+
+def test_ids():
+    assert parse_id("123") == 123
+    assert parse_id("-100123") == -100123
+    assert parse_id("unknown") == "unknown"
+    assert parse_id("12a") == "12a"
+
+def test_synthetic_message_ids():
+    first = synthetic_message_id(5, 1700000000)
+    assert first < 0
+    assert first == synthetic_message_id("5", 1700000000)
+    assert first != synthetic_message_id(6, 1700000000)
+    assert first != synthetic_message_id(5, 1700000001)
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    assert load_checkpoint(path, migrate.DIRECTIONS[0]) == {}
+    save_checkpoint(path, {'direction': migrate.DIRECTIONS[0], 'rowid': 42})
+    assert load_checkpoint(path, migrate.DIRECTIONS[0]) == {'direction': migrate.DIRECTIONS[0], 'rowid': 42}
+    assert load_checkpoint(path, migrate.DIRECTIONS[0], restart=True) == {}
+    with pytest.raises(SystemExit):
+        load_checkpoint(path, migrate.DIRECTIONS[1])
+
+def test_read_ahead_batches_and_errors():
+    assert list(migrate._read_ahead(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+
+    def failing():
+        yield 1
+        raise RuntimeError("read failed")
+    with pytest.raises(RuntimeError):
+        list(migrate._read_ahead(failing(), 10))
+
+def test_write_sqlite_messages(tmp_path, monkeypatch):
+    # utils.storage opens gayness.db in the working directory at import
+    monkeypatch.chdir(tmp_path)
+    storage = importlib.import_module("utils.storage")
+    conn = sqlite3.connect(":memory:")
+    storage.init_schema(conn)
+    rows = [{'chat_id': -100, 'user_id': 5, 'percentage': 69, 'timestamp': 1700000000},
+            {'chat_id': -100, 'user_id': 6, 'percentage': 100, 'timestamp': 1700003600},
+            {'chat_id': 7, 'user_id': 5, 'percentage': 0, 'timestamp': 1600000000}]
+    write_sqlite_messages(conn, rows)
+    write_sqlite_messages(conn, rows[:1])  # Repeated batch of a resumed run
+    assert conn.execute("SELECT chat_id, user_id, percentage, timestamp FROM stats ORDER BY timestamp").fetchall() == [
+        ("7", "5", 0, unix_to_iso(1600000000)),
+        ("-100", "5", 69, "2023-11-14T22:13:20"),
+        ("-100", "6", 100, "2023-11-14T23:13:20"),
+    ]
+    assert dict(conn.execute("SELECT chat_id, last_timestamp FROM last_update")) == {
+        "-100": "2023-11-14T23:13:20", "7": unix_to_iso(1600000000)}
@@ -0,0 +1,71 @@
+## Tests of utils/outbox.py: pacing lanes, coalescing of edits and flood-wait retries
+import asyncio
+from datetime import timedelta
+from types import SimpleNamespace
+import pytest
+from telegram.error import RetryAfter
+import utils.outbox as outbox_module
+from utils.outbox import Outbox
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture
+def lanes(monkeypatch):
+    monkeypatch.setattr(outbox_module, "LANES", {'send': (2, 1), 'edit': (100, 5)})
+
+def recorder(sent, label, delay=0):
+    async def send():
+        if delay:
+            await asyncio.sleep(delay)
+        sent.append(label)
+    return send
+
+def query(sent, message_id=10, chat_id=1):
+    message = SimpleNamespace(chat_id=chat_id, message_id=message_id)
+
+    async def edit_message_text(text, **kwargs):
+        sent.append(text)
+    return SimpleNamespace(message=message, edit_message_text=edit_message_text)
+
+def test_edits_do_not_wait_behind_sends(lanes):
+    async def main():
+        outbox, sent = Outbox(), []
+        for i in range(3):
+            outbox.send(1, recorder(sent, f"send{i}"))
+        outbox.edit_message_text(query(sent), "page 2")
+        await asyncio.sleep(0.1)
+        # One send went out (burst 1), the edit did not queue behind the other two
+        assert sent == ["send0", "page 2"]
+        await outbox.flush(timeout=5)
+        assert sent == ["send0", "page 2", "send1", "send2"]
+    run(main())
+
+def test_unsent_edits_are_coalesced(lanes):
+    async def main():
+        outbox, sent = Outbox(), []
+        q = query(sent)
+        # The first edit is being sent when the others arrive: they become one job
+        outbox.send(1, recorder(sent, "slow", delay=0.05), coalesce_key=("edit", 10), lane='edit')
+        await asyncio.sleep(0.01)
+        for page in range(5):
+            outbox.edit_message_text(q, f"page {page}")
+        await outbox.flush(timeout=5)
+        assert sent == ["slow", "page 4"]
+    run(main())
+
+def test_flood_wait_is_retried(lanes):
+    async def main():
+        outbox, sent, attempts = Outbox(), [], []
+
+        async def send():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RetryAfter(timedelta(seconds=0.05))
+            sent.append("ok")
+
+        outbox.send(1, send)
+        await outbox.flush(timeout=5)
+        assert sent == ["ok"] and len(attempts) == 2
+        assert not outbox._chats
+    run(main())
@@ -0,0 +1,61 @@
+## Tests of utils/profiling.py: profiling windows, wrapped handler timings and the written reports
+import asyncio
+import os
+import pytest
+import utils.profiling as profiling
+from utils.profiling import profiled, start_profiling, stop_profiling, is_profiling
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "_session", None)
+    return tmp_path
+
+async def handle_roll(update, context):
+    await asyncio.sleep(0.01)
+    return sum(range(10000))
+
+def test_handler_unchanged_without_window(profile_dir):
+    wrapped = profiled(handle_roll)
+    assert wrapped.__name__ == "handle_roll"
+    assert run(wrapped(None, None)) == sum(range(10000))
+    assert not is_profiling()
+
+@pytest.mark.parametrize("mode, suffix", [("cprofile", ".prof"), ("sample", ".folded")])
+def test_window_writes_reports(profile_dir, mode, suffix):
+    wrapped = profiled(handle_roll, trace_memory=True)
+
+    async def main():
+        reported = []
+
+        async def on_report(paths):
+            reported.extend(paths)
+        assert start_profiling(60, mode, on_report)
+        assert not start_profiling(60, mode)  # One window at a time
+        for _ in range(3):
+            await wrapped(None, None)
+        paths = await stop_profiling()
+        assert reported == paths
+        assert not is_profiling()
+        assert await stop_profiling() == []
+        return paths
+
+    paths = run(main())
+    assert [os.path.splitext(path)[1] for path in paths] == [".txt", suffix]
+    assert all(os.path.dirname(path) == str(profile_dir) for path in paths)
+    with open(paths[0], encoding="utf-8") as f:
+        report = f.read()
+    handler_line = next(line for line in report.splitlines() if line.startswith("handle_roll"))
+    assert handler_line.split()[1] == "3"
+    assert report.count("tracemalloc around handle_roll") == 3
+
+def test_window_closes_itself(profile_dir):
+    async def main():
+        assert start_profiling(0.05, "sample")
+        await asyncio.sleep(0.3)
+        assert not is_profiling()
+    run(main())
+    assert any(path.suffix == ".folded" for path in profile_dir.iterdir())
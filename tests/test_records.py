@@ -0,0 +1,117 @@
+## Tests of utils/records.py and the chat store's record rebuilds: running aggregates fed in time
+## order must match a from-scratch computation, and survive the Firestore encoding
+import random
+import pytest
+from utils.records import UserRecords, records_of, day_number, STREAK_PERCENTAGES
+from utils.chat_store import ChatStore
+
+DAY = 86400
+
+def reference(rolls):
+    """Records computed the slow way: sets of days and timestamps."""
+    nice_days = sorted({day_number(ts) for percent, ts in rolls if percent in STREAK_PERCENTAGES})
+    best_streak, best_streak_end, run = 0, 0, 0
+    for i, day in enumerate(nice_days):
+        run = run + 1 if i and day == nice_days[i - 1] + 1 else 1
+        if (run, day) > (best_streak, best_streak_end):
+            best_streak, best_streak_end = run, day
+    per_day = {}
+    for percent, ts in rolls:
+        if percent == 100:
+            per_day[day_number(ts)] = per_day.get(day_number(ts), 0) + 1
+    best_hundreds, best_hundreds_day = max(((count, day) for day, count in per_day.items()), default=(0, 0))
+    zeros = [ts for percent, ts in rolls if percent == 0]
+    return (best_streak, best_streak_end, best_hundreds, best_hundreds_day,
+            min(zeros, default=0), max(zeros, default=0))
+
+def summary(records: UserRecords):
+    return (records.best_streak, records.best_streak_end, records.best_hundreds, records.best_hundreds_day,
+            records.first_zero, records.last_zero)
+
+def make_rolls(rng: random.Random, n: int, days: int):
+    return [(rng.choice([100, 88, 69, 0, 50, 12]), rng.randint(1, days) * DAY + rng.randint(0, DAY - 1)) for _ in range(n)]
+
+def test_streak_counts_consecutive_days():
+    rolls = [(100, 10 * DAY), (88, 11 * DAY + 5), (69, 11 * DAY + 9), (0, 12 * DAY), (50, 13 * DAY), (100, 14 * DAY)]
+    records = records_of(rolls)
+    assert (records.best_streak, records.best_streak_end) == (3, 12)
+    assert (records.streak, records.streak_end) == (1, 14)
+
+def test_most_hundreds_in_a_day():
+    rolls = [(100, 5 * DAY), (100, 5 * DAY + 1), (100, 6 * DAY), (100, 7 * DAY), (100, 7 * DAY + 2), (100, 7 * DAY + 3)]
+    records = records_of(rolls)
+    assert (records.best_hundreds, records.best_hundreds_day) == (3, 7)
+    assert (records.hundreds, records.hundreds_day) == (3, 7)
+
+def test_zeros():
+    records = records_of([(0, 500), (0, 100), (1, 50), (0, 300)])
+    assert (records.first_zero, records.last_zero) == (100, 500)
+
+def test_older_roll_is_refused():
+    records = records_of([(100, 10 * DAY)])
+    before = summary(records)
+    assert not records.add(88, 9 * DAY)
+    assert summary(records) == before
+    # Same day and non-record rolls are fine
+    assert records.add(100, 10 * DAY + 5)
+    assert records.add(50, DAY)
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_reference(seed):
+    rng = random.Random(seed)
+    rolls = make_rolls(rng, rng.randint(0, 300), rng.choice([3, 30, 400]))
+    assert summary(records_of(rolls)) == reference(rolls)
+
+@pytest.mark.parametrize("seed", range(20))
+def test_doc_round_trip_and_merge(seed):
+    rng = random.Random(seed)
+    rolls = sorted(make_rolls(rng, 200, 60), key=lambda roll: roll[1])
+    # Records stored after part of the rolls, then updated one roll at a time
+    k = rng.randint(0, len(rolls))
+    records = UserRecords.from_doc(records_of(rolls[:k]).to_doc())
+    keys = [records.to_doc()]
+    for percent, ts in rolls[k:]:
+        assert records.add(percent, ts)
+        keys.append(records.to_doc())
+    assert summary(records) == reference(rolls)
+    # The packed keys only grow, so Maximum transforms merge them in any order
+    for field in ('streak_key', 'best_streak_key', 'hundreds_key', 'best_hundreds_key', 'last_zero'):
+        values = [doc[field] for doc in keys if field in doc]
+        assert values == sorted(values)
+
+def test_store_rebuilds_out_of_order_rows():
+    rng = random.Random(7)
+    rolls = make_rolls(rng, 500, 40)
+    store = ChatStore("1")
+    for percent, ts in rolls:
+        store.append(42, percent, ts)
+    store.append(43, 100, DAY)
+    assert 0 in store.stale_records
+    assert summary(store.get_records(42)) == reference(rolls)
+    assert not store.stale_records
+    assert store.get_records(44) is None
+
+def test_stored_records_rebuilt_when_offset_changes(monkeypatch):
+    import bot.ingest as ingest
+    rolls = [(100, 10 * DAY), (88, 11 * DAY), (100, 11 * DAY + 1)]
+    monkeypatch.setattr(ingest, "store_get_user_rolls", lambda chat_id, user_id: list(rolls))
+    stored = records_of(rolls).to_doc()
+
+    # Same offset: updated in place, merged with transforms
+    doc = {'last_update': 11 * DAY + 1, 'records': dict(stored, utc_offset=ingest.RECORDS_UTC_OFFSET_HOURS)}
+    records, exact = ingest._next_records(1, 2, doc, 100, 12 * DAY)
+    assert not exact and records.best_streak == 3
+
+    # Other offset, invalidated by a backfill, or an older roll: rebuilt from the chat's messages
+    for doc, percent, ts in (
+        ({'last_update': 1, 'records': dict(stored, utc_offset=ingest.RECORDS_UTC_OFFSET_HOURS + 8)}, 100, 12 * DAY),
+        ({'last_update': 1, 'records': stored}, 100, 12 * DAY),
+        ({'last_update': 1, 'records': dict(stored, utc_offset=ingest.RECORDS_UTC_OFFSET_HOURS)}, 0, 9 * DAY),
+    ):
+        records, exact = ingest._next_records(1, 2, doc, percent, ts)
+        assert exact
+        assert summary(records) == reference(rolls + [(percent, ts)])
+
+    # A new user's records are complete
+    records, exact = ingest._next_records(1, 2, {}, 100, DAY)
+    assert exact and records.best_hundreds == 1
@@ -0,0 +1,90 @@
+## Tests of the chat document, shard count and watermark caching in utils/firestore.py
+## (the "chats" collection is replaced by in-memory documents)
+from types import SimpleNamespace
+import pytest
+from google.api_core.exceptions import AlreadyExists
+import utils.firestore as fs
+
+class Doc:
+    def __init__(self, docs, key):
+        self.docs, self.key = docs, key
+
+    def get(self):
+        self.docs.reads += 1
+        data = self.docs.data.get(self.key)
+        return SimpleNamespace(exists=data is not None, to_dict=lambda: dict(data))
+
+    def create(self, data):
+        if self.docs.racer is not None:
+            # Another instance created it between our read and our create
+            self.docs.data[self.key], self.docs.racer = self.docs.racer, None
+        if self.key in self.docs.data:
+            raise AlreadyExists("exists")
+        self.docs.data[self.key] = dict(data)
+
+    def update(self, data):
+        self.docs.data[self.key].update(data)
+
+class Chats:
+    def __init__(self):
+        self.data, self.reads, self.racer = {}, 0, None
+
+    def document(self, key):
+        return Doc(self, key)
+
+@pytest.fixture
+def chats(monkeypatch):
+    chats = Chats()
+    monkeypatch.setattr(fs, "chats", chats)
+    monkeypatch.setattr(fs, "_chat_shards", {})
+    monkeypatch.setattr(fs, "_watermarks", {})
+    return chats
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(fs.time, "monotonic", lambda: clock.now)
+    return clock
+
+def test_chat_created_once_and_cached(chats, clock):
+    assert fs.get_chat_shard_count(5) == fs.DEFAULT_CHAT_SHARDS
+    assert chats.data["5"] == {'chat_id': 5, 'shard_count': fs.DEFAULT_CHAT_SHARDS}
+    reads = chats.reads
+    assert fs.get_chat_shard_count(5) == fs.DEFAULT_CHAT_SHARDS
+    assert chats.reads == reads
+
+def test_concurrent_creator_keeps_its_settings(chats, clock):
+    chats.racer = {'chat_id': 5, 'shard_count': 16}
+    assert fs.get_chat_shard_count(5) == 16
+    assert chats.data["5"]['shard_count'] == 16
+
+def test_remote_shard_change_seen_after_ttl(chats, clock):
+    chats.data["5"] = {'chat_id': 5, 'shard_count': 4}
+    assert fs.get_chat_shard_count(5) == 4
+    chats.data["5"]['shard_count'] = 32  # /shards on another instance
+    assert fs.get_chat_shard_count(5) == 4
+    clock.now += fs.CHAT_CACHE_TTL_SECONDS + 1
+    assert fs.get_chat_shard_count(5) == 32
+
+def test_cached_watermark(monkeypatch, chats, clock):
+    reads = []
+    monkeypatch.setattr(fs, "_read_last_update", lambda chat_id: reads.append(chat_id) or 100)
+    assert fs.get_cached_last_update(5) == 100
+    # Own writes raise it without a read
+    fs._raise_watermark("5", 150)
+    fs._raise_watermark("5", 120)
+    assert fs.get_cached_last_update(5) == 150
+    assert reads == [5]
+    clock.now += fs.CHAT_CACHE_TTL_SECONDS + 1
+    assert fs.get_cached_last_update(5) == 100
+    fs.forget_chat(5)
+    assert fs.get_cached_last_update(5) == 100
+    assert reads == [5, 5, 5]
+
+def test_watermark_read_failure_is_not_cached(monkeypatch, chats, clock):
+    def fail(chat_id):
+        raise RuntimeError("unavailable")
+    monkeypatch.setattr(fs, "_read_last_update", fail)
+    with pytest.raises(RuntimeError):
+        fs.get_cached_last_update(5)
+    assert "5" not in fs._watermarks
@@ -0,0 +1,154 @@
+## Tests of utils/singleflight.py: coalescing, TTL, invalidation and cancellation of shared computations
+import asyncio
+import pytest
+import utils.singleflight as singleflight
+from utils.singleflight import SingleFlight
+
+def run(coro):
+    return asyncio.run(coro)
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(singleflight.time, "monotonic", clock.monotonic)
+    return clock
+
+def test_concurrent_callers_share_one_computation():
+    async def main():
+        cache, calls = SingleFlight(ttl=30), []
+        release = asyncio.Event()
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return "text"
+
+        callers = [asyncio.create_task(cache.run(("leaderboard", "1"), compute)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert cache.is_ready(("leaderboard", "1"))
+        release.set()
+        assert await asyncio.gather(*callers) == ["text"] * 5
+        assert len(calls) == 1
+    run(main())
+
+def test_ttl(clock):
+    async def main():
+        cache, calls = SingleFlight(ttl=30), []
+
+        async def compute():
+            calls.append(1)
+            return len(calls)
+
+        assert await cache.run(("k", "1"), compute) == 1
+        clock.now += 29
+        assert await cache.run(("k", "1"), compute) == 1
+        clock.now += 2
+        assert not cache.is_ready(("k", "1"))
+        assert await cache.run(("k", "1"), compute) == 2
+    run(main())
+
+def test_invalidation_drops_cache_but_keeps_stale():
+    async def main():
+        cache = SingleFlight(ttl=30)
+
+        async def compute():
+            return "old"
+
+        await cache.run(("k", "1"), compute)
+        await cache.run(("k", "2"), compute)
+        cache.invalidate("1")
+        assert not cache.is_ready(("k", "1"))
+        assert cache.is_ready(("k", "2"))
+        assert cache.peek_stale(("k", "1")) == "old"
+        cache.invalidate("1", keep_stale=False)
+        assert cache.peek_stale(("k", "1")) is None
+    run(main())
+
+def test_result_computed_across_invalidation_is_not_cached():
+    async def main():
+        cache = SingleFlight(ttl=30)
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def compute():
+            started.set()
+            await release.wait()
+            return "outdated"
+
+        caller = asyncio.create_task(cache.run(("k", "1"), compute))
+        await started.wait()
+        cache.invalidate("1")
+        release.set()
+        assert await caller == "outdated"
+        assert not cache.is_ready(("k", "1"))
+        assert cache.peek_stale(("k", "1")) == "outdated"
+        # No generation is kept for chats with nothing in flight
+        assert cache._generation == {}
+        cache.invalidate("2")
+        assert cache._generation == {}
+    run(main())
+
+def test_cancelled_owner_does_not_fail_waiters():
+    async def main():
+        cache = SingleFlight(ttl=30)
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return "text"
+
+        owner = asyncio.create_task(cache.run(("k", "1"), compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.run(("k", "1"), compute))
+        await asyncio.sleep(0)
+        owner.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await waiter == "text"
+        assert owner.cancelled()
+    run(main())
+
+def test_last_caller_leaving_cancels_computation():
+    async def main():
+        cache = SingleFlight(ttl=30)
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        async def compute():
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.create_task(cache.run(("k", "1"), compute)) for _ in range(2)]
+        await started.wait()
+        for caller in callers:
+            caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        assert not cache.is_ready(("k", "1"))
+        assert cache._waiters == {} and cache._generation == {}
+    run(main())
+
+def test_errors_reach_every_caller_and_are_not_cached():
+    async def main():
+        cache, calls = SingleFlight(ttl=30), []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(*(cache.run(("k", "1"), compute) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        with pytest.raises(ValueError):
+            await cache.run(("k", "1"), compute)
+        assert len(calls) == 2
+    run(main())
@@ -0,0 +1,63 @@
+## Tests of utils/snapshot.py: a packed and reloaded chat store must hold the same rows, users and records
+import random
+from collections import OrderedDict
+import pytest
+import utils.chat_store as chat_store
+from utils.chat_store import ChatStore
+from utils.snapshot import pack_snapshot, write_snapshot, load_snapshot, HEADER, SNAPSHOT_MAGIC
+
+@pytest.fixture
+def stores(monkeypatch):
+    stores = OrderedDict()
+    monkeypatch.setattr(chat_store, "_stores", stores)
+    return stores
+
+def make_store(chat_id: str, seed: int):
+    rng = random.Random(seed)
+    store = ChatStore(chat_id)
+    users = [1, 2, 10**12, -7, "unknown", "ünïcode"]
+    for _ in range(rng.randint(0, 500)):
+        store.append(rng.choice(users), rng.randint(0, 100), rng.randint(1, 10**9))
+    for user_id in store.user_ids:
+        store.set_user_info(user_id, f"user{user_id}", f"Näme {user_id}", rng.randint(0, 10**9))
+    store.generation = seed
+    return store
+
+def state(store: ChatStore):
+    users = []
+    for user_id, user in zip(store.user_ids, store.users):
+        records = store.get_records(user_id)
+        users.append((user_id, user.username, user.name, user.last_update, user.counts.tolist(), user.last_seen.tolist(),
+                      records.best_streak, records.best_streak_end, records.best_hundreds, records.first_zero))
+    return (store.chat_id, store.percentages.tolist(), store.timestamps.tolist(), store.user_index.tolist(),
+            users, store.watermark, store.generation)
+
+def test_round_trip(tmp_path, stores):
+    originals = [make_store(str(chat_id), seed) for seed, chat_id in enumerate([1, -100123, 42, 7])]
+    expected = [state(store) for store in originals]
+    path = str(tmp_path / "snapshot.bin")
+    write_snapshot(path, pack_snapshot(originals))
+
+    assert load_snapshot(path) == 4
+    assert [state(stores[store.chat_id]) for store in originals] == expected
+    # Loaded chats check Firestore for newer messages on first query
+    assert all(store.reconcile_from == store.watermark for store in stores.values())
+
+def test_loaded_store_keeps_growing(tmp_path, stores):
+    path = str(tmp_path / "snapshot.bin")
+    write_snapshot(path, pack_snapshot([make_store("1", 3)]))
+    load_snapshot(path)
+    store = stores["1"]
+    rows = len(store)
+    store.append(99, 100, 2 * 10**9)
+    assert len(store) == rows + 1
+    assert store.get_user(99).counts[100] == 1
+
+def test_missing_or_foreign_file(tmp_path, stores):
+    assert load_snapshot(str(tmp_path / "missing.bin")) == 0
+    path = tmp_path / "other.bin"
+    path.write_bytes(HEADER.pack(b"NOPE", 1, 0, 3, 0))
+    assert load_snapshot(str(path)) == 0
+    path.write_bytes(HEADER.pack(SNAPSHOT_MAGIC, 99, 0, 3, 0))
+    assert load_snapshot(str(path)) == 0
+    assert not stores
@@ -0,0 +1,86 @@
+## Tests of utils/spool.py: durable queue semantics and the replayer's ordering and retries
+import asyncio
+import threading
+import pytest
+from utils.spool import Spool, Replayer, CircuitBreaker
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = Spool(str(tmp_path / "spool.db"))
+    yield spool
+    spool.close()
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def drain(replayer: Replayer, spool: Spool, timeout: float = 5):
+    replayer.start()
+    try:
+        for _ in range(int(timeout / 0.01)):
+            if not len(spool):
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError("spool not drained")
+    finally:
+        await replayer.stop()
+
+def test_spool_peek_ack_dead_letter(spool):
+    for i in range(3):
+        spool.append({'n': i})
+    entries = spool.peek()
+    assert [entry for _, entry in entries] == [{'n': 0}, {'n': 1}, {'n': 2}]
+    spool.ack(entries[0][0])
+    spool.dead_letter(entries[1][0], "bad")
+    assert [entry for _, entry in spool.peek()] == [{'n': 2}]
+    assert spool.conn.execute("SELECT error FROM dead_letter").fetchall() == [("bad",)]
+
+def test_chats_stay_in_order_and_run_concurrently(spool):
+    for i in range(20):
+        spool.append({'chat_id': i % 4, 'n': i})
+    applied, lock, active, peak = [], threading.Lock(), [0], [0]
+
+    def apply(entry):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        threading.Event().wait(0.005)
+        with lock:
+            active[0] -= 1
+            applied.append(entry)
+
+    replayer = Replayer(spool, apply, key=lambda entry: entry['chat_id'], concurrency=4)
+    run(drain(replayer, spool))
+    for chat_id in range(4):
+        assert [entry['n'] for entry in applied if entry['chat_id'] == chat_id] == list(range(chat_id, 20, 4))
+    assert peak[0] > 1
+
+def test_failure_holds_back_its_chat_only(spool):
+    for i in range(6):
+        spool.append({'chat_id': i % 2, 'n': i})
+    applied, failures = [], [2]
+
+    def apply(entry):
+        if entry['n'] == 2 and failures[0]:
+            failures[0] -= 1
+            raise RuntimeError("backend unavailable")
+        applied.append(entry['n'])
+
+    replayer = Replayer(spool, apply, key=lambda entry: entry['chat_id'], concurrency=2,
+                        backoff_base=0.01, breaker=CircuitBreaker(threshold=100))
+    run(drain(replayer, spool))
+    assert sorted(applied) == list(range(6))
+    # Chat 0 resumed at the failed entry; chat 1 went on meanwhile
+    assert [n for n in applied if n % 2 == 0] == [0, 2, 4]
+    assert applied.index(5) < applied.index(2)
+
+def test_malformed_entries_are_dead_lettered(spool):
+    spool.append({'chat_id': 1})
+    spool.append({'chat_id': 1, 'n': 1})
+    applied = []
+
+    def apply(entry):
+        applied.append(entry['n'])
+
+    run(drain(Replayer(spool, apply, key=lambda entry: entry.get('chat_id')), spool))
+    assert applied == [1]
+    assert spool.conn.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0] == 1
@@ -0,0 +1,40 @@
+## Tests of utils/storage.py bulk writes: timestamps are stored as naive UTC whatever the local time zone
+import importlib
+import sqlite3
+import time
+import pytest
+from utils.migrate_store import iso_to_unix, unix_to_iso
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    # The module opens gayness.db in the working directory at import
+    monkeypatch.chdir(tmp_path)
+    storage = importlib.import_module("utils.storage")
+    conn = sqlite3.connect(":memory:")
+    storage.init_schema(conn)
+    monkeypatch.setattr(storage, "conn", conn)
+    monkeypatch.setattr(storage, "cur", conn.cursor())
+    return storage
+
+@pytest.fixture
+def local_time_zone(monkeypatch):
+    monkeypatch.setenv("TZ", "Asia/Singapore")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+def test_bulk_timestamps_are_utc(storage, local_time_zone):
+    messages = [{'user_id': 1, 'percentage': 69, 'timestamp': ts} for ts in (0, 1700000000, 1700003600)]
+    storage.bulk_log_stat("5", messages, [{'user_id': 1, 'username': "a", 'name': "A"}])
+
+    stored = [row[0] for row in storage.conn.execute("SELECT timestamp FROM stats ORDER BY timestamp")]
+    assert stored == ["1970-01-01T00:00:00", "2023-11-14T22:13:20", "2023-11-14T23:13:20"]
+    assert stored == [unix_to_iso(message['timestamp']) for message in messages]
+    assert [iso_to_unix(value) for value in stored] == [message['timestamp'] for message in messages]
+
+def test_bulk_duplicates_are_skipped(storage):
+    messages = [{'user_id': 1, 'percentage': 69, 'timestamp': 1700000000}] * 2
+    storage.bulk_log_stat("5", messages, [])
+    storage.bulk_log_stat("5", messages, [])
+    assert storage.conn.execute("SELECT COUNT(*) FROM stats").fetchone()[0] == 1
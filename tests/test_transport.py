@@ -0,0 +1,33 @@
+## Tests of utils/transport.py against the benchmark's local mock Bot API server
+import asyncio
+import pytest
+from telegram.ext import ApplicationBuilder
+import utils.transport as transport
+from utils.transport import build_request, build_get_updates_request, configure_transport
+from utils.benchmark_transport import start_mock_server, run_profile
+
+def test_request_settings():
+    request = build_request(7, "1.1")
+    assert request._client_kwargs['limits'].max_connections == 7
+    assert request.read_timeout == transport.TELEGRAM_READ_TIMEOUT
+    assert build_get_updates_request()._client_kwargs['limits'].max_connections == 1
+
+def test_configure_transport(monkeypatch):
+    monkeypatch.setattr(transport, "TELEGRAM_BASE_URL", "http://127.0.0.1:1/bot")
+    app = configure_transport(ApplicationBuilder().token("1:mock")).build()
+    get_updates_request, request = app.bot._request
+    assert get_updates_request._client_kwargs['limits'].max_connections == 1
+    assert request._client_kwargs['limits'].max_connections == transport.TELEGRAM_POOL_SIZE
+    assert app.bot.base_url == "http://127.0.0.1:1/bot1:mock"
+
+@pytest.fixture
+def mock_server():
+    server, base_url = start_mock_server(0.05)
+    yield base_url
+    server.shutdown()
+
+def test_concurrent_sends_share_the_pool(mock_server):
+    rate, failures = asyncio.run(run_profile(mock_server, 8, "1.1", messages=40, concurrency=20))
+    assert failures == 0
+    # 50 ms per request: one connection at a time could not exceed 20 sends/s
+    assert rate > 40
@@ -0,0 +1,187 @@
+## Module that bounds how many expensive commands run at once, so they cannot starve ingestion
+## process_message never goes through here: stats are always spooled right away. /leaderboard,
+## /chatstats, /mystats and backfills each get a per-chat and a global concurrency limit; a request over
+## the limit waits briefly in a bounded queue, then is shed and answered with the last rendered
+## result (even if out of date) or a "busy" reply. Counters are logged and shown by /admission.
+import os
+import asyncio
+import contextlib
+from collections import deque
+from dotenv import load_dotenv
+from utils.singleflight import render_cache
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Seconds an excess request may wait for a slot, and how many may wait per command, before being shed
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "32"))
+BUSY_MESSAGE = "⏳ I'm busy right now, please try again in a bit."
+STALE_NOTE = "\n\n⏳ Busy right now: this may be slightly out of date."
+
+class AdmissionController:
+    """
+    Per-chat and global concurrency limits of one command.
+
+    Parameters:
+        name (str):          The command, for logs.
+        per_chat (int):      Requests of one chat that may run at once.
+        global_limit (int):  Requests of all chats that may run at once.
+        max_queued (int):    Requests that may wait for a slot; more are shed at once.
+        queue_timeout (float): Seconds a request waits for a slot before being shed.
+    """
+
+    def __init__(self, name: str, per_chat: int, global_limit: int,
+                 max_queued: int = ADMISSION_MAX_QUEUED, queue_timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.per_chat = per_chat
+        self.global_limit = global_limit
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.running_by_chat = {}  # chat_id -> running requests
+        self._waiters = deque()    # (chat_id, future), oldest first
+        # Counters since startup
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.served_stale = 0
+
+    def _has_room(self, chat_id: str):
+        return self.running < self.global_limit and self.running_by_chat.get(chat_id, 0) < self.per_chat
+
+    def _take(self, chat_id: str):
+        self.running += 1
+        self.running_by_chat[chat_id] = self.running_by_chat.get(chat_id, 0) + 1
+
+    async def acquire(self, chat_id: str):
+        """
+        Takes a slot for a chat, waiting up to queue_timeout for one.
+
+        Returns:
+            bool: True if admitted (call release afterwards), False if shed.
+        """
+        chat_id = str(chat_id)
+        if self._has_room(chat_id):
+            self._take(chat_id)
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.max_queued or self.queue_timeout <= 0:
+            self.shed += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (chat_id, future)
+        self._waiters.append(entry)
+        self.queued += 1
+        try:
+            # asyncio.wait does not cancel the future on timeout, so a slot granted meanwhile is seen
+            await asyncio.wait((future,), timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if future.done():
+                self.release(chat_id)
+            else:
+                future.cancel()
+                self._waiters.remove(entry)
+            raise
+        if not future.done():
+            future.cancel()
+            self._waiters.remove(entry)
+            self.shed += 1
+            return False
+        self.admitted += 1
+        return True
+
+    def release(self, chat_id: str):
+        """Frees a slot taken by acquire and hands it to the oldest waiter that fits."""
+        chat_id = str(chat_id)
+        self.running -= 1
+        if self.running_by_chat[chat_id] > 1:
+            self.running_by_chat[chat_id] -= 1
+        else:
+            del self.running_by_chat[chat_id]
+
+        # A waiter blocked by its own chat's limit does not hold back other chats
+        for entry in list(self._waiters):
+            if self.running >= self.global_limit:
+                break
+            waiter_chat, future = entry
+            if self._has_room(waiter_chat):
+                self._waiters.remove(entry)
+                self._take(waiter_chat)
+                future.set_result(True)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, chat_id: str):
+        """Async context manager around acquire/release; yields whether the request was admitted."""
+        admitted = await self.acquire(chat_id)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release(chat_id)
+
+    def stats(self):
+        return (f"{self.name}: {self.running} running, {len(self._waiters)} waiting; "
+                f"{self.admitted} admitted, {self.queued} queued, {self.shed} shed, {self.served_stale} served stale")
+
+def _limits(name: str, per_chat: int, global_limit: int):
+    prefix = f"ADMISSION_{name.upper()}"
+    return AdmissionController(
+        name,
+        int(os.getenv(f"{prefix}_PER_CHAT", str(per_chat))),
+        int(os.getenv(f"{prefix}_GLOBAL", str(global_limit))),
+    )
+
+# command -> its limits, e.g. ADMISSION_LEADERBOARD_PER_CHAT=1, ADMISSION_LEADERBOARD_GLOBAL=8
+admission = {
+    'leaderboard': _limits('leaderboard', 1, 8),
+    'chatstats': _limits('chatstats', 1, 8),
+    'mystats': _limits('mystats', 2, 16),
+    'backfill': _limits('backfill', 1, 2),
+}
+
+async def admitted_render(command: str, chat_id: str, key: tuple, compute):
+    """
+    Renders through the shared render cache, within the admission limits of a command.
+
+    A cached or in-flight result is served without taking a slot. A shed request gets the
+    last result rendered for the key, however old, if there is one.
+
+    Parameters:
+        command (str): The admission class, a key of `admission`.
+        chat_id (str): The chat the request is for.
+        key (tuple): The render cache key.
+        compute (callable): Returns an awaitable producing the result (see SingleFlight.run).
+
+    Returns:
+        tuple: (result or None if shed with nothing cached, whether the result is stale)
+    """
+    if render_cache.is_ready(key):
+        return await render_cache.run(key, compute), False
+
+    controller = admission[command]
+    async with controller.admit(chat_id) as admitted:
+        if admitted:
+            return await render_cache.run(key, compute), False
+
+    stale = render_cache.peek_stale(key)
+    if stale is not None:
+        controller.served_stale += 1
+    logger.debug(f"Shed {command} in chat {chat_id} ({'stale answer' if stale is not None else 'busy'}).")
+    return stale, stale is not None
+
+def format_admission_stats():
+    return "\n".join(controller.stats() for controller in admission.values())
+
+_last_logged = None  # (queued, shed) of every command at the last log_admission_stats
+
+def log_admission_stats():
+    """Logs the counters if anything had to wait or was shed since the last call."""
+    global _last_logged
+    totals = tuple((controller.queued, controller.shed) for controller in admission.values())
+    if totals != _last_logged and any(queued or shed for queued, shed in totals):
+        logger.info(f"Admission: {format_admission_stats()}")
+    _last_logged = totals
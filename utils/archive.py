@@ -0,0 +1,126 @@
+## Module that packs old messages into compact archive documents and unpacks them again
+## An archive holds one month of a chat's messages as parallel packed columns (message id,
+## user index, percentage, timestamp) plus the table of user ids the index points into,
+## so a month of rolls costs one document read instead of one read per roll.
+import sys
+from array import array
+from datetime import datetime, timezone
+
+ARCHIVE_VERSION = 1
+# Firestore rejects documents over 1 MiB; leave room for field names and the user table
+ARCHIVE_MAX_BYTES = 900 * 1024
+# message id (q) + user index (I) + percentage (B) + timestamp (I)
+BYTES_PER_MESSAGE = 8 + 4 + 1 + 4
+# Per-user counts of these (the leaderboard percentages) are stored unpacked, for aggregations
+SUMMARY_PERCENTAGES = (100, 88, 69, 0)
+
+def _to_bytes(column: array):
+    # Archives are always little-endian, whatever machine wrote them
+    if sys.byteorder != "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+def _from_bytes(typecode: str, data: bytes):
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column
+
+def month_key(timestamp: int):
+    """Returns the archive month ("YYYY-MM", UTC) a timestamp belongs to."""
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m")
+
+def month_bounds(month: str):
+    """Returns the (start, end) unix timestamps of a "YYYY-MM" month, end exclusive."""
+    start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return int(start.timestamp()), int(end.timestamp())
+
+def archive_cutoff(now: float, after_days: int):
+    """Returns the compaction cutoff: the start of the month `after_days` days before `now`."""
+    return month_bounds(month_key(int(now) - after_days * 86400))[0]
+
+def archive_doc_id(month: str, part: int):
+    return month if part == 0 else f"{month}-p{part}"
+
+def _user_bytes(user_id):
+    return len(str(user_id)) + 16  # Rough Firestore size of one array entry
+
+def pack_archive_parts(month: str, rows: list, first_part: int = 0):
+    """
+    Packs a month of messages into one or more archive documents, each under ARCHIVE_MAX_BYTES.
+
+    Parameters:
+        month (str):      The "YYYY-MM" month all rows belong to.
+        rows (list):      (message_id, user_id, percentage, timestamp) tuples; message ids must be ints.
+        first_part (int): Part number of the first document (months archived before get more parts).
+
+    Returns:
+        list: (document id, document data) tuples.
+    """
+    start, end = month_bounds(month)
+    parts = []
+    rows = sorted(rows, key=lambda row: row[3])
+    i = 0
+    while i < len(rows):
+        message_ids, user_index = array('q'), array('I')
+        percentages, timestamps = array('B'), array('I')
+        user_ids, lookup = [], {}
+        nice_counts = {}  # str(user_id) -> str(percentage) -> count
+        size = 0
+        while i < len(rows):
+            message_id, user_id, percent, timestamp = rows[i]
+            added = BYTES_PER_MESSAGE + (2 * _user_bytes(user_id) if user_id not in lookup else 0)
+            if size + added > ARCHIVE_MAX_BYTES and message_ids:
+                break
+            index = lookup.get(user_id)
+            if index is None:
+                index = lookup[user_id] = len(user_ids)
+                user_ids.append(user_id)
+            message_ids.append(message_id)
+            user_index.append(index)
+            percentages.append(percent)
+            timestamps.append(timestamp)
+            if percent in SUMMARY_PERCENTAGES:
+                by_percent = nice_counts.setdefault(str(user_id), {})
+                by_percent[str(percent)] = by_percent.get(str(percent), 0) + 1
+            size += added
+            i += 1
+
+        part = first_part + len(parts)
+        parts.append((archive_doc_id(month, part), {
+            'version': ARCHIVE_VERSION,
+            'month': month,
+            'part': part,
+            'start': start,
+            'end': end,
+            'count': len(message_ids),
+            'user_ids': user_ids,
+            'nice_counts': nice_counts,
+            'message_ids': _to_bytes(message_ids),
+            'user_index': _to_bytes(user_index),
+            'percentages': _to_bytes(percentages),
+            'timestamps': _to_bytes(timestamps),
+        }))
+    return parts
+
+def unpack_archive(data: dict):
+    """
+    Unpacks an archive document.
+
+    Yields:
+        tuple: (message_id, user_id, percentage, timestamp) for each archived message.
+    """
+    user_ids = data['user_ids']
+    message_ids = _from_bytes('q', data['message_ids'])
+    user_index = _from_bytes('I', data['user_index'])
+    percentages = _from_bytes('B', data['percentages'])
+    timestamps = _from_bytes('I', data['timestamps'])
+    for i in range(len(message_ids)):
+        yield message_ids[i], user_ids[user_index[i]], percentages[i], timestamps[i]
+
+def archived_message_ids(data: dict):
+    """Returns the message ids of an archive document as a set."""
+    return set(_from_bytes('q', data['message_ids']))
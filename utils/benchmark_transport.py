@@ -0,0 +1,104 @@
+#####################################################################################
+# Usage: python -m utils.benchmark_transport [--messages N] [--concurrency C] [--latency S] [--pool-sizes 1 8 64]
+#
+# Measures sendMessage throughput of the bot's HTTP transport under concurrent replies.
+# Starts a local mock Bot API server (stdlib, HTTP/1.1 keep-alive, fixed per-request
+# latency standing in for the network round trip) and fires concurrent sends through
+# the same HTTPXRequest the bot builds, once per connection pool size.
+#
+# The stdlib server only speaks HTTP/1.1, and httpx falls back to it over plain http,
+# so --http-version 2 measures the client overhead only, not multiplexing.
+####################################################################################
+import json
+import time
+import asyncio
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from telegram import Bot
+from utils.transport import build_request, TELEGRAM_HTTP_VERSION
+
+MOCK_TOKEN = "123456:mock"
+
+class MockBotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like api.telegram.org
+    latency = 0.0
+    message_id = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+
+        method = self.path.rsplit("/", 1)[-1]
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Mock", "username": "mock_bot"}
+        else:
+            MockBotAPIHandler.message_id += 1
+            result = {"message_id": MockBotAPIHandler.message_id, "date": int(time.time()),
+                      "chat": {"id": 1, "type": "group", "title": "Benchmark"}, "text": "ok"}
+
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+def start_mock_server(latency: float):
+    """Starts the mock server in a background thread and returns (server, base_url)."""
+    MockBotAPIHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockBotAPIHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/bot"
+
+async def run_profile(base_url: str, pool_size: int, http_version: str, messages: int, concurrency: int):
+    """
+    Sends `messages` messages with at most `concurrency` in flight.
+
+    Returns:
+        tuple: (messages per second, number of failed sends)
+    """
+    bot = Bot(MOCK_TOKEN, base_url=base_url, request=build_request(pool_size, http_version))
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def send(i):
+        nonlocal failures
+        async with semaphore:
+            try:
+                await bot.send_message(chat_id=1, text=f"I am {i % 101}% gay")
+            except Exception:
+                failures += 1  # e.g. pool timeouts when the pool is too small
+
+    async with bot:
+        start = time.monotonic()
+        await asyncio.gather(*(send(i) for i in range(messages)))
+        elapsed = max(time.monotonic() - start, 1e-9)
+    return messages / elapsed, failures
+
+async def benchmark(args):
+    server, base_url = start_mock_server(args.latency)
+    try:
+        print(f"{args.messages} sends, {args.concurrency} concurrent, HTTP/{args.http_version}, "
+              f"{args.latency * 1000:.0f} ms server latency")
+        for pool_size in args.pool_sizes:
+            rate, failures = await run_profile(base_url, pool_size, args.http_version, args.messages, args.concurrency)
+            print(f"pool={pool_size:>4}: {rate:>8,.0f} messages/s, {failures} failed")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Telegram send throughput against a mock Bot API server.")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages to send per profile")
+    parser.add_argument("--concurrency", type=int, default=200, help="Sends in flight at once")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock server latency per request, in seconds")
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[1, 8, 64, 256], help="Connection pool sizes to compare")
+    parser.add_argument("--http-version", default=TELEGRAM_HTTP_VERSION, choices=["1.1", "2"], help="HTTP version of the client")
+
+    asyncio.run(benchmark(parser.parse_args()))
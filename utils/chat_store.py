@@ -0,0 +1,582 @@
+## Module that keeps a compact in-memory copy of each chat's stats
+## Chats are hydrated lazily from Firestore on first query, appended to on every logged stat,
+## and evicted least-recently-used first once the memory budget is exceeded.
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from dotenv import load_dotenv
+from utils.firestore import (
+    get_chat_messages,
+    get_chat_users,
+    get_history_generation,
+    NICE_PERCENTAGES,
+    LEADERBOARD_PERCENTAGES,
+)
+from utils.records import UserRecords, format_user_records, format_day
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Memory budget for all resident chats, in MiB
+CHAT_STORE_MAX_MB = int(os.getenv("CHAT_STORE_MAX_MB", "256"))
+CHAT_STORE_MAX_BYTES = CHAT_STORE_MAX_MB * 1024 * 1024
+
+# Rough per-user overhead (two 101-slot uint32 arrays, the constant-size records + object headers)
+USER_OVERHEAD_BYTES = 2 * 101 * 4 + 256 + 160
+
+class UserStats:
+    """Per-user aggregates of a chat: occurrences and latest timestamp of each percentage, and records."""
+    __slots__ = ("counts", "last_seen", "username", "name", "last_update", "records")
+
+    def __init__(self, username: str = "", name: str = "", last_update: int = 0):
+        self.counts = array('I', bytes(101 * 4))     # percentage -> occurrences
+        self.last_seen = array('I', bytes(101 * 4))  # percentage -> latest timestamp
+        self.username = username
+        self.name = name
+        self.last_update = last_update
+        self.records = UserRecords()
+
+    @property
+    def display_name(self):
+        # Use username if available, otherwise use name
+        return self.username or self.name or 'Unknown'
+
+class ChatStore:
+    """
+    Columnar copy of a chat's "messages" subcollection plus per-user aggregates.
+
+    Rows live in growable `array` columns (uint8 percentages, uint32 timestamps,
+    int32 user index); user ids are interned so each row costs 9 bytes.
+    """
+    __slots__ = ("chat_id", "percentages", "timestamps", "user_index", "user_ids", "users", "watermark",
+                 "reconcile_from", "generation", "stale_records", "_user_lookup")
+
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.percentages = array('B')   # uint8
+        self.timestamps = array('I')    # uint32
+        self.user_index = array('i')    # int32, index into user_ids / users
+        self.user_ids = []              # Interned user ids, position == index
+        self.users = []                 # UserStats, parallel to user_ids
+        self.watermark = 0              # Latest message timestamp held by the store
+        self.reconcile_from = None      # Set when loaded from a snapshot that may lag behind Firestore
+        self.generation = 0             # History generation of the chat when it was hydrated
+        self.stale_records = set()      # Indexes of users whose records missed an out-of-order row
+        self._user_lookup = {}          # user_id -> index
+
+    def __len__(self):
+        return len(self.percentages)
+
+    def intern_user(self, user_id):
+        """Returns the index of a user, registering it if needed."""
+        idx = self._user_lookup.get(user_id)
+        if idx is None:
+            idx = self._user_lookup[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.users.append(UserStats())
+        return idx
+
+    def get_user(self, user_id):
+        idx = self._user_lookup.get(user_id)
+        return None if idx is None else self.users[idx]
+
+    def append(self, user_id, percent: int, timestamp: int):
+        if not 0 <= percent <= 100:
+            return
+        idx = self.intern_user(user_id)
+        self.percentages.append(percent)
+        self.timestamps.append(timestamp)
+        self.user_index.append(idx)
+        if timestamp > self.watermark:
+            self.watermark = timestamp
+
+        user = self.users[idx]
+        user.counts[percent] += 1
+        if timestamp > user.last_seen[percent]:
+            user.last_seen[percent] = timestamp
+        if not user.records.add(percent, timestamp):
+            self.stale_records.add(idx)
+
+    def refresh_records(self):
+        """
+        Rebuilds the records of users that got rows out of time order (hydration, snapshots,
+        late replays) with one pass over their rows sorted by timestamp. Call with store_lock held.
+        """
+        if not self.stale_records:
+            return
+        stale = self.stale_records
+        rows = sorted((self.timestamps[i], self.percentages[i], self.user_index[i])
+                      for i in range(len(self)) if self.user_index[i] in stale)
+        for idx in stale:
+            self.users[idx].records = UserRecords()
+        for timestamp, percent, idx in rows:
+            self.users[idx].records.add(percent, timestamp)
+        self.stale_records = set()
+
+    def user_rolls(self, user_id):
+        """Returns the (percentage, timestamp) rows of a user. Call with store_lock held."""
+        idx = self._user_lookup.get(user_id)
+        if idx is None:
+            return []
+        return [(self.percentages[i], self.timestamps[i]) for i in range(len(self)) if self.user_index[i] == idx]
+
+    def get_records(self, user_id):
+        """Returns the up-to-date records of a user, or None. Call with store_lock held."""
+        idx = self._user_lookup.get(user_id)
+        if idx is None:
+            return None
+        if idx in self.stale_records:
+            self.refresh_records()
+        return self.users[idx].records
+
+    def set_user_info(self, user_id, username: str, name: str, last_update: int = 0):
+        user = self.users[self.intern_user(user_id)]
+        user.username = username
+        user.name = name
+        if last_update > user.last_update:
+            user.last_update = last_update
+
+    def nbytes(self):
+        """Approximate memory footprint of the store."""
+        columns = sum(col.itemsize * len(col) for col in (self.percentages, self.timestamps, self.user_index))
+        return columns + USER_OVERHEAD_BYTES * len(self.users)
+
+# chat_id -> ChatStore, least recently used first
+_stores = OrderedDict()
+# Guards _stores and the stores themselves: stats are appended from the spool replayer's worker
+# thread and Firestore listener callbacks. Hold it while reading a store's columns.
+store_lock = threading.RLock()
+# Callables notified when a chat becomes resident / is evicted (see utils/coherence.py)
+_residency_hooks = []
+
+def add_residency_hook(on_resident, on_evict):
+    """
+    Registers callbacks for chat residency changes.
+
+    Parameters:
+        on_resident (callable): Called with the chat_id (str) when a chat becomes resident.
+        on_evict (callable):    Called with the chat_id (str) when a chat is evicted.
+    """
+    _residency_hooks.append((on_resident, on_evict))
+
+def _notify(chat_id: str, resident: bool):
+    for on_resident, on_evict in _residency_hooks:
+        try:
+            (on_resident if resident else on_evict)(chat_id)
+        except Exception as e:
+            logger.error(f"Residency hook failed for chat {chat_id}: {e}")
+
+def _apply_user_docs(store: ChatStore, users: dict):
+    # User documents are keyed by str(user_id), messages keep the original type
+    for user_id in store.user_ids:
+        user_data = users.get(str(user_id))
+        if user_data:
+            store.set_user_info(user_id, user_data.get('username', ''), user_data.get('name', ''), user_data.get('last_update', 0))
+
+def _hydrate(chat_id: str):
+    store = ChatStore(chat_id)
+    # Read first: history rewritten while hydrating shows up as a newer generation later
+    store.generation = get_history_generation(chat_id)
+    users = get_chat_users(chat_id)
+    for user_id, percent, timestamp in get_chat_messages(chat_id):
+        store.append(user_id, percent, timestamp)
+    _apply_user_docs(store, users)
+
+    logger.info(f"Hydrated chat {chat_id} with {len(store)} messages and {len(store.users)} users.")
+    return store
+
+def _reconcile(store: ChatStore):
+    """
+    Catches a stale store (loaded from a snapshot, or changed by another writer) up with
+    Firestore, fetching only the messages at or after store.reconcile_from.
+    Fetches without holding store_lock; only applying the result takes it.
+
+    Returns:
+        bool: False if the chat's history was rewritten meanwhile (a backfill, import or
+              migration added older messages): the store is evicted and must be hydrated again.
+    """
+    with store_lock:
+        since, store.reconcile_from = store.reconcile_from, None
+    if since is None:
+        return True
+    try:
+        generation = get_history_generation(store.chat_id)
+        if generation != store.generation:
+            logger.info(f"Chat {store.chat_id} history was rewritten, hydrating it again.")
+            _evict_store(store)
+            return False
+        messages = list(get_chat_messages(store.chat_id, since=since))
+        users = get_chat_users(store.chat_id)
+    except Exception:
+        mark_stale(store.chat_id, since)  # Retried by the next query
+        raise
+
+    with store_lock:
+        # Rows after `since` may already be held (appended meanwhile, too); (user, timestamp)
+        # is unique per chat because the bot drops rolls of the same user within 60s
+        known = {
+            (store.user_ids[store.user_index[i]], store.timestamps[i])
+            for i in range(len(store)) if store.timestamps[i] >= since
+        }
+        added = 0
+        for user_id, percent, timestamp in messages:
+            if (user_id, timestamp) not in known:
+                store.append(user_id, percent, timestamp)
+                added += 1
+        _apply_user_docs(store, users)
+
+    logger.info(f"Reconciled chat {store.chat_id} from {since}: {added} new messages.")
+    return True
+
+def _enforce_budget():
+    """Evicts least recently used chats until the resident stores fit the memory budget."""
+    total = sum(store.nbytes() for store in _stores.values())
+    # Always keep the most recently used chat, even if it alone exceeds the budget
+    while total > CHAT_STORE_MAX_BYTES and len(_stores) > 1:
+        chat_id, store = _stores.popitem(last=False)
+        total -= store.nbytes()
+        logger.info(f"Evicted chat {chat_id} from the chat store ({store.nbytes()} bytes).")
+        _notify(chat_id, resident=False)
+
+class _Loading:
+    """A chat being hydrated without store_lock held; see get_store."""
+    __slots__ = ("done", "pending", "cancelled")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.pending = []        # record_stat arguments received while loading
+        self.cancelled = False   # Evicted while loading: the result is not installed
+
+# chat_id -> _Loading, for chats being hydrated
+_loading = {}
+
+def get_store(chat_id: int):
+    """
+    Returns the in-memory store of a chat, hydrating it from Firestore on first use.
+
+    Firestore is read without holding store_lock, so loading a large chat does not block
+    other chats or ingestion; concurrent callers for the same chat wait for one load.
+    Must not be called with store_lock held.
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+
+    Returns:
+        ChatStore: The resident store of the chat.
+    """
+    key = str(chat_id)
+    while True:
+        with store_lock:
+            store = _stores.get(key)
+            if store is not None:
+                _stores.move_to_end(key)
+                break
+            loading = _loading.get(key)
+            if loading is None:
+                loading = _loading[key] = _Loading()
+                break
+        # Another thread is hydrating this chat
+        loading.done.wait()
+
+    if store is not None:
+        if store.reconcile_from is not None and not _reconcile(store):
+            return get_store(chat_id)
+        return store
+
+    try:
+        store = _hydrate(key)
+    finally:
+        with store_lock:
+            del _loading[key]
+            loading.done.set()
+
+    with store_lock:
+        if loading.pending:
+            # Stats logged while loading may or may not have been read from Firestore
+            since = min(timestamp for *_, timestamp in loading.pending)
+            known = {
+                (store.user_ids[store.user_index[i]], store.timestamps[i])
+                for i in range(len(store)) if store.timestamps[i] >= since
+            }
+            for user_id, username, name, percent, timestamp in loading.pending:
+                if (user_id, timestamp) not in known:
+                    store.append(user_id, percent, timestamp)
+                store.set_user_info(user_id, username, name, timestamp)
+        if not loading.cancelled and key not in _stores:
+            _stores[key] = store
+            _notify(key, resident=True)
+            _enforce_budget()
+    return store
+
+def install_store(store: ChatStore):
+    """Makes a store built elsewhere (e.g. loaded from a snapshot) resident."""
+    with store_lock:
+        _stores[store.chat_id] = store
+        _notify(store.chat_id, resident=True)
+        _enforce_budget()
+
+def resident_stores():
+    """Returns the resident stores, least recently used first."""
+    with store_lock:
+        return list(_stores.values())
+
+def peek_store(chat_id: int):
+    """Returns the store of a chat if it is resident, without hydrating it or touching the LRU order."""
+    return _stores.get(str(chat_id))
+
+def record_stat(chat_id: int, user_id, username: str, name: str, percent: int, timestamp: int):
+    """
+    Appends a newly logged stat to the chat's store, if it is resident (replays are ignored).
+    Chats that are not resident will pick the message up from Firestore when hydrated.
+    """
+    key = str(chat_id)
+    with store_lock:
+        store = _stores.get(key)
+        if store is None:
+            loading = _loading.get(key)
+            if loading is not None:
+                loading.pending.append((user_id, username, name, percent, timestamp))
+            return
+        user = store.get_user(user_id)
+        # A replayed stat already held: (user, timestamp) is unique per chat
+        replayed = user is not None and 0 <= percent <= 100 and user.counts[percent] and user.last_seen[percent] == timestamp
+        if not replayed:
+            store.append(user_id, percent, timestamp)
+        store.set_user_info(user_id, username, name, timestamp)
+        _enforce_budget()
+
+def mark_stale(chat_id: int, since: int):
+    """
+    Flags a resident chat as stale; messages at or after `since` are fetched on its next query.
+    """
+    with store_lock:
+        store = _stores.get(str(chat_id))
+        if store is None:
+            return
+        if store.reconcile_from is None or since < store.reconcile_from:
+            store.reconcile_from = since
+
+def patch_user_info(chat_id: int, user_key: str, user_data: dict):
+    """
+    Patches the name/username of a user in a resident chat from its Firestore document.
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+        user_key (str): The user document ID (str(user_id)).
+        user_data (dict): The user document data.
+    """
+    with store_lock:
+        store = _stores.get(str(chat_id))
+        if store is None:
+            return
+        for user_id in (user_key, int(user_key) if user_key.lstrip('-').isdigit() else None):
+            if store.get_user(user_id) is not None:
+                store.set_user_info(user_id, user_data.get('username', ''), user_data.get('name', ''), user_data.get('last_update', 0))
+                return
+
+def _evict_store(store: ChatStore):
+    """Drops a store if it is still the resident one of its chat."""
+    with store_lock:
+        if _stores.get(store.chat_id) is store:
+            del _stores[store.chat_id]
+            _notify(store.chat_id, resident=False)
+
+def invalidate_history(chat_id: int, generation: int):
+    """
+    Evicts a resident chat hydrated before its history was rewritten (generation is newer).
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+        generation (int): The chat's current history generation.
+    """
+    store = peek_store(chat_id)
+    if store is not None and generation > store.generation:
+        logger.info(f"Chat {chat_id} history was rewritten (generation {generation}), evicting it.")
+        _evict_store(store)
+
+def evict_chat(chat_id: int):
+    """Drops the store of a chat (e.g. after a backfill or deletion)."""
+    with store_lock:
+        loading = _loading.get(str(chat_id))
+        if loading is not None:
+            loading.cancelled = True
+        if _stores.pop(str(chat_id), None) is not None:
+            _notify(str(chat_id), resident=False)
+
+def get_user_histogram(chat_id: int, user_id: str):
+    """
+    Retrieves a copy of a user's histogram (occurrences of each percentage) in a chat, from memory.
+
+    Parameters:
+        chat_id (int): The ID of the chat to retrieve stats from.
+        user_id (str): The ID of the user to retrieve stats for.
+
+    Returns:
+        list: 101 counts indexed by percentage, or None if the user has no stats.
+
+    Raises:
+        Exception: If the chat cannot be loaded, so callers do not mistake it for no stats.
+    """
+    store = get_store(chat_id)
+    with store_lock:
+        user = store.get_user(user_id)
+        if user is None or not any(user.counts):
+            return None
+        return user.counts.tolist()
+
+def format_user_stats_page(counts: list, page: int, sort_by: str = "percent", page_size: int = 20):
+    """
+    Formats one page of a user's non-zero percentage counts.
+
+    Parameters:
+        counts (list):   101 counts indexed by percentage, from get_user_histogram.
+        page (int):      The 0-based page to format; clamped to the valid range.
+        sort_by (str):   'percent' (0% to 100%) or 'count' (most frequent first).
+        page_size (int): The number of lines per page.
+
+    Returns:
+        tuple: (formatted page, clamped page, number of pages)
+    """
+    buckets = [(p, c) for p, c in enumerate(counts) if c]
+    if sort_by == "count":
+        buckets.sort(key=lambda bucket: bucket[1], reverse=True)
+
+    pages = max(1, -(-len(buckets) // page_size))
+    page = min(max(page, 0), pages - 1)
+    lines = [f"{p}% Gay: {c} times" for p, c in buckets[page * page_size:(page + 1) * page_size]]
+    return "\n".join(lines), page, pages
+
+def get_user_stats_nice(chat_id: int, user_id: str):
+    """
+    Retrieves a specific user's nice stats (Occurrence of specific "nice" percentage) in a chat, from memory.
+
+    Parameters:
+        chat_id (int): The ID of the chat to retrieve stats from.
+        user_id (str): The ID of the user to retrieve stats for.
+
+    Returns:
+        str: A formatted string of the user's nice percent counts or an error message.
+    """
+    try:
+        store = get_store(chat_id)
+        with store_lock:
+            user = store.get_user(user_id)
+            if user is None:
+                logger.info(f"No nice stats found for user {user_id} in chat {chat_id}.")
+                return "No nice stats yet!"
+
+            output = []
+            for target_percent in sorted(NICE_PERCENTAGES.keys(), reverse=True):
+                if user.counts[target_percent]:
+                    formatted_time = datetime.fromtimestamp(user.last_seen[target_percent]).strftime('%Y-%m-%d %H:%M')
+                    output.append(
+                        f"{NICE_PERCENTAGES[target_percent]}\n→ {user.counts[target_percent]} times (last on {formatted_time})"
+                    )
+
+            records = format_user_records(store.get_records(user_id))
+            if records:
+                output.append(records)
+
+            return "\n\n".join(output)
+    except Exception as e:
+        logger.error(f"Failed to retrieve user nice percent counts: {e}")
+        return "Error retrieving nice stats."
+
+def get_leaderboard(chat_id: int):
+    """
+    Retrieves the leaderboard for a chat, from memory.
+
+    Parameters:
+        chat_id (int): The ID of the chat to retrieve the leaderboard for.
+
+    Returns:
+        str: A formatted string of the leaderboard or an error message.
+    """
+    try:
+        store = get_store(chat_id)
+        with store_lock:
+            output = []
+            for percent in sorted(LEADERBOARD_PERCENTAGES.keys(), reverse=True):
+                ranked = sorted(
+                    (user for user in store.users if user.counts[percent]),
+                    key=lambda user: user.counts[percent],
+                    reverse=True,
+                )
+                if ranked:
+                    output.append(LEADERBOARD_PERCENTAGES[percent])
+                    for user in ranked:
+                        output.append(f"@{user.display_name} x{user.counts[percent]}")
+                    output.append("")
+
+            output.extend(_format_records_board(store))
+
+            if not output:
+                logger.info(f"No leaderboard entries found for chat {chat_id}.")
+                return "No leaderboard yet! Use @HowGayBot to start contributing your stats."
+
+            return "\n".join(output)
+    except Exception as e:
+        logger.error(f"Failed to retrieve leaderboard: {e}")
+        return "Error retrieving leaderboard."
+
+RECORDS_BOARD_SIZE = 3
+
+def _format_records_board(store: ChatStore):
+    """Formats the records sections of the leaderboard (top users by longest streak / most 100% in a day)."""
+    store.refresh_records()
+    output = []
+    boards = (
+        ("🔥 Longest Nice Streaks", lambda r: (r.best_streak, r.best_streak_end),
+         lambda r: f"{r.best_streak} day{'s' if r.best_streak > 1 else ''} (until {format_day(r.best_streak_end)})"),
+        ("💯 Most 100% In One Day", lambda r: (r.best_hundreds, r.best_hundreds_day),
+         lambda r: f"x{r.best_hundreds} (on {format_day(r.best_hundreds_day)})"),
+    )
+    for title, key, describe in boards:
+        ranked = sorted((user for user in store.users if key(user.records)[0]),
+                        key=lambda user: key(user.records), reverse=True)[:RECORDS_BOARD_SIZE]
+        if ranked:
+            output.append(title)
+            for user in ranked:
+                output.append(f"@{user.display_name} {describe(user.records)}")
+            output.append("")
+    return output
+
+def get_user_rolls(chat_id: int, user_id: str):
+    """
+    Retrieves every roll of a user in a chat, from memory (used to rebuild stored records).
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+        user_id (str): The ID of the user.
+
+    Returns:
+        list: (percentage, timestamp) tuples, in no particular order.
+    """
+    store = get_store(chat_id)
+    with store_lock:
+        return store.user_rolls(user_id)
+
+def get_user_stats_views(chat_id: int, user_id: str):
+    """
+    Retrieves both /mystats views of a user (the chat is loaded once).
+
+    Parameters:
+        chat_id (int): The ID of the chat to retrieve stats from.
+        user_id (str): The ID of the user to retrieve stats for.
+
+    Returns:
+        dict: 'histogram' (see get_user_histogram, paged with format_user_stats_page)
+              and 'nice' (formatted, see get_user_stats_nice).
+
+    Raises:
+        Exception: If the chat cannot be loaded (see get_user_histogram).
+    """
+    # Each view takes store_lock itself: get_store must not be called with it held
+    return {
+        'histogram': get_user_histogram(chat_id, user_id),
+        'nice': get_user_stats_nice(chat_id, user_id),
+    }
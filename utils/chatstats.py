@@ -0,0 +1,105 @@
+## Module that computes chat-wide analytics (/chatstats) with NumPy over compact arrays
+import numpy as np
+from utils.chat_store import ChatStore, get_store, store_lock
+import logging
+logger = logging.getLogger(__name__)
+
+HISTOGRAM_BINS = 10     # 0-9%, 10-19%, ..., 90-100%
+HISTOGRAM_BAR_WIDTH = 12
+TOP_USERS = 10          # Number of users shown in the per-user averages
+
+def compute_chat_stats(store: ChatStore):
+    """
+    Computes the chat statistics with vectorized NumPy operations.
+
+    Parameters:
+        store (ChatStore): The in-memory columnar messages of the chat.
+
+    Returns:
+        dict: count, mean, median, std, histogram (counts per bin) and
+              per_user (list of (display name, average, count), highest average first).
+    """
+    # Zero-copy views over the array columns; they are released when this function returns
+    percentages = np.frombuffer(store.percentages, dtype=np.uint8)
+    user_index = np.frombuffer(store.user_index, dtype=np.int32)
+    n_users = len(store.users)
+
+    percent_counts = np.bincount(percentages, minlength=101)
+    histogram = percent_counts[:100].reshape(HISTOGRAM_BINS, -1).sum(axis=1)
+    histogram[-1] += percent_counts[100]  # 100% belongs to the last bin
+
+    user_counts = np.bincount(user_index, minlength=n_users)
+    user_sums = np.bincount(user_index, weights=percentages, minlength=n_users)
+    active = np.flatnonzero(user_counts)
+    averages = user_sums[active] / user_counts[active]
+    order = np.argsort(-averages, kind="stable")[:TOP_USERS]
+
+    return {
+        'count': int(percentages.size),
+        'mean': float(percentages.mean()),
+        'median': float(np.median(percentages)),
+        'std': float(percentages.std()),
+        'histogram': histogram.tolist(),
+        'per_user': [
+            (store.users[active[i]].display_name, float(averages[i]), int(user_counts[active[i]]))
+            for i in order
+        ],
+    }
+
+def format_chat_stats(stats: dict):
+    """
+    Formats the output of compute_chat_stats for Telegram.
+
+    Parameters:
+        stats (dict): The computed chat statistics.
+
+    Returns:
+        str: The formatted chat statistics.
+    """
+    output = [
+        f"📊 Chat stats ({stats['count']} rolls)",
+        f"Mean: {stats['mean']:.1f}%",
+        f"Median: {stats['median']:.1f}%",
+        f"Std dev: {stats['std']:.1f}%",
+        "",
+        "Histogram:",
+    ]
+
+    bin_width = 100 // HISTOGRAM_BINS
+    peak = max(stats['histogram']) or 1
+    for i, count in enumerate(stats['histogram']):
+        low = i * bin_width
+        high = 100 if i == HISTOGRAM_BINS - 1 else low + bin_width - 1
+        bar = "█" * round(HISTOGRAM_BAR_WIDTH * count / peak)
+        output.append(f"{low}-{high}%: {bar} {count}")
+
+    output.append("")
+    output.append("Per-user average:")
+    for display, average, count in stats['per_user']:
+        output.append(f"@{display} {average:.1f}% (x{count})")
+
+    return "\n".join(output)
+
+def get_chat_stats(chat_id: int):
+    """
+    Retrieves the chat-wide statistics (mean, median, std dev, histogram, per-user averages).
+
+    Parameters:
+        chat_id (int): The ID of the chat to retrieve stats for.
+
+    Returns:
+        str: A formatted string of the chat stats or an error message.
+    """
+    try:
+        store = get_store(chat_id)
+        # Hold the lock so no stat is appended while NumPy views the columns
+        with store_lock:
+            if not len(store):
+                logger.info(f"No messages found for chat {chat_id}.")
+                return "No stats yet! Use @HowGayBot to start contributing your stats."
+            stats = compute_chat_stats(store)
+
+        return format_chat_stats(stats)
+    except Exception as e:
+        logger.error(f"Failed to retrieve chat stats: {e}")
+        return "Error retrieving chat stats."
@@ -7,16 +7,81 @@ import argparse
 
 GAYNESS_RE = re.compile(r"I am (\d+)% gay")
 
+DEDUPE_WINDOW_SECONDS = 60  # Same rule as the bot: one roll per user per minute
+
+def message_text(message):
+    text = message.get("text", "")
+    if isinstance(text, list):  # Text with formatting/entities
+        text = "".join(t["text"] if isinstance(t, dict) else str(t) for t in text)
+    return text
+
 def is_valid_gay_message(message):
     # Ensure message is via the HowGayBot and matches the gayness message pattern
     if message.get("via_bot") != "@HowGayBot":
         return False
-    
-    text = message.get("text", "")
-    if isinstance(text, list):  # Text with formatting/entities
-        text = "".join(t["text"] if isinstance(t, dict) else str(t) for t in text)
 
-    return bool(GAYNESS_RE.search(text))
+    return bool(GAYNESS_RE.search(message_text(message)))
+
+def extract_stat(message):
+    """
+    Extracts a stat from an exported Telegram message.
+
+    Returns:
+        dict: message_id, user_id, name, percentage, timestamp; or None if the
+              message is not a @HowGayBot roll.
+    """
+    if message.get("via_bot") != "@HowGayBot":
+        return None
+
+    m = GAYNESS_RE.search(message_text(message))
+    if not m:
+        return None
+
+    from_id = message.get("from_id", "unknown")
+    if isinstance(from_id, str) and from_id.startswith("user"):
+        user_id = int(from_id.replace("user", ""))
+    elif isinstance(from_id, int):
+        user_id = from_id
+    else:
+        user_id = "unknown"
+
+    return {
+        'message_id': message.get("id", 0),
+        'user_id': user_id,
+        'name': message.get("from", ""),
+        'percentage': int(m.group(1)),
+        'timestamp': int(message["date_unixtime"]),  # Unix time for easier comparison
+    }
+
+def dedupe_stats(stats):
+    """
+    Applies the bot's per-user dedupe: a roll is dropped if the same user's previous
+    kept roll is less than DEDUPE_WINDOW_SECONDS older. Stats must be in chronological order.
+
+    Returns:
+        tuple: (kept stats, users list for bulk_log_stat, number of skipped stats)
+    """
+    kept = []
+    skipped = 0
+    last_updates = {}
+    names = {}
+    for stat in stats:
+        user_id = stat['user_id']
+        last_update = last_updates.get(user_id, 0)
+        if last_update and (stat['timestamp'] - last_update < DEDUPE_WINDOW_SECONDS):
+            skipped += 1
+            continue
+        last_updates[user_id] = stat['timestamp']
+        names[user_id] = stat['name']
+        kept.append(stat)
+
+    users = [{
+        'user_id': user_id,
+        'last_update': last_update,
+        'username': "",  # Not included in Telegram export
+        'name': names[user_id],
+    } for user_id, last_update in last_updates.items()]
+    return kept, users, skipped
 
 def clean_json(input_file, output_file):
     with open(input_file, "r", encoding="utf-8") as f:
@@ -0,0 +1,78 @@
+## Module that keeps the in-memory chat store coherent with Firestore across bot instances
+## When enabled, every resident chat gets Firestore listeners on its chat document, watermark
+## shards and "users" subcollection: user renames are patched in place, and writes by other instances (or admin
+## scripts) mark the chat stale so its next query fetches just the missing messages. Rewritten history
+## (a bumped history generation) evicts the chat, so it is hydrated again in full.
+import os
+import threading
+from dotenv import load_dotenv
+from utils.chat_store import add_residency_hook, peek_store, mark_stale, patch_user_info, evict_chat, invalidate_history
+from utils.firestore import watch_chat, watch_chat_shards, watch_chat_users, forget_chat, get_own_last_update
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+CACHE_COHERENCE = os.getenv("CACHE_COHERENCE", "0") == "1"
+# How far before the local watermark to re-read when another writer is detected,
+# to catch messages that were logged elsewhere slightly out of order
+COHERENCE_SLACK_SECONDS = int(os.getenv("COHERENCE_SLACK_SECONDS", "300"))
+
+# chat_id -> list of Firestore Watch handles
+_watches = {}
+
+def _on_chat_change(chat_id: str, data: dict):
+    if data is None:
+        # Chat deleted elsewhere (e.g. the bot was removed while handled by another instance)
+        logger.info(f"Chat {chat_id} deleted remotely, evicting it.")
+        evict_chat(chat_id)
+        # The next stat logged here recreates the chat document
+        forget_chat(chat_id)
+        return
+
+    # Older messages added by a backfill, import or migration: reload the chat from scratch
+    invalidate_history(chat_id, data.get('history_generation', 0))
+
+    # Chats written before sharding keep their watermark on the chat document
+    _on_watermark_change(chat_id, data.get('last_update', 0))
+
+def _on_watermark_change(chat_id: str, last_update: int):
+    store = peek_store(chat_id)
+    # This instance's own stats are appended to the store right after their write: only a
+    # watermark past both comes from another writer
+    if store is not None and last_update > max(store.watermark, get_own_last_update(chat_id)):
+        logger.debug(f"Chat {chat_id} updated remotely, marking it stale.")
+        mark_stale(chat_id, max(0, store.watermark - COHERENCE_SLACK_SECONDS))
+
+def _on_user_change(chat_id: str, user_key: str, data: dict):
+    patch_user_info(chat_id, user_key, data)
+
+def _attach(chat_id: str):
+    if chat_id in _watches:
+        return
+    try:
+        _watches[chat_id] = [
+            watch_chat(chat_id, lambda data: _on_chat_change(chat_id, data)),
+            watch_chat_shards(chat_id, lambda last_update: _on_watermark_change(chat_id, last_update)),
+            watch_chat_users(chat_id, lambda user_key, data: _on_user_change(chat_id, user_key, data)),
+        ]
+        logger.debug(f"Attached listeners to chat {chat_id}.")
+    except Exception as e:
+        logger.error(f"Failed to attach listeners to chat {chat_id}: {e}")
+
+def _detach(chat_id: str):
+    watches = _watches.pop(chat_id, [])
+    # Evictions can be triggered from a listener callback, which must not join its own thread
+    for watch in watches:
+        threading.Thread(target=watch.unsubscribe, daemon=True).start()
+
+def enable_cache_coherence():
+    """
+    Attaches Firestore listeners to every chat while it is held in the chat store,
+    if CACHE_COHERENCE is enabled. Call once at startup, before any chat is loaded.
+    """
+    if not CACHE_COHERENCE:
+        return
+    add_residency_hook(_attach, _detach)
+    logger.info("Cache coherence enabled: listening to Firestore for resident chats.")
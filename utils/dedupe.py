@@ -0,0 +1,183 @@
+## Module that dedupes backfilled stats whatever order they arrive in, with bounded memory
+## The bot's rule (a roll is dropped if the same user's previous kept roll is less than
+## DEDUPE_WINDOW_SECONDS older) only depends on each user's own rolls in time order. Stats are
+## read in runs of at most DEDUPE_RUN_SIZE, each run sorted by (user, timestamp, arrival) and
+## spilled to a temporary file when there are several, then the runs are merged (an input that
+## fits one run is just sorted in memory) and the rule is applied one user at a time, handing
+## out the kept stats in batches of DEDUPE_WRITE_BATCH to be written as they come. The kept
+## stats are exactly those of a chronologically sorted pass (dedupe_reference), equal
+## timestamps kept in arrival order.
+import os
+import heapq
+import pickle
+import tempfile
+from operator import itemgetter
+from dotenv import load_dotenv
+from utils.clean_chat_history_json import dedupe_stats, DEDUPE_WINDOW_SECONDS
+
+# Load environment variables
+load_dotenv()
+
+# Stats sorted in memory at once; larger inputs are spilled to temporary files in sorted runs
+DEDUPE_RUN_SIZE = int(os.getenv("DEDUPE_RUN_SIZE", "200000"))
+# Kept stats handed out (and written) at once
+DEDUPE_WRITE_BATCH = int(os.getenv("DEDUPE_WRITE_BATCH", "10000"))
+
+def dedupe_reference(stats):
+    """
+    The reference result: a stable chronological sort, then the bot's rule (dedupe_stats).
+    Holds every stat in memory.
+
+    Returns:
+        tuple: (kept stats, users list for bulk_log_stat, number of skipped stats)
+    """
+    return dedupe_stats(sorted(stats, key=lambda stat: stat['timestamp']))
+
+# Stats are sorted by one int, (user rank << TIMESTAMP_BITS) + timestamp; sorts and merges are
+# stable, so equal timestamps stay in arrival order
+TIMESTAMP_BITS = 34
+SPILL_CHUNK = 8192  # Records pickled per dump
+
+def _sort_key(ranks: dict):
+    def key(stat):
+        user_id = stat['user_id']
+        if not isinstance(user_id, int):
+            # String ids ("unknown") rank below every numeric id, the same in every run
+            user_id = ranks.setdefault(user_id, -(1 << 64) - len(ranks))
+        return (user_id << TIMESTAMP_BITS) + stat['timestamp']
+    return key
+
+def _spill(run: list, key):
+    """Writes a run to a temporary file as sorted (key, stat) records."""
+    records = [(key(stat), stat) for stat in run]
+    records.sort(key=itemgetter(0))
+    f = tempfile.TemporaryFile()
+    for i in range(0, len(records), SPILL_CHUNK):
+        pickle.dump(records[i:i + SPILL_CHUNK], f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+def _read_run(f):
+    while True:
+        try:
+            yield from pickle.load(f)
+        except EOFError:
+            return
+
+class StatSorter:
+    """
+    Sorts stats by user then timestamp with bounded memory: stats are added in runs of at most
+    run_size, each run is sorted and spilled to a temporary file once there is more than one,
+    and sorted() merges the runs back. An input that fits one run is just sorted in memory.
+    Use it as a context manager, so the temporary files are closed.
+
+    Parameters:
+        run_size (int): Stats sorted in memory at once.
+    """
+
+    def __init__(self, run_size: int = DEDUPE_RUN_SIZE):
+        self.run_size = max(run_size, 1)
+        self.key = _sort_key({})
+        self.run = []
+        self.files = []
+
+    def add(self, stat: dict):
+        self.run.append(stat)
+        if len(self.run) >= self.run_size:
+            self.files.append(_spill(self.run, self.key))
+            self.run = []
+
+    def extend(self, stats):
+        for stat in stats:
+            self.add(stat)
+
+    def sorted(self):
+        """Yields every stat added, sorted by user then timestamp, equal timestamps in arrival order."""
+        if not self.files:
+            self.run.sort(key=self.key)
+            yield from self.run
+            return
+        if self.run:
+            self.files.append(_spill(self.run, self.key))
+            self.run = []
+        # heapq.merge takes equal keys from earlier runs first, i.e. in arrival order
+        for _, stat in heapq.merge(*[_read_run(f) for f in self.files], key=itemgetter(0)):
+            yield stat
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+        self.run = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def dedupe_batches(sorter: StatSorter, batch_size: int = DEDUPE_WRITE_BATCH):
+    """
+    Applies the bot's per-user dedupe to the stats added to a sorter, with the result of
+    dedupe_reference, handing the kept stats out in batches so they can be written as they come.
+
+    Parameters:
+        sorter (StatSorter): The stats, in any order.
+        batch_size (int):    Kept stats per batch.
+
+    Yields:
+        tuple: (kept stats grouped by user, each user's in chronological order, users list for
+                bulk_log_stat of the users whose last kept stat is in the batch, skipped stats)
+    """
+    kept, users = [], []
+    skipped = 0
+
+    def add_user(stat):
+        users.append({
+            'user_id': stat['user_id'],
+            'last_update': stat['timestamp'],
+            'username': "",  # Not included in Telegram export
+            'name': stat['name'],
+        })
+
+    last_kept = None
+    for stat in sorter.sorted():
+        if last_kept is None or stat['user_id'] != last_kept['user_id']:
+            if last_kept is not None:
+                add_user(last_kept)
+        # Like dedupe_stats, a kept timestamp of 0 counts as no previous roll
+        elif last_kept['timestamp'] and stat['timestamp'] - last_kept['timestamp'] < DEDUPE_WINDOW_SECONDS:
+            skipped += 1
+            continue
+        last_kept = stat
+        kept.append(stat)
+        if len(kept) >= batch_size:
+            yield kept, users, skipped
+            kept, users, skipped = [], [], 0
+    if last_kept is not None:
+        add_user(last_kept)
+    if kept or users or skipped:
+        yield kept, users, skipped
+
+def dedupe_unordered(stats, run_size: int = DEDUPE_RUN_SIZE):
+    """
+    Applies the bot's per-user dedupe to stats in any order, with the result of dedupe_reference.
+    Returns every kept stat at once: use StatSorter and dedupe_batches to write them as they come.
+
+    Parameters:
+        stats (iterable): Stats as produced by extract_stat, in any order (a generator is fine).
+        run_size (int):   Stats sorted in memory at once.
+
+    Returns:
+        tuple: (kept stats grouped by user, each user's in chronological order,
+                users list for bulk_log_stat, number of skipped stats)
+    """
+    kept, users = [], []
+    skipped = 0
+    with StatSorter(run_size) as sorter:
+        sorter.extend(stats)
+        for batch_kept, batch_users, batch_skipped in dedupe_batches(sorter):
+            kept += batch_kept
+            users += batch_users
+            skipped += batch_skipped
+    return kept, users, skipped
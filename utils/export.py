@@ -0,0 +1,71 @@
+## Module that exports all chats' messages/users to gzip-compressed NDJSON or CSV files
+## Rows are streamed from Firestore page by page and written as they arrive, so memory use
+## stays constant whatever the dataset size.
+import os
+import csv
+import gzip
+import json
+import time
+from utils.firestore import iter_message_rows, iter_user_rows
+import logging
+logger = logging.getLogger(__name__)
+
+EXPORT_KINDS = {
+    'messages': (iter_message_rows, ['chat_id', 'message_id', 'user_id', 'percentage', 'timestamp']),
+    'users': (iter_user_rows, ['chat_id', 'user_id', 'username', 'name', 'last_update']),
+}
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+def write_rows(rows, path: str, fmt: str, columns: list):
+    """
+    Writes rows to a gzip-compressed NDJSON or CSV file, one row at a time.
+
+    Parameters:
+        rows (iterable): The rows (dicts) to write.
+        path (str):      The output file path.
+        fmt (str):       'ndjson' or 'csv'.
+        columns (list):  The CSV header / column order.
+
+    Returns:
+        int: The number of rows written.
+    """
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False))
+                f.write("\n")
+                count += 1
+    return count
+
+def export_to_file(kind: str, fmt: str, directory: str = "exports"):
+    """
+    Exports every chat's messages or users to a compressed file.
+
+    Parameters:
+        kind (str):      'messages' or 'users'.
+        fmt (str):       'ndjson' or 'csv'.
+        directory (str): The directory to write the export to.
+
+    Returns:
+        tuple: (path, number of rows written)
+    """
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"Unknown export kind: {kind}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    iter_rows, columns = EXPORT_KINDS[kind]
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{kind}_{time.strftime('%Y%m%d_%H%M%S')}.{fmt}.gz")
+
+    start = time.monotonic()
+    count = write_rows(iter_rows(), path, fmt, columns)
+    logger.info(f"Exported {count} {kind} to {path} in {time.monotonic() - start:.1f}s.")
+    return path, count
@@ -1,9 +1,12 @@
 import os
 from dotenv import load_dotenv
 import json
-from collections import defaultdict
-from datetime import datetime
+import time
+import random
 from firebase_admin import credentials, firestore, initialize_app
+from google.api_core.exceptions import AlreadyExists
+from utils.records import RECORDS_UTC_OFFSET_HOURS, RECORD_DOC_FIELDS
+from utils.archive import pack_archive_parts, unpack_archive, archived_message_ids, month_key, month_bounds
 import logging
 logger = logging.getLogger(__name__)
 
@@ -27,8 +30,226 @@ db = firestore.client()
 
 chats = db.collection("chats")
 
+# Labels of the "nice" percentages, shared by every stats/leaderboard renderer
+NICE_PERCENTAGES = {
+    100: "💯 100% GAY 👨‍❤️‍💋‍👨",
+    88:  "🐉 88% Huat Gay 🍀",
+    69:  "☯️ 69% Gay 👯",
+    0:   "🙅‍♂️ 0% Gay 🚫"
+}
+
+LEADERBOARD_PERCENTAGES = {
+    100: "💯The Great Gays 👨‍❤️‍💋‍👨100%",
+    88: "🐉 88% Huat Gays 🍀",
+    69: "☯️ 69 Gays 👯",
+    0:  "🙅‍♂️ 0% Gays 🚫",
+}
+
+# Chat-level watermark (last_update) and counters are spread over N documents in
+# chats/{chat_id}/shards, since Firestore throttles sustained writes to one document (~1/s).
+# Readers take the max (watermark) or sum (counters) over all shards.
+# The count can be changed per chat with set_chat_shard_count (admin command /shards).
+DEFAULT_CHAT_SHARDS = int(os.getenv("CHAT_WATERMARK_SHARDS", "4"))
+# How long a chat's shard count and watermark are reused before being read again
+# (/shards on another instance and other writers are picked up within that delay, at once with CACHE_COHERENCE)
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", "300"))
+
+# chat_id -> (shard count, expires_at), for chats whose document is known to exist (saves a read per write)
+_chat_shards = {}
+# chat_id -> (watermark, expires_at): the max over the shards when read, raised by this process's writes
+_watermarks = {}
+# chat_id -> latest timestamp written by this process, to tell its own writes from other writers'
+_own_watermarks = {}
+
+def _ensure_chat(chat_id: int):
+    """
+    Creates the chat document if needed and returns the chat's shard count.
+    The chat document is read at most once every CHAT_CACHE_TTL_SECONDS.
+    """
+    key = str(chat_id)
+    cached = _chat_shards.get(key)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    chat_ref = chats.document(key)
+    chat_doc = chat_ref.get()
+    if chat_doc.exists:
+        shard_count = chat_doc.to_dict().get('shard_count', DEFAULT_CHAT_SHARDS)
+    else:
+        shard_count = DEFAULT_CHAT_SHARDS
+        try:
+            # Fails if another instance created it meanwhile, keeping its settings
+            chat_ref.create({'chat_id': chat_id, 'shard_count': shard_count})
+        except AlreadyExists:
+            shard_count = chat_ref.get().to_dict().get('shard_count', DEFAULT_CHAT_SHARDS)
+    _remember_shards(key, shard_count)
+    return shard_count
+
+def _remember_shards(key: str, shard_count: int):
+    _chat_shards[key] = (shard_count, time.monotonic() + CHAT_CACHE_TTL_SECONDS)
+
+def _raise_watermark(key: str, last_update: int, refresh: bool = False):
+    cached = _watermarks.get(key)
+    if refresh or cached is None:
+        _watermarks[key] = (last_update, time.monotonic() + CHAT_CACHE_TTL_SECONDS)
+    elif last_update > cached[0]:
+        _watermarks[key] = (last_update, cached[1])
+
+def _shard_ref(chat_id: int):
+    """Returns a random watermark/counter shard of a chat, spreading writes over all shards."""
+    shard_count = _ensure_chat(chat_id)
+    return chats.document(str(chat_id)).collection("shards").document(str(random.randrange(shard_count)))
+
+def forget_chat(chat_id: int):
+    """
+    Drops what this process knows of a chat's document (e.g. it was deleted by another
+    instance), so the next write checks it again and recreates it if needed.
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+
+    Returns:
+        None
+    """
+    _chat_shards.pop(str(chat_id), None)
+    _watermarks.pop(str(chat_id), None)
+    _own_watermarks.pop(str(chat_id), None)
+
+def get_chat_shard_count(chat_id: int):
+    """
+    Retrieves how many shard documents a chat's watermark and counters are spread over.
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+
+    Returns:
+        int: The shard count.
+    """
+    return _ensure_chat(chat_id)
+
+def set_chat_shard_count(chat_id: int, shard_count: int):
+    """
+    Sets how many shard documents a chat's watermark and counters are spread over.
+    Safe to change at any time: readers aggregate every existing shard.
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+        shard_count (int): The number of shards (1 for quiet chats, more for busy groups).
+
+    Returns:
+        None
+    """
+    _ensure_chat(chat_id)
+    chats.document(str(chat_id)).update({'shard_count': shard_count})
+    _remember_shards(str(chat_id), shard_count)
+    logger.info(f"Set shard count of chat {chat_id} to {shard_count}.")
+
+def _records_fields(records, exact: bool = False):
+    """
+    Returns the update of a user document's 'records' map (see utils/records.py).
+
+    Parameters:
+        records (UserRecords): The user's records, including the roll being written.
+        exact (bool): True to replace the stored records (rebuilt from the chat's messages),
+                      False to merge them with Maximum / Minimum transforms.
+    """
+    doc = records.to_doc()
+    if exact:
+        # Also drops the unbounded arrays of the previous format
+        fields = {field: doc.get(field, firestore.DELETE_FIELD) for field in RECORD_DOC_FIELDS + ('nice_days', 'hundred_ts')}
+        fields['utc_offset'] = RECORDS_UTC_OFFSET_HOURS
+        return fields
+    return {field: firestore.Minimum(value) if field == 'first_zero' else firestore.Maximum(value)
+            for field, value in doc.items()}
+
+# Messages older than a few months are compacted into chats/{chat_id}/archives (see utils/archive.py).
+# The chat document tracks the compaction horizon (archived_until: archives with end <= it are
+# visible) and an archive_generation counter bumped by every compaction write, which lets
+# readers notice a compaction that ran while they were streaming.
+def _archive_state(chat_ref):
+    chat_doc = chat_ref.get()
+    data = chat_doc.to_dict() if chat_doc.exists else {}
+    return data.get('archived_until', 0), data.get('archive_generation', 0)
+
+def _visible_archives(chat_ref, archived_until: int, since: int = None):
+    if not archived_until:
+        return
+    query = chat_ref.collection("archives").where('end', '<=', archived_until)
+    if since is not None:
+        query = query.where('end', '>', since)
+    for doc in query.stream():
+        yield doc.id, doc.to_dict()
+
+def _straggler_filter(chat_ref, archived_until: int):
+    """
+    Returns a function telling whether a raw message below the archive horizon is already archived
+    (raw documents outlive their archive for a moment during compaction, and a backfill can re-add them).
+    """
+    archived_ids = {}  # month -> set of archived message ids, loaded on first use
+
+    def is_archived(message_id: str, timestamp: int):
+        if timestamp >= archived_until:
+            return False
+        month = month_key(timestamp)
+        ids = archived_ids.get(month)
+        if ids is None:
+            ids = archived_ids[month] = set()
+            for doc in chat_ref.collection("archives").where('month', '==', month).stream():
+                ids |= archived_message_ids(doc.to_dict())
+        try:
+            return int(message_id) in ids
+        except ValueError:
+            return False
+
+    return is_archived
+
+def _iter_messages(chat_ref, raw_query, since: int = None, keep=None):
+    """
+    Streams a chat's archived and raw messages, each message exactly once, even while
+    a compaction is running.
+
+    Parameters:
+        chat_ref:            The chat document reference.
+        raw_query:           Query over the chat's "messages" subcollection (may filter server-side).
+        since (int):         Optional, only yield messages with timestamp >= since.
+        keep (callable):     Optional keep(user_id, percentage) filter for archived messages,
+                             matching the filters of raw_query.
+
+    Yields:
+        tuple: (message_id, user_id, percentage, timestamp)
+    """
+    def archived_rows(data, skip_ids=()):
+        for row in unpack_archive(data):
+            if (since is None or row[3] >= since) and (keep is None or keep(row[1], row[2])) and row[0] not in skip_ids:
+                yield row
+
+    archived_until, generation = _archive_state(chat_ref)
+    seen_archives = set()
+    for doc_id, data in _visible_archives(chat_ref, archived_until, since):
+        seen_archives.add(doc_id)
+        yield from archived_rows(data)
+
+    is_archived = _straggler_filter(chat_ref, archived_until)
+    raw_ids = set()
+    for doc in raw_query.stream():
+        message = doc.to_dict()
+        timestamp = message.get('timestamp', 0)
+        if is_archived(doc.id, timestamp):
+            continue
+        if doc.id.lstrip('-').isdigit():
+            raw_ids.add(int(doc.id))
+        yield doc.id, message.get('user_id'), message.get('percentage', -1), timestamp
+
+    # A compaction archived (and possibly deleted) messages while we streamed: pick up
+    # its new archives, minus the messages already read raw
+    archived_until, new_generation = _archive_state(chat_ref)
+    if new_generation != generation:
+        for doc_id, data in _visible_archives(chat_ref, archived_until, since):
+            if doc_id not in seen_archives:
+                yield from archived_rows(data, raw_ids)
+
 # NEED TO ADD "MESSAGE_ID" INPUT TO log_stats FUNCTION CALLED
-def log_stat(chat_id: int, message_id: int, user_id: str, username: str, name: str, percent: int, timestamp: int):
+def log_stat(chat_id: int, message_id: int, user_id: str, username: str, name: str, percent: int, timestamp: int,
+             records=None, exact_records: bool = False, extra_writes=()):
     """
     Adds a message document to the "messages" subcollection of a chat document in Firestore.
 
@@ -40,70 +261,85 @@ def log_stat(chat_id: int, message_id: int, user_id: str, username: str, name: s
         name (str):         The name of the user who sent the message.
         percent (int):      The percentage of gayness to log.
         timestamp (int):    The timestamp of the message in seconds since epoch (Unix timestamp).
+        records (UserRecords): The user's records including this roll, if any (see _records_fields).
+        exact_records (bool):  True if the records were rebuilt and replace the stored ones.
+        extra_writes (list):   (document reference, data) pairs merged in the same batch, such as
+                               the global board's (see utils/globalboard.py global_board_writes).
 
     Returns:
         None
+
+    Raises:
+        Exception: If the write fails, so spooled stats can be retried.
     """
     try:
-        # Get chat reference
+        # Get chat reference (creates the chat document on first use)
+        _ensure_chat(chat_id)
         chat_ref = chats.document(str(chat_id))
-        # if chat document reference does not exist, create document
-        if not chat_ref.get().exists:
-            chats.document(str(chat_id)).set({
-                'chat_id': chat_id,
-            })
 
-        # Get chat's messages collection reference
-        messages_ref = chat_ref.collection("messages")
+        # One atomic batch: a failed write leaves nothing behind, so a retry neither drops
+        # the stat nor counts it twice (see bot/ingest.py apply_stat)
+        batch = db.batch()
 
         # Log message
-        messages_ref.document(str(message_id)).set({
+        batch.set(chat_ref.collection("messages").document(str(message_id)), {
             'user_id': user_id,
             'percentage': percent,
             'timestamp': timestamp
         })
 
-        # Upsert user info
-        # Check if user already exists
-        # if exists: check for last_update field and update if necessary
-        user_ref = chat_ref.collection("users").document(str(user_id))
-        user_doc = user_ref.get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            # Update user info if necessary
-            if user_data.get('username') != user_id:
-                user_ref.update({ 'username': username })
-            if user_data.get('name') != user_id:
-                user_ref.update({ 'name': name })
-            # Update last_update if the new timestamp is greater
-            if timestamp > user_data.get('last_update', 0): 
-                user_ref.update({ 'last_update': timestamp })
-        else:
-            # Insert new document with last_update field
-            user_ref.set({
-                'username': username,
-                'name': name,
-                'last_update': timestamp,
-            })
+        # Advance the chat watermark and message counter on one random shard
+        batch.set(_shard_ref(chat_id), {
+            'last_update': firestore.Maximum(timestamp),
+            'message_count': firestore.Increment(1),
+        }, merge=True)
+
+        # Upsert user info; last_update only moves forward
+        user_data = {
+            'username': username,
+            'name': name,
+            'last_update': firestore.Maximum(timestamp),
+        }
+        # Streaks and records: a few running aggregates that only grow
+        if records is not None:
+            fields = _records_fields(records, exact_records)
+            if fields:
+                user_data['records'] = fields
+        batch.set(chat_ref.collection("users").document(str(user_id)), user_data, merge=True)
+
+        for ref, data in extra_writes:
+            batch.set(ref, data, merge=True)
+
+        # Before commit: the shard listener may fire before this returns
+        key = str(chat_id)
+        _own_watermarks[key] = max(_own_watermarks.get(key, 0), timestamp)
+        batch.commit()
+        _raise_watermark(key, timestamp)
 
         logger.info(f"Logged message for user {user_id} in chat {chat_id} with percentage {percent}.")
     except Exception as e:
         logger.error(f"Failed to log message: {e}")
+        raise
 
-def bulk_log_stat(chat_id: int, messages: list, users: list):
+def bulk_log_stat(chat_id: int, messages: list, users: list, bump_generation: bool = True):
     """
     Adds multiple messages to the "messages" subcollection of a chat document in Firestore.
     Adds multiple users to the "users" subcollection of a chat document in Firestore.
+
+    The messages may be older than the chat's watermark, which no cached copy of the chat
+    (snapshot, other instances) would fetch: afterwards the chat's history generation is
+    bumped, so they rehydrate it in full. Callers writing one chat in many chunks can pass
+    bump_generation=False and call bump_history_generation once at the end.
     """
+    _ensure_chat(chat_id)
     chat_ref = chats.document(str(chat_id))
-    # if chat document reference does not exist, create document
-    if not chat_ref.get().exists:
-        chats.document(str(chat_id)).set({
-            'chat_id': chat_id,
-        })
 
     
     operations = []
+    # Running records cannot take older rolls: drop their offset so the next live stat of each
+    # user rebuilds them from the chat's messages (see bot/ingest.py apply_stat)
+    stale_records = {'records': {'utc_offset': firestore.DELETE_FIELD}}
+    record_users = set()
     # process messages
     for message in messages:
         message_id = message.get('message_id')
@@ -112,6 +348,7 @@ def bulk_log_stat(chat_id: int, messages: list, users: list):
         timestamp = message.get('timestamp', 0)
 
         msg_ref = chat_ref.collection("messages").document(str(message_id))
+        record_users.add(user_id)
 
         operations.append(('set', msg_ref, {
             'user_id': user_id,
@@ -127,11 +364,21 @@ def bulk_log_stat(chat_id: int, messages: list, users: list):
         last_update = user.get('last_update', 0)
 
         user_ref = chat_ref.collection("users").document(str(user_id))
-        operations.append(('set', user_ref, {
+        user_data = {
             'username': username,
             'name': name,
-            'last_update': last_update
-        }, True))
+            # Backfills and migrations may write older history than what is stored
+            'last_update': firestore.Maximum(last_update)
+        }
+        if user_id in record_users:
+            record_users.discard(user_id)
+            user_data.update(stale_records)
+        operations.append(('set', user_ref, user_data, True))
+
+    # Users without an entry in `users` get their records invalidated too
+    for user_id in record_users:
+        user_ref = chat_ref.collection("users").document(str(user_id))
+        operations.append(('set', user_ref, stale_records, True))
 
 
     BATCH_LIMIT = 500
@@ -157,228 +404,122 @@ def bulk_log_stat(chat_id: int, messages: list, users: list):
     except Exception as e:
         logger.error(f"Failed to bulk log messages/users: {e}")
         raise
+    finally:
+        # Even after a failure: earlier batches may have been committed
+        if bump_generation:
+            bump_history_generation(chat_id)
 
-
-def get_user_stats_all(chat_id: int, user_id: str):
-    """"
-    Retrieves a specific user's stats (Occurrences of each percentage) in a chat.
+def bump_history_generation(chat_id: int):
+    """
+    Marks a chat's history as rewritten (messages added behind its watermark), so cached
+    copies of the chat are discarded and hydrated again from scratch.
 
     Parameters:
-        chat_id (int): The ID of the chat to retrieve stats from.
-        user_id (str): The ID of the user to retrieve stats for.
-    
+        chat_id (int): The ID of the chat.
+
     Returns:
-        str: A formatted string of the user's percent counts or an error message.
-    """""
+        None
+    """
     try:
-        # Get chat reference
-        chat_ref = chats.document(str(chat_id))
-        # Check if chat document exists
-        if not chat_ref.get().exists:
-            logger.error(f"Chat with ID {chat_id} does not exist.")
-            return "Chat not found."
-        
-        # Get chat's messages collection reference
-        messages_ref = chat_ref.collection("messages")
-        # Query messages from specified user
-        query = messages_ref.where('user_id', '==', user_id)
-        results = list(query.stream())
-
-        # Check if any results were found
-        if not results:
-            logger.info(f"No messages found for user {user_id} in chat {chat_id}.")
-            return "No stats yet!"
-
-        # Count occurrences of each percentage
-        percent_count = [0] * 101  # Initialize a list for percentages 0-100
-        for doc in results:
-            message = doc.to_dict()
-            percent = message.get('percentage', -1)
-            if 0 <= percent <= 100:
-                percent_count[percent] += 1
-
-        # Format the output
-        logger.info(f"Retrieved percent counts for user {user_id} in chat {chat_id}.")
-        return "\n".join([f"{p}% Gay: {percent_count[p]} times" for p in range(101)]) 
+        chats.document(str(chat_id)).set({'history_generation': firestore.Increment(1)}, merge=True)
+        logger.info(f"Bumped history generation of chat {chat_id}.")
     except Exception as e:
-        logger.error(f"Failed to retrieve user percent counts: {e}")
-        return "Error retrieving stats."
+        logger.error(f"Failed to bump history generation of chat {chat_id}: {e}")
 
-def get_user_stats_nice(chat_id: int, user_id: str):
+def get_history_generation(chat_id: int):
     """
-    Retrieves a specific user's nice stats (Occurrence of specific "nice" percentage) in a chat.
+    Retrieves the history generation of a chat (see bump_history_generation).
 
     Parameters:
-        chat_id (int): The ID of the chat to retrieve stats from.
-        user_id (str): The ID of the user to retrieve stats for.
+        chat_id (int): The ID of the chat.
 
     Returns:
-        str: A formatted string of the user's nice percent counts or an error message.
+        int: The generation, 0 if the chat's history was never rewritten.
     """
-    nice_percentages = {
-        100: "💯 100% GAY 👨‍❤️‍💋‍👨",
-        88:  "🐉 88% Huat Gay 🍀",
-        69:  "☯️ 69% Gay 👯",
-        0:   "🙅‍♂️ 0% Gay 🚫"
-    }
+    chat_doc = chats.document(str(chat_id)).get()
+    return chat_doc.to_dict().get('history_generation', 0) if chat_doc.exists else 0
 
-    try:
-        # Get chat reference
-        chat_ref = chats.document(str(chat_id))
-        if not chat_ref.get().exists:
-            logger.error(f"Chat with ID {chat_id} does not exist.")
-            return "Chat not found."
-        
-        # Get chat's messages collection reference
-        messages_ref = chat_ref.collection("messages")
-        # Query messages from specified user wih nice percentages
-        query = messages_ref.where('user_id', '==', user_id).where('percentage', 'in', [0, 69, 88, 100])
-        results = query.stream()
-
-        # Check if any results were found
-        if not results:
-            logger.info(f"No nice stats found for user {user_id} in chat {chat_id}.")
-            return "No nice stats yet!"
-      
-
-        # Count occurrences of each percentage and latest timestamp
-        percent_count = defaultdict(int)  # Initialize a dictionary
-        latest_timestamps = defaultdict(int)  # To track latest timestamp for each percentage
-        for doc in results:
-            message = doc.to_dict()
-            percent = message.get('percentage', -1)
-
-            # Only count if the percentage is one of the nice percentages
-            if percent in nice_percentages:
-                percent_count[percent] += 1 # increment count for this percentage
-
-                # Update the latest timestamp for this percentage (Only for nice percentages)
-                timestamp = message.get('timestamp', 0)
-                if timestamp > latest_timestamps[percent]:
-                    latest_timestamps[percent] = timestamp
-
-        # Format the output
-        output = []
-        for target_percent in sorted(nice_percentages.keys(), reverse=True):
-            if target_percent in percent_count:
-                # Format latest timestamp for display
-                formatted_time = datetime.fromtimestamp(latest_timestamps[target_percent]).strftime('%Y-%m-%d %H:%M')
-                output.append(
-                        f"{nice_percentages[target_percent]}\n→ {percent_count[target_percent]} times (last on {formatted_time})"
-                    )
-
-        return "\n\n".join(output)
-    except Exception as e:
-        logger.error(f"Failed to retrieve user nice percent counts: {e}")
-        return "Error retrieving nice stats."
-        
-def get_leaderboard(chat_id: int):
+
+def get_last_update(chat_id: int):
     """
-    Retrieves the leaderboard for a chat
+    Retrieves the last update timestamp for a specific chat (the max over its shards).
 
     Parameters:
-        chat_id (int): The ID of the chat to retrieve the leaderboard for.
+        chat_id (int): The ID of the chat to retrieve the last update for.
 
     Returns:
-        str: A formatted string of the leaderboard or an error message.
-    """
-    leaderboard_percents = {
-        100: "💯The Great Gays 👨‍❤️‍💋‍👨100%",
-        88: "🐉 88% Huat Gays 🍀",
-        69: "☯️ 69 Gays 👯",
-        0:  "🙅‍♂️ 0% Gays 🚫",
-    }
-    
+        int: The last update timestamp in seconds since epoch, or 0 if not found.
+    """
     try:
-        # Get chat reference
-        chat_ref = chats.document(str(chat_id))
-        if not chat_ref.get().exists:
-            logger.error(f"Chat with ID {chat_id} does not exist.")
-            return "Chat not found."
-        
-        # Get chat's messages collection reference
-        messages_ref = chat_ref.collection("messages")
-        # Aggregate counts of each percentage
-        query = messages_ref.where('percentage', 'in', list(leaderboard_percents.keys()))
-        results = query.stream()
-
-        leaderboard = defaultdict(lambda: defaultdict(int))  # percentage -> user_id -> count
-        relevant_users = set()  # To track users who have contributed to the leaderboard
-        # Count occurrences of each user for each specific % category
-        for doc in results:
-            message = doc.to_dict()
-            user_id = message.get('user_id')
-            percent = message.get('percentage', -1)
-            if percent in leaderboard_percents:
-                leaderboard[percent][user_id] += 1
-                relevant_users.add(user_id)
-
-        # Get chats' users collection reference
-        users_ref = chat_ref.collection("users")
-        user_dict = {}  # To store user data for formatting
-        for user_id in relevant_users:
-            user_doc = users_ref.document(str(user_id)).get()
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                username = user_data.get('username', '')
-                name = user_data.get('name', '')
-
-                # Use username if available, otherwise use name
-                user_dict[user_id] = username if username else (name if name else 'Unknown')
-
-        # Format the output
-        output = []
-        for percent in sorted(leaderboard_percents.keys(), reverse=True):
-            users = leaderboard[percent]
-            if users:
-                # Append the header for this percentage
-                output.append(leaderboard_percents[percent])
-
-                # Sort users by their count in descending order
-                # Append each user and their count
-                for user_id in sorted(users.keys(), key=lambda uid: users[uid], reverse=True):
-                    output.append(
-                        f"@{user_dict.get(user_id, 'Unknown')} x{users[user_id]}"
-                        )
-                output.append("")
-
-        if not output:
-            logger.info(f"No leaderboard entries found for chat {chat_id}.")
-            return "No leaderboard yet! Use @HowGayBot to start contributing your stats."
-        
-        # Compose output
-        return "\n".join(output)
-
+        return _read_last_update(chat_id)
     except Exception as e:
-        logger.error(f"Failed to retrieve leaderboard: {e}")
-        return "Error retrieving leaderboard."
+        logger.error(f"Failed to retrieve last update: {e}")
+        return 0
 
-def get_last_update(chat_id: int):
+def _read_last_update(chat_id: int):
+    chat_ref = chats.document(str(chat_id))
+    shards = [shard.to_dict() for shard in chat_ref.collection("shards").stream()]
+    if shards:
+        return max(shard.get('last_update', 0) for shard in shards)
+
+    # Chats written before sharding keep the watermark on the chat document
+    chat_doc = chat_ref.get()
+    if not chat_doc.exists:
+        logger.error(f"Chat with ID {chat_id} does not exist.")
+        return 0
+    return chat_doc.to_dict().get('last_update', 0)
+
+def get_cached_last_update(chat_id: int):
     """
-    Retrieves the last update timestamp for a specific chat.
+    Retrieves the watermark of a chat like get_last_update, reusing it for CHAT_CACHE_TTL_SECONDS
+    (raised in between by this process's own writes and, with CACHE_COHERENCE, by listeners).
 
     Parameters:
-        chat_id (int): The ID of the chat to retrieve the last update for.
+        chat_id (int): The ID of the chat.
 
     Returns:
         int: The last update timestamp in seconds since epoch, or 0 if not found.
+
+    Raises:
+        Exception: If the read fails, so spooled stats can be retried.
+    """
+    key = str(chat_id)
+    cached = _watermarks.get(key)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    last_update = _read_last_update(chat_id)
+    _raise_watermark(key, last_update, refresh=True)
+    return last_update
+
+def get_own_last_update(chat_id: int):
+    """
+    Returns the latest message timestamp this process logged in a chat (see log_stat), or 0.
+    A watermark no newer than it may come from this process's own writes.
+    """
+    return _own_watermarks.get(str(chat_id), 0)
+
+def get_message_count(chat_id: int):
+    """
+    Retrieves the number of messages logged live in a chat (the sum over its shards).
+    Backfilled messages are not counted.
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+
+    Returns:
+        int: The number of logged messages, or 0 if not found.
     """
     try:
-        chat_ref = chats.document(str(chat_id))
-        if not chat_ref.get().exists:
-            logger.error(f"Chat with ID {chat_id} does not exist.")
-            return 0
-        
-        # Get the last_update field from the chat document
-        last_update = chat_ref.get().to_dict().get('last_update', 0)
-        return last_update
+        shards = chats.document(str(chat_id)).collection("shards").stream()
+        return sum(shard.to_dict().get('message_count', 0) for shard in shards)
     except Exception as e:
-        logger.error(f"Failed to retrieve last update: {e}")
+        logger.error(f"Failed to retrieve message count: {e}")
         return 0
     
 def update_last_timestamp(chat_id: int, timestamp: int):
     """
-    Updates the last update timestamp for a specific chat.
+    Updates the last update timestamp for a specific chat, on one of its shards.
+    The watermark never moves backwards.
 
     Parameters:
         chat_id (int): The ID of the chat to update.
@@ -388,13 +529,7 @@ def update_last_timestamp(chat_id: int, timestamp: int):
         None
     """
     try:
-        chat_ref = chats.document(str(chat_id))
-        if not chat_ref.get().exists:
-            logger.error(f"Chat with ID {chat_id} does not exist. Creating new chat document.")
-            chats.document(str(chat_id)).set({'chat_id': chat_id})
-
-        # Update the last_update field
-        chat_ref.update({'last_update': timestamp})
+        _shard_ref(chat_id).set({'last_update': firestore.Maximum(timestamp)}, merge=True)
         logger.info(f"Updated last timestamp for chat {chat_id} to {timestamp}.")
     except Exception as e:
         logger.error(f"Failed to update last timestamp: {e}")
@@ -424,114 +559,339 @@ def delete_chat_data(chat_id: int):
             for user in users:
                 user.reference.delete()
 
+            for shard in chat_ref.collection("shards").stream():
+                shard.reference.delete()
+
+            for archive in chat_ref.collection("archives").stream():
+                archive.reference.delete()
+
             # Finally, delete the chat document itself
             chat_ref.delete()
+            forget_chat(chat_id)
             logger.info(f"Deleted data for chat {chat_id}.")
         else:
             logger.warning(f"Chat with ID {chat_id} does not exist. No data to delete.")
     except Exception as e:
         logger.error(f"Failed to delete chat data: {e}")
 
-# CHANGE THIS TO GET FROM SPECIFIC CHAT(?)
-def get_chat_stats_all():
+def get_chat_messages(chat_id: int, since: int = None):
     """
-    Retrieves all messages for all chats
+    Streams the (user_id, percentage, timestamp) fields of every message in a chat,
+    archived months included.
+
+    Only the three fields are requested from Firestore (field projection), so the
+    returned snapshots stay small even for chats with millions of messages.
 
     Parameters:
-        None
+        chat_id (int): The ID of the chat to stream messages from.
+        since (int):   Optional, only stream messages with timestamp >= since.
+
+    Yields:
+        tuple: (user_id, percentage, timestamp) for each message in the chat.
+    """
+    chat_ref = chats.document(str(chat_id))
+    query = chat_ref.collection("messages").select(['user_id', 'percentage', 'timestamp'])
+    if since is not None:
+        query = query.where('timestamp', '>=', since)
+    for _, user_id, percent, timestamp in _iter_messages(chat_ref, query, since):
+        yield user_id, percent, timestamp
+
+def get_chat_users(chat_id: int):
+    """
+    Retrieves the user documents of a chat.
+
+    Parameters:
+        chat_id (int): The ID of the chat to retrieve users from.
 
     Returns:
-        str: A formatted string of all chat stats or an error message.
+        dict: user_id (str) -> user data (username, name, last_update).
     """
-    try:
-        all_chats = chats.stream()
-        if not all_chats:
-            logger.info("No stats found in any chat.")
-            return "No stats yet!"
-
-        output = []
-        for chat in all_chats:
-            chat_id = chat.id
-            messages_ref = chat.collection("messages")
-            messages = messages_ref.stream()
+    users_ref = chats.document(str(chat_id)).collection("users")
+    return {user.id: user.to_dict() for user in users_ref.stream()}
+
+def _compact_month(chat_ref, month: str, docs: list):
+    archives_ref = chat_ref.collection("archives")
+
+    # Months archived before (a backfill added older rolls) get extra parts
+    existing_ids, next_part = set(), 0
+    for doc in archives_ref.where('month', '==', month).stream():
+        data = doc.to_dict()
+        existing_ids |= archived_message_ids(data)
+        next_part = max(next_part, data['part'] + 1)
+
+    rows, refs = [], []
+    for doc in docs:
+        message = doc.to_dict()
+        percent, timestamp = message.get('percentage', -1), message.get('timestamp', 0)
+        packable = (doc.id.lstrip('-').isdigit() and isinstance(percent, int) and 0 <= percent <= 100
+                    and isinstance(timestamp, int) and 0 <= timestamp < 2 ** 32)
+        if not packable:
+            continue  # Stays a raw document
+        refs.append(doc.reference)
+        if int(doc.id) not in existing_ids:
+            rows.append((int(doc.id), message.get('user_id'), percent, timestamp))
+
+    # 1. Write the archives, 2. move the horizon so readers use them, 3. delete the raw documents
+    for doc_id, data in pack_archive_parts(month, rows, next_part):
+        archives_ref.document(doc_id).set(data)
+    _, end = month_bounds(month)
+    chat_ref.set({
+        'archived_until': firestore.Maximum(end),
+        'archive_generation': firestore.Increment(1),
+    }, merge=True)
 
-            for message in messages:
-                msg_data = message.to_dict()
-                user_id = msg_data.get('user_id', 'Unknown')
-                percent = msg_data.get('percentage', -1)
-                timestamp = msg_data.get('timestamp', 0)
-                output.append(f"Chat: {chat_id}, User: {user_id}, Percentage: {percent}, Timestamp: {timestamp}")
+    BATCH_LIMIT = 500
+    for i in range(0, len(refs), BATCH_LIMIT):
+        batch = db.batch()
+        for ref in refs[i:i + BATCH_LIMIT]:
+            batch.delete(ref)
+        batch.commit()
+    return len(refs)
+
+def compact_chat(chat_id: int, before: int):
+    """
+    Rolls the raw message documents of a chat older than `before` into monthly archive
+    documents and deletes them. Month by month, so memory holds at most one month.
 
-        return "\n".join(output)
+    Parameters:
+        chat_id (int): The ID of the chat to compact.
+        before (int):  Compact messages with timestamp < before; must be the start of a month.
 
-    except Exception as e:
-        logger.error(f"Failed to retrieve all stats: {e}")
-        return "Error retrieving stats."
+    Returns:
+        int: The number of raw message documents compacted.
+    """
+    chat_ref = chats.document(str(chat_id))
+    messages_ref = chat_ref.collection("messages")
+    fields = ['user_id', 'percentage', 'timestamp']
+    compacted = 0
+    cursor = None
+    while True:
+        query = messages_ref.where('timestamp', '<', before)
+        if cursor is not None:
+            query = query.where('timestamp', '>=', cursor)
+        oldest = list(query.order_by('timestamp').limit(1).select(fields).stream())
+        if not oldest:
+            break
+        month = month_key(oldest[0].to_dict().get('timestamp', 0))
+        start, end = month_bounds(month)
+        docs = list(messages_ref.where('timestamp', '>=', start).where('timestamp', '<', end).select(fields).stream())
+        compacted += _compact_month(chat_ref, month, docs)
+        cursor = end  # Unpackable documents stay behind, continue with the next month
+    if compacted:
+        logger.info(f"Compacted {compacted} messages of chat {chat_id} into archives.")
+    return compacted
+
+def compact_all_chats(before: int):
+    """
+    Compacts the raw messages older than `before` of every chat (see compact_chat).
 
-# CHANGE THIS TO GET FROM SPECIFIC CHAT(?)
-def get_users_all():
+    Returns:
+        int: The total number of raw message documents compacted.
+    """
+    total = 0
+    for chat in chats.select([]).stream():
+        try:
+            total += compact_chat(chat.id, before)
+        except Exception as e:
+            # Leaves the chat as it is (raw + already written archives stay consistent), retried next run
+            logger.error(f"Failed to compact chat {chat.id}: {e}")
+    logger.info(f"Compaction done: {total} messages archived.")
+    return total
+
+def watch_chat(chat_id: int, callback):
     """
-    Retrieves all users across all chats.
+    Attaches a real-time listener to a chat document.
 
     Parameters:
-        None
+        chat_id (int): The ID of the chat to watch.
+        callback (callable): Called as callback(data) on every change, where data is the
+                             chat document as a dict, or None if the document was deleted.
+                             Runs on a Firestore background thread.
 
     Returns:
-        str: A formatted string of all users or an error message.
+        Watch: The listener handle, call .unsubscribe() to detach it.
     """
-    try:
-        all_chats = chats.stream()
-        if not all_chats:
-            logger.info("No users found in any chat.")
-            return "No users found!"
-
-        output = []
-        for chat in all_chats:
-            chat_id = chat.id
-            users_ref = chat.collection("users")
-            users = users_ref.stream()
+    def on_snapshot(doc_snapshots, changes, read_time):
+        for doc in doc_snapshots:
+            data = doc.to_dict() if doc.exists else None
+            if data is not None:
+                # A /shards change made on another instance
+                _remember_shards(str(chat_id), data.get('shard_count', DEFAULT_CHAT_SHARDS))
+            callback(data)
 
-            for user in users:
-                user_data = user.to_dict()
-                username = user_data.get('username', 'UNKNOWN')
-                name = user_data.get('name', 'UNKNOWN')
-                output.append(f"Chat: {chat_id}, User ID: {user.id}, Username: {username}, Name: {name}")
+    return chats.document(str(chat_id)).on_snapshot(on_snapshot)
 
-        return "\n".join(output)
+def watch_chat_shards(chat_id: int, callback):
+    """
+    Attaches a real-time listener to the watermark shards of a chat.
 
-    except Exception as e:
-        logger.error(f"Failed to retrieve all users: {e}")
-        return "Error retrieving users."
-    
-# NEW
-def get_user_last_update(chat_id: int, user_id: str):
+    Parameters:
+        chat_id (int): The ID of the chat to watch.
+        callback (callable): Called as callback(last_update) with the max watermark over all
+                             shards whenever one changes. Runs on a Firestore background thread.
+
+    Returns:
+        Watch: The listener handle, call .unsubscribe() to detach it.
     """
-    Retrieves the last update timestamp for a specific user in a chat.
+    def on_snapshot(col_snapshot, changes, read_time):
+        last_update = max((doc.to_dict().get('last_update', 0) for doc in col_snapshot), default=0)
+        _raise_watermark(str(chat_id), last_update)
+        callback(last_update)
+
+    return chats.document(str(chat_id)).collection("shards").on_snapshot(on_snapshot)
+
+def watch_chat_users(chat_id: int, callback):
+    """
+    Attaches a real-time listener to the "users" subcollection of a chat.
 
     Parameters:
-        chat_id (int): The ID of the chat to retrieve the last update for.
-        user_id (str): The ID of the user to retrieve the last update for.
+        chat_id (int): The ID of the chat to watch.
+        callback (callable): Called as callback(user_key, data) for every added or modified
+                             user document. Runs on a Firestore background thread.
 
     Returns:
-        int: The last update timestamp in seconds since epoch, or 0 if not found.
+        Watch: The listener handle, call .unsubscribe() to detach it.
     """
-    try:
-        # Get chat reference
-        chat_ref = chats.document(str(chat_id))
-        if not chat_ref.get().exists:
-            logger.error(f"Chat with ID {chat_id} does not exist.")
-            return 0
-        
-        # Get user's document reference
-        user_ref = chat_ref.collection("users").document(str(user_id))
-        user_doc = user_ref.get()
+    def on_snapshot(col_snapshot, changes, read_time):
+        for change in changes:
+            if change.type.name in ('ADDED', 'MODIFIED'):
+                callback(change.document.id, change.document.to_dict())
 
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            return user_data.get('last_update', 0)
-        else:
-            logger.warning(f"User {user_id} does not exist in chat {chat_id}.")
-            return 0
-    except Exception as e:
-        logger.error(f"Failed to retrieve last update: {e}")
-        return 0
\ No newline at end of file
+    return chats.document(str(chat_id)).collection("users").on_snapshot(on_snapshot)
+
+def iter_collection_group(collection_id: str, fields: list, page_size: int = 1000, start_after: str = None):
+    """
+    Streams every document of a collection group (e.g. all "messages" of all chats),
+    page by page, requesting only the given fields.
+
+    Only one page of snapshots is held in memory at a time, so memory use does not
+    grow with the dataset.
+
+    Parameters:
+        collection_id (str): The subcollection name, e.g. "messages" or "users".
+        fields (list):       The document fields to retrieve (field projection).
+        page_size (int):     The number of documents fetched per request.
+        start_after (str):   Optional document path to resume after, e.g. "chats/1/messages/42".
+
+    Yields:
+        tuple: (chat_id, document_id, data) for each document.
+    """
+    query = (
+        db.collection_group(collection_id)
+        .select(fields)
+        .order_by(firestore.FieldPath.document_id())
+        .limit(page_size)
+    )
+    # A path cursor works even if that document was deleted since
+    last_doc = {firestore.FieldPath.document_id(): db.document(start_after)} if start_after else None
+    while True:
+        page = query.start_after(last_doc) if last_doc is not None else query
+        docs = list(page.stream())
+        for doc in docs:
+            # chats/{chat_id}/{collection_id}/{document_id}
+            yield doc.reference.parent.parent.id, doc.id, doc.to_dict()
+
+        if len(docs) < page_size:
+            break
+        last_doc = docs[-1]
+
+def iter_message_rows(page_size: int = 1000, start_after: str = None, raw: bool = True, archives: bool = True):
+    """
+    Streams all messages of all chats as flat rows, archived months included.
+
+    Raw messages are read first and archives after, so a message compacted while the
+    export runs may be exported twice, but never goes missing.
+
+    Parameters:
+        page_size (int):   The number of raw messages fetched per request.
+        start_after (str): Optional raw message path to resume the raw pass after.
+        raw (bool):        Stream the raw messages.
+        archives (bool):   Stream the archived messages.
+
+    Yields:
+        dict: chat_id, message_id, user_id, percentage, timestamp
+    """
+    archive_states = {}  # chat_id -> (archived_until, straggler filter), read once per chat
+    def archive_state(chat_id):
+        if chat_id not in archive_states:
+            chat_ref = chats.document(chat_id)
+            archived_until, _ = _archive_state(chat_ref)
+            archive_states[chat_id] = (archived_until, _straggler_filter(chat_ref, archived_until))
+        return archive_states[chat_id]
+
+    raw_rows = iter_collection_group("messages", ['user_id', 'percentage', 'timestamp'], page_size, start_after) if raw else ()
+    for chat_id, message_id, data in raw_rows:
+        timestamp = data.get('timestamp', 0)
+        if archive_state(chat_id)[1](message_id, timestamp):
+            continue
+        yield {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'user_id': data.get('user_id', 'Unknown'),
+            'percentage': data.get('percentage', -1),
+            'timestamp': timestamp,
+        }
+
+    if not archives:
+        return
+    # Horizons are re-read now, so archives written during the raw pass are included
+    archive_states.clear()
+    # Archive documents are up to ~1 MiB each: fetch a few per page
+    archive_fields = ['end', 'user_ids', 'message_ids', 'user_index', 'percentages', 'timestamps']
+    for chat_id, _, data in iter_collection_group("archives", archive_fields, page_size=8):
+        if data['end'] > archive_state(chat_id)[0]:
+            continue  # Not visible yet: its messages are still raw
+        for message_id, user_id, percent, timestamp in unpack_archive(data):
+            yield {
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'user_id': user_id,
+                'percentage': percent,
+                'timestamp': timestamp,
+            }
+
+def iter_user_rows(page_size: int = 1000):
+    """
+    Streams all users of all chats as flat rows.
+
+    Yields:
+        dict: chat_id, user_id, username, name, last_update
+    """
+    for chat_id, user_id, data in iter_collection_group("users", ['username', 'name', 'last_update'], page_size):
+        yield {
+            'chat_id': chat_id,
+            'user_id': user_id,
+            'username': data.get('username', 'UNKNOWN'),
+            'name': data.get('name', 'UNKNOWN'),
+            'last_update': data.get('last_update', 0),
+        }
+
+def message_exists(chat_id: int, message_id: int):
+    """
+    Checks whether a message was already logged (its document exists) in a chat.
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+        message_id (int): The ID of the message.
+
+    Returns:
+        bool: True if the message document exists.
+    """
+    return chats.document(str(chat_id)).collection("messages").document(str(message_id)).get().exists
+
+def get_user_doc(chat_id: int, user_id: str):
+    """
+    Retrieves a user's document in a chat (one read).
+
+    Parameters:
+        chat_id (int): The ID of the chat.
+        user_id (str): The ID of the user.
+
+    Returns:
+        dict: The document data, or {} if the user has none.
+
+    Raises:
+        Exception: If the read fails, so spooled stats can be retried.
+    """
+    user_doc = chats.document(str(chat_id)).collection("users").document(str(user_id)).get()
+    return user_doc.to_dict() if user_doc.exists else {}
@@ -0,0 +1,255 @@
+## Module that serves the cross-chat leaderboard (/globalboard) from a few small documents
+## Every user's totals live in their own "global_users" document, incremented in the same batch
+## as the logged stat (see global_board_writes). What /globalboard reads is bounded: the
+## "global_board" base document holds the GLOBAL_BOARD_CONTENDERS users of each leaderboard
+## percentage with the highest totals at the last reconciliation, and their rolls since are
+## added up on one random shard document. Reading the board is a single query over that
+## collection, whatever the number of users; other users enter it at the next reconciliation.
+## The reconciliation recounts every user with collection-group count aggregations (plus the
+## per-user summaries of archived months, a bounded number of users at a time), corrects the
+## per-user totals and rewrites the base.
+import os
+import time
+import random
+import heapq
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition
+from utils.firestore import db, chats, iter_collection_group, LEADERBOARD_PERCENTAGES
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Rolls of the contenders are added up on N docs (Firestore sustains ~1 write/s per doc)
+GLOBAL_BOARD_SHARDS = int(os.getenv("GLOBAL_BOARD_SHARDS", "8"))
+# Users recounted at once by the reconciliation (each takes up to 5 count aggregations)
+GLOBAL_BOARD_RECONCILE_WORKERS = int(os.getenv("GLOBAL_BOARD_RECONCILE_WORKERS", "8"))
+GLOBAL_BOARD_SIZE = 10
+# Users of each percentage followed between reconciliations, so the board can reorder
+GLOBAL_BOARD_CONTENDERS = 2 * GLOBAL_BOARD_SIZE
+CONTENDERS_TTL_SECONDS = 300  # How long the contenders are reused before reading the base again
+BATCH_LIMIT = 500
+
+board = db.collection("global_board")
+global_users = db.collection("global_users")
+
+# percent -> user keys on the base document, refreshed every CONTENDERS_TTL_SECONDS
+_contenders = {}
+_contenders_at = None
+
+def _user_key(user_id):
+    return str(user_id)
+
+def _is_contender(key: str, percent: int):
+    global _contenders, _contenders_at
+    if _contenders_at is None or time.monotonic() - _contenders_at > CONTENDERS_TTL_SECONDS:
+        base = board.document("base").get()
+        top = base.to_dict().get('top', {}) if base.exists else {}
+        _contenders = {int(percent): set(entries) for percent, entries in top.items()}
+        _contenders_at = time.monotonic()
+    return key in _contenders.get(percent, ())
+
+def _invalidate_contenders():
+    global _contenders_at
+    _contenders_at = None
+
+def global_board_writes(user_id, display_name: str, percent: int):
+    """
+    Returns the writes adding one roll of a user to the global board, to be committed in the
+    same batch as the stat itself (see utils/firestore.py log_stat), so a failed write is
+    retried from the spool with it and a successful one is never counted twice.
+    No document is read, except the base of the board every CONTENDERS_TTL_SECONDS.
+
+    Parameters:
+        user_id:             The ID of the user.
+        display_name (str):  The username (or name) shown on the board.
+        percent (int):       The rolled percentage.
+
+    Returns:
+        list: (document reference, data) pairs to set with merge=True (none for other percentages).
+    """
+    if percent not in LEADERBOARD_PERCENTAGES:
+        return []
+    key = _user_key(user_id)
+    writes = [(global_users.document(key), {'name': display_name, 'counts': {str(percent): firestore.Increment(1)}})]
+    try:
+        if _is_contender(key, percent):
+            writes.append((board.document(f"shard-{random.randrange(GLOBAL_BOARD_SHARDS)}"), {
+                'top': {str(percent): {key: {'delta': firestore.Increment(1)}}},
+            }))
+    except Exception as e:
+        # The board catches up at the next reconciliation; the user's totals are still counted
+        logger.warning(f"Failed to read global board contenders: {e}")
+    return writes
+
+def _read_board():
+    """
+    Returns (top: percent -> user key -> (count, name), shard documents), adding the rolls
+    counted on the shards since the last reconciliation to the totals of the base.
+    """
+    docs = list(board.stream())
+    top = defaultdict(dict)
+    for doc in docs:
+        if doc.id == "base":
+            for percent, entries in doc.to_dict().get('top', {}).items():
+                for key, entry in entries.items():
+                    top[int(percent)][key] = (entry.get('count', 0), entry.get('name', ''))
+    shards = [doc for doc in docs if doc.id != "base"]
+    for doc in shards:
+        for percent, entries in doc.to_dict().get('top', {}).items():
+            for key, entry in entries.items():
+                # Rolls of users who left the base are in their recounted totals already
+                if key in top[int(percent)]:
+                    count, name = top[int(percent)][key]
+                    top[int(percent)][key] = (count + entry.get('delta', 0), name)
+    return top, shards
+
+def get_global_board():
+    """
+    Retrieves the leaderboard across all chats.
+
+    Returns:
+        str: A formatted string of the global leaderboard or an error message.
+    """
+    try:
+        top, _ = _read_board()
+
+        output = []
+        for percent in sorted(LEADERBOARD_PERCENTAGES.keys(), reverse=True):
+            ranked = sorted(((count, name) for count, name in top[percent].values() if count > 0),
+                            key=lambda entry: entry[0], reverse=True)[:GLOBAL_BOARD_SIZE]
+            if ranked:
+                output.append(LEADERBOARD_PERCENTAGES[percent])
+                for count, name in ranked:
+                    output.append(f"@{name or 'Unknown'} x{count}")
+                output.append("")
+
+        if not output:
+            return "No global leaderboard yet! Use @HowGayBot to start contributing your stats."
+        return "🌏 Global Leaderboard\n\n" + "\n".join(output)
+    except Exception as e:
+        logger.error(f"Failed to retrieve global leaderboard: {e}")
+        return "Error retrieving global leaderboard."
+
+def _count_messages(user_key: str, percentages: list):
+    # Live and backfilled messages store numeric user ids as ints
+    user_id = int(user_key) if user_key.lstrip('-').isdigit() else user_key
+    query = db.collection_group("messages").where('user_id', '==', user_id)
+    if len(percentages) == 1:
+        query = query.where('percentage', '==', percentages[0])
+    else:
+        query = query.where('percentage', 'in', percentages)
+    return query.count().get()[0][0].value
+
+def _count_user(user_key: str):
+    """Returns a user's raw message counts of each leaderboard percentage."""
+    percentages = list(LEADERBOARD_PERCENTAGES)
+    # One aggregation settles the many users without any leaderboard roll
+    if not _count_messages(user_key, percentages):
+        return user_key, {}
+    return user_key, {percent: _count_messages(user_key, [percent]) for percent in percentages}
+
+def _archived_counts():
+    """Sums the per-user summaries of every visible archive (see utils/archive.py)."""
+    totals = defaultdict(lambda: defaultdict(int))
+    horizons = {}  # chat_id -> archived_until
+    for chat_id, _, data in iter_collection_group("archives", ['end', 'nice_counts'], page_size=100):
+        if chat_id not in horizons:
+            chat_doc = chats.document(chat_id).get()
+            horizons[chat_id] = chat_doc.to_dict().get('archived_until', 0) if chat_doc.exists else 0
+        if data.get('end', 0) > horizons[chat_id]:
+            continue  # Not visible yet: its messages are still counted raw
+        for key, by_percent in data.get('nice_counts', {}).items():
+            for percent, count in by_percent.items():
+                totals[key][int(percent)] += count
+    return totals
+
+def reconcile_global_board():
+    """
+    Recomputes exact totals, corrects every user's global totals and rewrites the base of
+    the global board with the contenders of each percentage.
+
+    Totals and shard documents read before counting are what gets corrected or cleared, so
+    increments made while counting are kept (they may be counted twice until the next run).
+
+    Needs a collection-group index on "messages" (user_id ASC, percentage ASC), see README.md.
+
+    Returns:
+        int: The number of users with a leaderboard roll.
+    """
+    _, shards = _read_board()
+
+    # Every user the bot knows of, with a name from their chat user documents
+    previous, names = {}, {}
+    for doc in global_users.stream():
+        data = doc.to_dict()
+        previous[doc.id] = {int(percent): count for percent, count in data.get('counts', {}).items()}
+        names[doc.id] = data.get('name', '')
+    user_keys = set(previous)
+    for _, user_key, data in iter_collection_group("users", ['username', 'name'], page_size=1000):
+        user_keys.add(user_key)
+        names[user_key] = data.get('username') or data.get('name') or names.get(user_key, '')
+
+    totals = _archived_counts()
+    with ThreadPoolExecutor(max_workers=GLOBAL_BOARD_RECONCILE_WORKERS) as pool:
+        for key, counts in pool.map(_count_user, user_keys):
+            for percent, count in counts.items():
+                if count:
+                    totals[key][percent] += count
+
+    # Per-user totals: corrected by the difference, so increments since they were read stay
+    batch, pending = db.batch(), 0
+    for key in user_keys | set(totals):
+        before = previous.get(key, {})
+        corrections = {str(percent): firestore.Increment(totals[key].get(percent, 0) - before.get(percent, 0))
+                       for percent in LEADERBOARD_PERCENTAGES
+                       if totals[key].get(percent, 0) != before.get(percent, 0)}
+        if not corrections:
+            continue
+        batch.set(global_users.document(key), {'name': names.get(key, ''), 'counts': corrections}, merge=True)
+        pending += 1
+        if pending == BATCH_LIMIT:
+            batch.commit()
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+
+    top = {}
+    for percent in LEADERBOARD_PERCENTAGES:
+        ranked = heapq.nlargest(GLOBAL_BOARD_CONTENDERS, ((by_percent[percent], key) for key, by_percent in totals.items()
+                                                          if by_percent.get(percent)))
+        top[str(percent)] = {key: {'count': count, 'name': names.get(key, '')} for count, key in ranked}
+    base = {'top': top, 'reconciled_at': int(time.time())}
+
+    # Rolls added up on the shards before counting are in the base now. One atomic batch, so
+    # readers never see them twice: the shards are dropped unless written since they were read,
+    # otherwise only what was read is taken back
+    batch = db.batch()
+    batch.set(board.document("base"), base)
+    for doc in shards:
+        batch.delete(doc.reference, option=db.write_option(last_update_time=doc.update_time))
+    try:
+        batch.commit()
+    except FailedPrecondition:
+        batch = db.batch()
+        batch.set(board.document("base"), base)
+        for doc in shards:
+            read = {percent: {key: {'delta': firestore.Increment(-entry['delta'])} for key, entry in entries.items() if entry.get('delta')}
+                    for percent, entries in doc.to_dict().get('top', {}).items()}
+            read = {percent: entries for percent, entries in read.items() if entries}
+            if read:
+                batch.set(doc.reference, {'top': read}, merge=True)
+        batch.commit()
+    _invalidate_contenders()
+
+    users = sum(1 for by_percent in totals.values() if any(by_percent.values()))
+    logger.info(f"Reconciled global board: {users} users.")
+    return users
+
+if __name__ == "__main__":
+    # Run once after upgrading from the per-shard totals, so the board and user totals are filled
+    print(f"Reconciled global board: {reconcile_global_board()} users.")
@@ -0,0 +1,196 @@
+#####################################################################################
+# Usage: python -m utils.import_chat_history <export.json|dir> [...] [--chat-id ID] [--backend firestore|sqlite]
+#
+# Bulk-imports Telegram chat exports (e.g. too large for /backfill) straight into the
+# storage backend. Files are parsed in parallel in a process pool, streamed with ijson
+# when it is installed, deduped per user with the bot's 60-second rule (in any order,
+# see utils/dedupe.py) and written with bulk writes, batch by batch.
+####################################################################################
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils.clean_chat_history_json import extract_stat
+from utils.dedupe import StatSorter, dedupe_batches
+
+try:
+    import ijson  # Optional: streaming parser, keeps memory flat on huge exports
+except ImportError:
+    ijson = None
+
+def find_export_files(paths):
+    """Expands directories into the .json files they contain (recursively)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".json"))
+        else:
+            files.append(path)
+    return files
+
+def export_chat_id(chat_type, export_id):
+    """Converts the id of a Telegram export to the chat id the Bot API uses."""
+    if export_id is None:
+        return None
+    if chat_type in ("private_supergroup", "public_supergroup", "private_channel", "public_channel"):
+        return f"-100{export_id}"
+    if chat_type == "private_group":
+        return f"-{export_id}"
+    return str(export_id)
+
+def iter_export_messages(f):
+    """
+    Streams the messages of an export opened in binary mode, with ijson when it is installed
+    (else the whole export is parsed at once).
+
+    Returns:
+        iterator: The export's messages.
+    """
+    if ijson is None:
+        return iter(json.load(f).get("messages", []))
+    return ijson.items(f, "messages.item", use_float=True)
+
+def iter_export(path):
+    """
+    Streams the messages of an export file.
+
+    Returns:
+        tuple: (chat id derived from the export or None, iterator of messages)
+    """
+    if ijson is None:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return export_chat_id(data.get("type"), data.get("id")), iter(data.get("messages", []))
+
+    # "type" and "id" come before "messages" in Telegram exports, so this only reads the header
+    header = {}
+    with open(path, "rb") as f:
+        for prefix, event, value in ijson.parse(f):
+            if prefix in ("type", "id"):
+                header[prefix] = value
+            if prefix == "messages" or len(header) == 2:
+                break
+
+    def messages():
+        with open(path, "rb") as f:
+            yield from iter_export_messages(f)
+
+    return export_chat_id(header.get("type"), header.get("id")), messages()
+
+def parse_export_file(path):
+    """
+    Parses one export file into stats. Runs in a worker process.
+
+    Returns:
+        tuple: (path, export chat id, list of stats, number of messages read)
+    """
+    chat_id, messages = iter_export(path)
+    stats = []
+    read = 0
+    for message in messages:
+        read += 1
+        stat = extract_stat(message)
+        if stat:
+            stats.append(stat)
+    return path, chat_id, stats, read
+
+def write_stats(backend, chat_id, batches):
+    """
+    Writes a chat's deduped stats batch by batch (see utils.dedupe.dedupe_batches).
+
+    Returns:
+        tuple: (stats written, duplicates removed, users written)
+    """
+    # Backends are imported lazily: Firestore needs credentials, SQLite creates gayness.db on import
+    if backend == "firestore":
+        from utils.firestore import bulk_log_stat, bump_history_generation
+    else:
+        from utils.storage import bulk_log_stat
+        bump_history_generation = None
+
+    kept = skipped = users_written = 0
+    try:
+        for messages, users, batch_skipped in batches:
+            if backend == "firestore":
+                # The history generation is bumped once per chat, below
+                bulk_log_stat(chat_id=chat_id, messages=messages, users=users, bump_generation=False)
+            else:
+                bulk_log_stat(chat_id=chat_id, messages=messages, users=users)
+            kept += len(messages)
+            skipped += batch_skipped
+            users_written += len(users)
+    finally:
+        if bump_history_generation and kept:
+            bump_history_generation(chat_id)
+    return kept, skipped, users_written
+
+def import_chat_history(paths, chat_id=None, backend="firestore", workers=None, dry_run=False):
+    files = find_export_files(paths)
+    if not files:
+        print("No export files found.")
+        return
+
+    start = time.monotonic()
+    # One sorter per chat: each file's stats are spilled in sorted runs as soon as it is parsed
+    sorters = {}
+    messages_read = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(parse_export_file, path) for path in files]
+            for future in as_completed(futures):
+                path, export_id, stats, read = future.result()
+                target = chat_id or export_id
+                if target is None:
+                    print(f"Skipping {path}: no chat id in export, pass --chat-id.")
+                    continue
+                if target not in sorters:
+                    sorters[target] = StatSorter()
+                sorters[target].extend(stats)
+                messages_read += read
+                elapsed = time.monotonic() - start
+                print(f"Parsed {path}: {len(stats)} rolls from {read} messages ({messages_read / elapsed:,.0f} messages/s)")
+
+        total_kept = total_skipped = 0
+        for target, sorter in sorters.items():
+            # Files may overlap or arrive in any order: the dedupe does not depend on it
+            batches = dedupe_batches(sorter)
+
+            if dry_run:
+                kept = skipped = users = 0
+                for batch_kept, batch_users, batch_skipped in batches:
+                    kept += len(batch_kept)
+                    skipped += batch_skipped
+                    users += len(batch_users)
+                total_kept += kept
+                total_skipped += skipped
+                print(f"Chat {target}: {kept} rolls to write, {skipped} duplicates removed, {users} users")
+                continue
+
+            write_start = time.monotonic()
+            kept, skipped, users = write_stats(backend, target, batches)
+            total_kept += kept
+            total_skipped += skipped
+            write_elapsed = max(time.monotonic() - write_start, 1e-9)
+            print(f"Chat {target}: {kept} rolls written, {skipped} duplicates removed, "
+                  f"{users} users ({kept / write_elapsed:,.0f} records/s)")
+    finally:
+        for sorter in sorters.values():
+            sorter.close()
+
+    elapsed = time.monotonic() - start
+    print(f"Done: {len(files)} files, {len(sorters)} chats, {messages_read} messages read, "
+          f"{total_kept} rolls imported, {total_skipped} duplicates removed in {elapsed:.1f}s "
+          f"({total_kept / max(elapsed, 1e-9):,.0f} records/s){' [dry run]' if dry_run else ''}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-import Telegram export JSON files of HowGayBot rolls.")
+    parser.add_argument("paths", nargs="+", help="Export JSON files or directories containing them")
+    parser.add_argument("--chat-id", help="Import everything into this chat id instead of the one in each export")
+    parser.add_argument("--backend", choices=["firestore", "sqlite"], default="firestore", help="Storage backend to write to")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count)")
+    parser.add_argument("--dry-run", action="store_true", help="Parse and dedupe without writing")
+
+    args = parser.parse_args()
+    import_chat_history(args.paths, args.chat_id, args.backend, args.workers, args.dry_run)
@@ -0,0 +1,295 @@
+#####################################################################################
+# Usage: python -m utils.migrate_store sqlite-to-firestore|firestore-to-sqlite [--db gayness.db]
+#                                      [--batch-size N] [--workers N] [--checkpoint PATH] [--restart]
+#
+# Moves the roll history between the SQLite store (utils/storage.py: stats, users and
+# last_update tables, ISO timestamps, no message ids) and Firestore (chats/{id}/messages|users,
+# unix timestamps). Rows are streamed in batches, written with bulk writes (concurrent
+# Firestore batches, or one SQLite transaction per batch while the next Firestore page is
+# read), and the position is checkpointed after every batch so an interrupted run resumes.
+####################################################################################
+import os
+import json
+import time
+import zlib
+import queue
+import sqlite3
+import argparse
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+DIRECTIONS = ("sqlite-to-firestore", "firestore-to-sqlite")
+# Rows per bulk write; with their user documents they mostly fit one 500-write Firestore batch
+DEFAULT_BATCH_SIZE = 400
+PREFETCH_BATCHES = 4
+PROGRESS_INTERVAL_SECONDS = 5
+
+def iso_to_unix(value: str):
+    """Converts a SQLite timestamp to unix seconds; naive timestamps are UTC, as utils.storage writes them."""
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def unix_to_iso(timestamp: int):
+    """Converts unix seconds to the naive UTC ISO format of utils.storage.bulk_log_stat."""
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).replace(tzinfo=None).isoformat()
+
+def parse_id(value: str):
+    """SQLite keeps chat and user ids as text, Firestore as ints when they are numeric."""
+    return int(value) if value.lstrip('-').isdigit() else value
+
+def synthetic_message_id(user_id, timestamp: int):
+    """
+    Derives a message id for a SQLite row, which has none.
+
+    The id is negative, so it never collides with a Telegram message id, and only depends
+    on the row, so a resumed or repeated migration overwrites documents instead of duplicating them.
+    """
+    return -((timestamp << 20) | (zlib.crc32(str(user_id).encode("utf-8")) & 0xFFFFF))
+
+def load_checkpoint(path: str, direction: str, restart: bool = False):
+    """Returns the saved position of a previous run in the same direction, or {}."""
+    if restart or not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get('direction') != direction:
+        raise SystemExit(f"Checkpoint {path} is for {state.get('direction')}, pass --restart to discard it.")
+    return state
+
+def save_checkpoint(path: str, state: dict):
+    """Writes the checkpoint atomically (temp file + rename)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+class Progress:
+    """Prints rows done and rows per second at most every PROGRESS_INTERVAL_SECONDS."""
+
+    def __init__(self, label: str, done: int = 0, total: int = None):
+        self.label = label
+        self.done = done
+        self.total = total
+        self.rows = 0  # Rows of this run, for the rate
+        self.start = time.monotonic()
+        self.last_print = self.start
+
+    def add(self, count: int):
+        self.done += count
+        self.rows += count
+        now = time.monotonic()
+        if now - self.last_print >= PROGRESS_INTERVAL_SECONDS:
+            self.last_print = now
+            self.print()
+
+    def print(self, prefix: str = ""):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        total = f"/{self.total:,}" if self.total is not None else ""
+        print(f"{prefix}{self.label}: {self.done:,}{total} rows ({self.rows / elapsed:,.0f} rows/s)")
+
+def write_firestore_chunk(chat_id: str, messages: list, users: dict):
+    """Bulk-writes one chat's messages, with the SQLite user info of their authors. Runs in a worker thread."""
+    from utils.firestore import bulk_log_stat
+
+    last_updates = defaultdict(int)
+    for message in messages:
+        last_updates[message['user_id']] = max(last_updates[message['user_id']], message['timestamp'])
+    chat_users = []
+    for user_id, last_update in last_updates.items():
+        info = users.get(str(user_id))
+        if info:  # Authors missing from the users table only get their messages and records
+            chat_users.append({'user_id': user_id, 'username': info[0] or 'Unknown',
+                               'name': info[1] or 'Unknown', 'last_update': last_update})
+    # The history generation is bumped once per chat at the end, not per chunk
+    bulk_log_stat(chat_id=parse_id(chat_id), messages=messages, users=chat_users, bump_generation=False)
+
+def sqlite_to_firestore(db_path: str, checkpoint_path: str, batch_size: int, workers: int, restart: bool):
+    from utils.firestore import update_last_timestamp, bump_history_generation
+
+    state = load_checkpoint(checkpoint_path, "sqlite-to-firestore", restart)
+    last_rowid = state.get('last_rowid', 0)
+    skipped = state.get('skipped', 0)
+
+    conn = sqlite3.connect(db_path)
+    users = {user_id: (username, name) for user_id, username, name in conn.execute("SELECT user_id, username, name FROM users")}
+    total = conn.execute("SELECT COUNT(*) FROM stats").fetchone()[0]
+    progress = Progress("sqlite -> firestore", state.get('rows', 0), total)
+    if last_rowid:
+        print(f"Resuming after rowid {last_rowid} ({progress.done:,} rows already migrated).")
+
+    # Chunks in read order with their pending writes: the checkpoint only moves past fully written chunks
+    pending = deque()
+    def complete_oldest():
+        rowid, count, futures = pending.popleft()
+        for future in futures:
+            future.result()  # A failed write stops the run, the checkpoint stays before its chunk
+        progress.add(count)
+        save_checkpoint(checkpoint_path, {'direction': "sqlite-to-firestore", 'last_rowid': rowid,
+                                          'rows': progress.done, 'skipped': skipped})
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            # Keyset pagination on rowid: every batch is an index range scan, however far in
+            rows = conn.execute("""
+                SELECT rowid, chat_id, user_id, percentage, timestamp
+                FROM stats WHERE rowid > ? ORDER BY rowid LIMIT ?
+            """, (last_rowid, batch_size)).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+
+            messages_by_chat = defaultdict(list)
+            for _, chat_id, user_id, percent, ts in rows:
+                try:
+                    timestamp = iso_to_unix(ts)
+                except (TypeError, ValueError):
+                    skipped += 1
+                    continue
+                user_id = parse_id(user_id)
+                messages_by_chat[chat_id].append({
+                    'message_id': synthetic_message_id(user_id, timestamp),
+                    'user_id': user_id,
+                    'percentage': percent,
+                    'timestamp': timestamp,
+                })
+            futures = [pool.submit(write_firestore_chunk, chat_id, messages, users)
+                       for chat_id, messages in messages_by_chat.items()]
+            pending.append((last_rowid, len(rows), futures))
+
+            # Bounded number of chunks in flight; finished ones are checkpointed as soon as possible
+            while len(pending) > workers * 2 or (pending and all(future.done() for future in pending[0][2])):
+                complete_oldest()
+        while pending:
+            complete_oldest()
+
+    # Chat watermarks, so the bot does not re-fetch what was migrated, and history generations,
+    # so running instances and snapshots drop their copies of the migrated chats
+    for chat_id, last_timestamp in conn.execute("SELECT chat_id, MAX(timestamp) FROM stats GROUP BY chat_id"):
+        try:
+            update_last_timestamp(parse_id(chat_id), iso_to_unix(last_timestamp))
+        except (TypeError, ValueError):
+            pass
+        bump_history_generation(parse_id(chat_id))
+    conn.close()
+
+    progress.print("Done: ")
+    if skipped:
+        print(f"Skipped {skipped} rows with an unreadable timestamp.")
+
+def _read_ahead(rows, batch_size: int):
+    """Yields rows in batches, read in a background thread so Firestore reads overlap SQLite writes."""
+    batches = queue.Queue(maxsize=PREFETCH_BATCHES)
+
+    def produce():
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    batches.put(batch)
+                    batch = []
+            if batch:
+                batches.put(batch)
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+
+    threading.Thread(target=produce, name="migrate-reader", daemon=True).start()
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+
+def write_sqlite_messages(conn, rows: list):
+    """Inserts message rows and advances the chats' last_update, in one transaction."""
+    last_timestamps = {}
+    for row in rows:
+        chat_id = str(row['chat_id'])
+        last_timestamps[chat_id] = max(last_timestamps.get(chat_id, 0), row['timestamp'])
+    with conn:
+        conn.executemany("""
+            INSERT OR IGNORE INTO stats (chat_id, user_id, percentage, timestamp)
+            VALUES (?, ?, ?, ?)
+        """, [(str(row['chat_id']), str(row['user_id']), row['percentage'], unix_to_iso(row['timestamp'])) for row in rows])
+        conn.executemany("""
+            INSERT INTO last_update (chat_id, last_timestamp) VALUES (?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET last_timestamp = MAX(last_timestamp, excluded.last_timestamp)
+        """, [(chat_id, unix_to_iso(timestamp)) for chat_id, timestamp in last_timestamps.items()])
+
+def firestore_to_sqlite(db_path: str, checkpoint_path: str, batch_size: int, restart: bool):
+    from utils.firestore import iter_message_rows, iter_user_rows
+    from utils.storage import init_schema
+
+    state = load_checkpoint(checkpoint_path, "firestore-to-sqlite", restart)
+    phase = state.get('phase', 'messages')
+
+    conn = sqlite3.connect(db_path)
+    init_schema(conn)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    progress = Progress("firestore -> sqlite", state.get('rows', 0))
+    if state:
+        print(f"Resuming {phase} ({progress.done:,} rows already migrated).")
+
+    # Raw messages, resumable after the last written document
+    if phase == 'messages':
+        rows = iter_message_rows(page_size=batch_size, start_after=state.get('last_path'), archives=False)
+        for batch in _read_ahead(rows, batch_size):
+            write_sqlite_messages(conn, batch)
+            progress.add(len(batch))
+            last = batch[-1]
+            save_checkpoint(checkpoint_path, {'direction': "firestore-to-sqlite", 'phase': 'messages',
+                                              'last_path': f"chats/{last['chat_id']}/messages/{last['message_id']}",
+                                              'rows': progress.done})
+        phase = 'archives'
+        save_checkpoint(checkpoint_path, {'direction': "firestore-to-sqlite", 'phase': phase, 'rows': progress.done})
+
+    # Archived months (few, large documents): re-read from the start on resume, inserts ignore duplicates
+    if phase == 'archives':
+        for batch in _read_ahead(iter_message_rows(raw=False), batch_size):
+            write_sqlite_messages(conn, batch)
+            progress.add(len(batch))
+        phase = 'users'
+        save_checkpoint(checkpoint_path, {'direction': "firestore-to-sqlite", 'phase': phase, 'rows': progress.done})
+
+    # Users are per chat in Firestore and global in SQLite: the last chat read wins
+    users = 0
+    for batch in _read_ahead(iter_user_rows(page_size=batch_size), batch_size):
+        with conn:
+            conn.executemany("""
+                INSERT INTO users (user_id, username, name) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, name = excluded.name
+            """, [(str(row['user_id']), row['username'] or "unknown", row['name'] or "") for row in batch])
+        users += len(batch)
+    conn.close()
+
+    progress.print("Done: ")
+    print(f"Migrated {users:,} chat users.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate HowGayBot rolls between the SQLite and Firestore stores.")
+    parser.add_argument("direction", choices=DIRECTIONS, help="Which store to read and which to write")
+    parser.add_argument("--db", default="gayness.db", help="SQLite database file")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Rows per read and bulk write")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent Firestore bulk writes")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file (default: migrate-<direction>.json)")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint and start over")
+
+    args = parser.parse_args()
+    checkpoint_path = args.checkpoint or f"migrate-{args.direction}.json"
+    if args.direction == "sqlite-to-firestore":
+        if not os.path.exists(args.db):
+            raise SystemExit(f"No SQLite database at {args.db}.")
+        sqlite_to_firestore(args.db, checkpoint_path, args.batch_size, args.workers, args.restart)
+    else:
+        firestore_to_sqlite(args.db, checkpoint_path, args.batch_size, args.restart)
+    # Kept until the run completes, so an interrupted one resumes
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
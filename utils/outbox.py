@@ -0,0 +1,160 @@
+## Module that sends the bot's replies off the handler path, within Telegram's rate limits
+## Handlers enqueue sends and return immediately. Each chat is drained by its own worker,
+## paced by a per-chat and a global token bucket; flood waits (429 RetryAfter) pause the
+## chat and are retried. Edits of a message the user just clicked (pagination, /mystats
+## modes) go through a separate, faster lane so they do not wait behind the chat's new
+## messages, and edits of the same message that have not been sent yet are coalesced so only
+## the latest text goes out.
+import os
+import time
+import asyncio
+from collections import deque
+from dotenv import load_dotenv
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Telegram allows ~30 messages/s overall and ~20 messages/min in a group
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "0.33"))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))
+# Edits of callback messages: per chat, and per-chat burst size
+OUTBOX_EDIT_RATE = float(os.getenv("OUTBOX_EDIT_RATE", "1"))
+OUTBOX_EDIT_BURST = int(os.getenv("OUTBOX_EDIT_BURST", "5"))
+OUTBOX_MAX_RETRIES = 3
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class _Job:
+    __slots__ = ("factory", "coalesce_key", "attempts")
+
+    def __init__(self, factory, coalesce_key):
+        self.factory = factory
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+
+class _ChatQueue:
+    __slots__ = ("jobs", "pending", "bucket", "worker")
+
+    def __init__(self, rate: float, burst: int):
+        self.jobs = deque()
+        self.pending = {}   # coalesce_key -> queued (unsent) _Job
+        self.bucket = TokenBucket(rate, burst)
+        self.worker = None
+
+# lane -> (rate, burst) of each chat's queue in that lane
+LANES = {
+    'send': (OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST),
+    'edit': (OUTBOX_EDIT_RATE, OUTBOX_EDIT_BURST),
+}
+
+class Outbox:
+    def __init__(self):
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, int(OUTBOX_GLOBAL_RATE))
+        self._chats = {}  # (chat_id, lane) -> _ChatQueue
+
+    def send(self, chat_id, factory, coalesce_key=None, lane: str = 'send'):
+        """
+        Enqueues a send and returns immediately.
+
+        Parameters:
+            chat_id: The chat the send goes to (rate limits are per chat).
+            factory (callable): Returns the coroutine performing the send; called once per attempt.
+            coalesce_key: Optional; a queued job with the same key is superseded by this one.
+            lane (str): A key of LANES; each lane of a chat has its own queue and rate limit.
+        """
+        queue = self._chats.get((chat_id, lane))
+        if queue is None:
+            queue = self._chats[(chat_id, lane)] = _ChatQueue(*LANES[lane])
+
+        superseded = queue.pending.get(coalesce_key) if coalesce_key is not None else None
+        if superseded is not None:
+            # Keep the queue position, send only the latest content
+            superseded.factory = factory
+        else:
+            job = _Job(factory, coalesce_key)
+            queue.jobs.append(job)
+            if coalesce_key is not None:
+                queue.pending[coalesce_key] = job
+
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.get_running_loop().create_task(self._drain(chat_id, lane, queue))
+
+    def reply_text(self, message, text: str, **kwargs):
+        self.send(message.chat_id, lambda: message.reply_text(text, **kwargs))
+
+    def reply_document(self, message, path: str, **kwargs):
+        async def send_document():
+            with open(path, "rb") as f:
+                await message.reply_document(f, **kwargs)
+        self.send(message.chat_id, send_document)
+
+    def edit_message_text(self, query, text: str, **kwargs):
+        message = query.message
+        self.send(message.chat_id, lambda: query.edit_message_text(text, **kwargs),
+                  coalesce_key=("edit", message.message_id), lane='edit')
+
+    def send_message(self, bot, chat_id, text: str, **kwargs):
+        self.send(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs))
+
+    async def _drain(self, chat_id, lane: str, queue: _ChatQueue):
+        while queue.jobs:
+            job = queue.jobs[0]
+            await queue.bucket.acquire()
+            await self.global_bucket.acquire()
+
+            # From here on the job is being sent: later edits must queue a new job
+            if job.coalesce_key is not None and queue.pending.get(job.coalesce_key) is job:
+                del queue.pending[job.coalesce_key]
+            try:
+                await job.factory()
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                logger.warning(f"Flood wait in chat {chat_id}, pausing sends for {delay}s.")
+                await asyncio.sleep(delay)
+                continue  # Retry the same job
+            except BadRequest as e:  # Subclass of NetworkError, never retried
+                # e.g. "message is not modified" after coalescing, or the chat is gone
+                logger.debug(f"Send to chat {chat_id} rejected: {e}")
+            except (TimedOut, NetworkError) as e:
+                job.attempts += 1
+                if job.attempts < OUTBOX_MAX_RETRIES:
+                    logger.warning(f"Send to chat {chat_id} failed ({e}), retrying.")
+                    await asyncio.sleep(2 ** job.attempts)
+                    continue
+                logger.error(f"Giving up send to chat {chat_id} after {job.attempts} attempts: {e}")
+            except Exception as e:
+                logger.error(f"Failed to send to chat {chat_id}: {e}")
+            queue.jobs.popleft()
+
+        # Idle chats do not keep a queue around
+        if self._chats.get((chat_id, lane)) is queue and not queue.jobs:
+            del self._chats[(chat_id, lane)]
+
+    async def flush(self, timeout: float = 10.0):
+        """Waits (up to `timeout` seconds) for queued sends, e.g. before shutdown."""
+        workers = [queue.worker for queue in self._chats.values() if queue.worker and not queue.worker.done()]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+
+outbox = Outbox()
@@ -0,0 +1,228 @@
+## Module that profiles the live bot for a bounded time window, on demand
+## Handlers are wrapped once at registration; while no window is open the wrapper costs one
+## global lookup. A window records per-handler timings plus either a cProfile of the event
+## loop thread or a sampling profile of every thread (the to_thread work included), and
+## tracemalloc diffs around memory-heavy handlers. Reports are written to PROFILE_DIR.
+import os
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import functools
+import threading
+import tracemalloc
+from io import StringIO
+from datetime import datetime
+from collections import Counter, defaultdict
+from dotenv import load_dotenv
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Open a profiling window of this many seconds at startup (0 = off), in PROFILE_MODE
+PROFILE_ON_START = int(os.getenv("PROFILE_ON_START", "0"))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "cprofile")
+PROFILE_MAX_SECONDS = 600
+PROFILE_MODES = ("cprofile", "sample")
+SAMPLE_INTERVAL_SECONDS = 0.005
+REPORT_TOP = 40
+
+class ProfileSession:
+    """One profiling window; see start_profiling."""
+
+    def __init__(self, mode: str, seconds: int, on_report=None):
+        self.mode = mode
+        self.seconds = seconds
+        self.on_report = on_report
+        self.started = datetime.now()
+        self.timings = defaultdict(lambda: [0, 0.0, 0.0])  # handler -> [calls, total s, max s]
+        self.memory_reports = []
+        self.profiler = cProfile.Profile() if mode == "cprofile" else None
+        self.samples = Counter()  # collapsed stack -> samples
+        self._sampling = threading.Event()
+        self._sampler = None
+        self._timer = None
+        self.started_tracemalloc = False
+
+    def start(self):
+        if self.profiler is not None:
+            # cProfile follows the thread that enables it: the event loop thread
+            self.profiler.enable()
+        else:
+            self._sampling.set()
+            self._sampler = threading.Thread(target=self._sample, name="profiler-sampler", daemon=True)
+            self._sampler.start()
+        self._timer = asyncio.get_running_loop().call_later(self.seconds, lambda: asyncio.ensure_future(stop_profiling()))
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while self._sampling.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if ident not in names:  # Started during the window
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                thread_name = names.get(ident, f"thread-{ident}")
+                self.samples[";".join([thread_name] + stack[::-1])] += 1
+            time.sleep(SAMPLE_INTERVAL_SECONDS)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.profiler is not None:
+            self.profiler.disable()
+        else:
+            self._sampling.clear()
+            self._sampler.join()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+    def record(self, name: str, elapsed: float):
+        timing = self.timings[name]
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+
+    def write_reports(self, directory: str):
+        """Writes the reports of the window and returns their paths."""
+        os.makedirs(directory, exist_ok=True)
+        stamp = self.started.strftime("%Y%m%d-%H%M%S")
+        out = StringIO()
+        out.write(f"Profile ({self.mode}) from {self.started:%Y-%m-%d %H:%M:%S}, {self.seconds}s window\n\n")
+
+        out.write("Handler timings (wall clock):\n")
+        out.write(f"{'handler':<28}{'calls':>8}{'total s':>12}{'mean ms':>12}{'max ms':>12}\n")
+        for name, (calls, total, worst) in sorted(self.timings.items(), key=lambda item: item[1][1], reverse=True):
+            out.write(f"{name:<28}{calls:>8}{total:>12.3f}{total / calls * 1000:>12.1f}{worst * 1000:>12.1f}\n")
+
+        paths = []
+        if self.profiler is not None:
+            out.write(f"\ncProfile of the event loop thread, top {REPORT_TOP} by cumulative time:\n")
+            stats = pstats.Stats(self.profiler, stream=out)
+            stats.sort_stats("cumulative").print_stats(REPORT_TOP)
+            # Binary stats for snakeviz / pstats
+            prof_path = os.path.join(directory, f"profile-{stamp}.prof")
+            stats.dump_stats(prof_path)
+            paths.append(prof_path)
+        else:
+            total = sum(self.samples.values()) or 1
+            out.write(f"\nSampled stacks ({total} samples every {SAMPLE_INTERVAL_SECONDS * 1000:.0f} ms), top {REPORT_TOP} leaf frames:\n")
+            leaves = Counter()
+            for stack, count in self.samples.items():
+                leaves[stack.rsplit(";", 1)[-1]] += count
+            for leaf, count in leaves.most_common(REPORT_TOP):
+                out.write(f"{count / total:>7.1%}  {leaf}\n")
+            # Collapsed stacks, the input format of flamegraph.pl / speedscope
+            folded_path = os.path.join(directory, f"profile-{stamp}.folded")
+            with open(folded_path, "w", encoding="utf-8") as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            paths.append(folded_path)
+
+        for report in self.memory_reports:
+            out.write(f"\n{report}")
+
+        report_path = os.path.join(directory, f"profile-{stamp}.txt")
+        with open(report_path, "w", encoding="utf-8") as f:
+            f.write(out.getvalue())
+        return [report_path] + paths
+
+# The open window, None while profiling is off
+_session = None
+
+def is_profiling():
+    return _session is not None
+
+def start_profiling(seconds: int, mode: str = "cprofile", on_report=None):
+    """
+    Opens a profiling window. Must be called from the event loop.
+
+    Parameters:
+        seconds (int): Length of the window, capped at PROFILE_MAX_SECONDS.
+        mode (str): 'cprofile' (deterministic, event loop thread) or 'sample' (all threads).
+        on_report (callable): Optional coroutine function called with the report paths when the window closes.
+
+    Returns:
+        bool: False if a window is already open.
+    """
+    global _session
+    if _session is not None:
+        return False
+    _session = ProfileSession(mode, min(seconds, PROFILE_MAX_SECONDS), on_report)
+    _session.start()
+    logger.info(f"Profiling ({mode}) for {_session.seconds}s.")
+    return True
+
+async def stop_profiling():
+    """
+    Closes the open profiling window and writes its reports.
+
+    Returns:
+        list: The report paths, empty if no window was open.
+    """
+    global _session
+    session, _session = _session, None
+    if session is None:
+        return []
+    session.stop()
+    try:
+        paths = await asyncio.to_thread(session.write_reports, PROFILE_DIR)
+    except Exception as e:
+        logger.error(f"Failed to write profiling reports: {e}")
+        return []
+    logger.info(f"Profiling reports written: {', '.join(paths)}")
+    if session.on_report is not None:
+        try:
+            await session.on_report(paths)
+        except Exception as e:
+            logger.error(f"Failed to deliver profiling reports: {e}")
+    return paths
+
+def profiled(handler, trace_memory: bool = False):
+    """
+    Wraps a handler so profiling windows time it (and diff its allocations if trace_memory).
+
+    Parameters:
+        handler (callable): The async handler callback.
+        trace_memory (bool): Take tracemalloc snapshots around each call while profiling.
+
+    Returns:
+        callable: The wrapped handler.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        session = _session
+        if session is None:
+            return await handler(update, context)
+
+        if trace_memory and not tracemalloc.is_tracing():
+            # Traced until the window closes, so overlapping calls share one trace
+            tracemalloc.start(10)
+            session.started_tracemalloc = True
+        before = tracemalloc.take_snapshot() if trace_memory else None
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            session.record(name, time.perf_counter() - start)
+            if trace_memory and tracemalloc.is_tracing():  # The window may have closed meanwhile
+                after = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                lines = [f"tracemalloc around {name} at {datetime.now():%H:%M:%S} "
+                         f"(traced now {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB), top allocations:"]
+                lines += [f"  {stat}" for stat in after.compare_to(before, "lineno")[:15]]
+                session.memory_reports.append("\n".join(lines))
+
+    return wrapper
@@ -0,0 +1,157 @@
+## Module that maintains per-user streaks and records incrementally
+## Records are a handful of running aggregates (current and best nice streak, today's and the
+## best day's 100% rolls, first/last 0%), updated in O(1) per roll taken in time order. Each
+## streak/day pair is stored as one packed key that only grows, so Firestore user documents are
+## updated with Maximum / Minimum transforms: live stats, spool replays and backfills never
+## move a record backwards. In memory, a roll older than the running state makes the chat
+## store rebuild that user's records from its rows (see ChatStore.refresh_records).
+import os
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Days start at midnight in this UTC offset, e.g. 8 for Singapore. Stored records remember the
+# offset they were computed with and are rebuilt from the chat's messages when it changes.
+RECORDS_UTC_OFFSET_HOURS = int(os.getenv("RECORDS_UTC_OFFSET_HOURS", "0"))
+# A day with one of these counts towards a nice streak (same as NICE_PERCENTAGES)
+STREAK_PERCENTAGES = (100, 88, 69, 0)
+# Packed keys: (major << KEY_BITS) | minor, with day numbers and counts below 2**KEY_BITS
+KEY_BITS = 20
+KEY_MASK = (1 << KEY_BITS) - 1
+# Fields of the 'records' map of a Firestore user document (besides utc_offset)
+RECORD_DOC_FIELDS = ('streak_key', 'best_streak_key', 'hundreds_key', 'best_hundreds_key', 'first_zero', 'last_zero')
+
+def day_number(timestamp: int):
+    """Returns the day (days since epoch, in the records time zone) of a timestamp."""
+    return (timestamp + RECORDS_UTC_OFFSET_HOURS * 3600) // 86400
+
+def format_day(day: int):
+    return datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime('%Y-%m-%d')
+
+def _pack(major: int, minor: int):
+    return (major << KEY_BITS) | minor
+
+def _unpack(key: int):
+    return key >> KEY_BITS, key & KEY_MASK
+
+class UserRecords:
+    """
+    Streaks and records of a user in a chat, as constant-size running aggregates.
+    Rolls must be added in time order; add() refuses an older one (see its return value).
+    """
+    __slots__ = ("streak", "streak_end", "best_streak", "best_streak_end",
+                 "hundreds", "hundreds_day", "best_hundreds", "best_hundreds_day", "first_zero", "last_zero")
+
+    def __init__(self):
+        self.streak = 0             # Length of the current run of nice days
+        self.streak_end = 0         # Latest nice day
+        self.best_streak = 0        # Length of the longest run, in days
+        self.best_streak_end = 0    # Last day of the longest run
+        self.hundreds = 0           # 100% rolls on hundreds_day, the latest day with one
+        self.hundreds_day = 0
+        self.best_hundreds = 0      # Most 100% rolls in one day
+        self.best_hundreds_day = 0
+        self.first_zero = 0         # Timestamps of the first/last 0% roll (0 = never)
+        self.last_zero = 0
+
+    def add(self, percent: int, timestamp: int):
+        """
+        Updates the records with one roll.
+
+        Returns:
+            bool: False (and nothing changed) if the roll is older than the running streak or
+                  100% day, so the records must be rebuilt from the rolls in time order.
+        """
+        day = day_number(timestamp)
+        nice = percent in STREAK_PERCENTAGES
+        if (nice and self.streak and day < self.streak_end) or (percent == 100 and self.hundreds and day < self.hundreds_day):
+            return False
+
+        if nice and not (self.streak and day == self.streak_end):
+            self.streak = self.streak + 1 if self.streak and day == self.streak_end + 1 else 1
+            self.streak_end = day
+            if (self.streak, self.streak_end) > (self.best_streak, self.best_streak_end):
+                self.best_streak, self.best_streak_end = self.streak, self.streak_end
+        if percent == 100:
+            self.hundreds = self.hundreds + 1 if self.hundreds and day == self.hundreds_day else 1
+            self.hundreds_day = day
+            if (self.hundreds, self.hundreds_day) > (self.best_hundreds, self.best_hundreds_day):
+                self.best_hundreds, self.best_hundreds_day = self.hundreds, self.hundreds_day
+        if percent == 0:
+            if not self.first_zero or timestamp < self.first_zero:
+                self.first_zero = timestamp
+            self.last_zero = max(self.last_zero, timestamp)
+        return True
+
+    def copy(self):
+        records = UserRecords()
+        for field in self.__slots__:
+            setattr(records, field, getattr(self, field))
+        return records
+
+    def to_doc(self):
+        """
+        Returns the Firestore representation: packed keys that only grow as time passes
+        (merge them with Maximum, first_zero with Minimum). Empty records are omitted.
+        """
+        doc = {}
+        if self.streak:
+            doc['streak_key'] = _pack(self.streak_end, self.streak)
+            doc['best_streak_key'] = _pack(self.best_streak, self.best_streak_end)
+        if self.hundreds:
+            doc['hundreds_key'] = _pack(self.hundreds_day, self.hundreds)
+            doc['best_hundreds_key'] = _pack(self.best_hundreds, self.best_hundreds_day)
+        if self.first_zero:
+            doc['first_zero'] = self.first_zero
+            doc['last_zero'] = self.last_zero
+        return doc
+
+    @classmethod
+    def from_doc(cls, doc: dict):
+        """Builds records from the 'records' field of a Firestore user document (see to_doc)."""
+        records = cls()
+        if not doc:
+            return records
+        records.streak_end, records.streak = _unpack(doc.get('streak_key', 0))
+        records.best_streak, records.best_streak_end = _unpack(doc.get('best_streak_key', 0))
+        records.hundreds_day, records.hundreds = _unpack(doc.get('hundreds_key', 0))
+        records.best_hundreds, records.best_hundreds_day = _unpack(doc.get('best_hundreds_key', 0))
+        records.first_zero = doc.get('first_zero', 0)
+        records.last_zero = doc.get('last_zero', 0)
+        return records
+
+def records_of(rolls):
+    """
+    Computes records from rolls of one user, in any order.
+
+    Parameters:
+        rolls (iterable): (percentage, timestamp) tuples of one user.
+
+    Returns:
+        UserRecords: The records of those rolls alone.
+    """
+    records = UserRecords()
+    for percent, timestamp in sorted(rolls, key=lambda roll: roll[1]):
+        records.add(percent, timestamp)
+    return records
+
+def format_user_records(records: UserRecords):
+    """
+    Formats a user's records for /mystats.
+
+    Returns:
+        str: The formatted records, or "" if the user has none yet.
+    """
+    output = []
+    if records.best_streak:
+        output.append(f"🔥 Longest nice streak: {records.best_streak} day{'s' if records.best_streak > 1 else ''} "
+                      f"(until {format_day(records.best_streak_end)})")
+    if records.best_hundreds:
+        output.append(f"💯 Most 100% in one day: {records.best_hundreds} (on {format_day(records.best_hundreds_day)})")
+    if records.first_zero:
+        first = datetime.fromtimestamp(records.first_zero).strftime('%Y-%m-%d %H:%M')
+        last = datetime.fromtimestamp(records.last_zero).strftime('%Y-%m-%d %H:%M')
+        output.append(f"🚫 First 0%: {first}, last 0%: {last}")
+    return "\n".join(output)
@@ -0,0 +1,121 @@
+## Module that coalesces concurrent identical requests and caches their rendered text briefly
+## While a key is being computed, every other caller awaits the same result instead of
+## starting its own computation; the result is then served from cache for `ttl` seconds,
+## or until the chat it belongs to ingests a new stat.
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+RENDER_CACHE_TTL = float(os.getenv("RENDER_CACHE_TTL", "30"))
+MAX_CACHED_KEYS = 4096
+
+class SingleFlight:
+    """
+    Parameters:
+        ttl (float): Seconds a computed result is served from cache.
+    """
+
+    def __init__(self, ttl: float = 30.0):
+        self.ttl = ttl
+        self._inflight = {}   # key -> asyncio.Task computing it
+        self._waiters = {}    # key -> callers awaiting the in-flight task
+        self._cache = {}      # key -> (expires_at, value)
+        self._last = {}       # key -> last computed value, kept past expiry/invalidation for peek_stale
+        self._generation = {} # chat_id -> bumped on every invalidation while the chat has keys in flight
+
+    async def run(self, key: tuple, compute):
+        """
+        Returns the cached or in-flight result for `key`, or runs `compute()` to produce it.
+        The computation runs in its own task: a caller being cancelled does not cancel it
+        for the others, only the last one leaving does.
+
+        Parameters:
+            key (tuple): Request key; key[1] must be the chat_id, used for invalidation.
+            compute (callable): Returns an awaitable producing the result.
+
+        Returns:
+            The computed result.
+        """
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._compute(key, compute))
+            # Retrieved here, so an error nobody awaits any more is not logged as unhandled
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters.get(key) == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            if self._waiters[key] == 1:
+                del self._waiters[key]
+            else:
+                self._waiters[key] -= 1
+
+    async def _compute(self, key: tuple, compute):
+        chat_id = key[1]
+        generation = self._generation.get(chat_id, 0)
+        try:
+            value = await compute()
+        finally:
+            del self._inflight[key]
+            # Nothing left to compare the generation with
+            if not any(other[1] == chat_id for other in self._inflight):
+                current = self._generation.pop(chat_id, 0)
+            else:
+                current = self._generation.get(chat_id, 0)
+
+        # Do not cache a result computed before the chat changed underneath it
+        if current == generation:
+            if len(self._cache) >= MAX_CACHED_KEYS:
+                self._prune()
+            self._cache[key] = (time.monotonic() + self.ttl, value)
+        self._last.pop(key, None)
+        self._last[key] = value
+        while len(self._last) > MAX_CACHED_KEYS:
+            del self._last[next(iter(self._last))]  # Least recently computed
+        return value
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self._cache.items() if expires_at <= now]:
+            del self._cache[key]
+
+    def is_ready(self, key: tuple):
+        """Whether run(key) would be served without a new computation (cached or in flight)."""
+        cached = self._cache.get(key)
+        return (cached is not None and cached[0] > time.monotonic()) or key in self._inflight
+
+    def peek_stale(self, key: tuple):
+        """Returns the last result computed for `key`, even if expired or invalidated, or None."""
+        return self._last.get(key)
+
+    def invalidate(self, chat_id: str, keep_stale: bool = True):
+        """
+        Drops every cached result of a chat, e.g. after it ingested a new stat.
+        Unless keep_stale is False, they can still be served by peek_stale under load.
+        """
+        chat_id = str(chat_id)
+        # Only computations in flight can be outdated by it
+        if any(key[1] == chat_id for key in self._inflight):
+            self._generation[chat_id] = self._generation.get(chat_id, 0) + 1
+        for key in [key for key in self._cache if key[1] == chat_id]:
+            del self._cache[key]
+        if not keep_stale:
+            for key in [key for key in self._last if key[1] == chat_id]:
+                del self._last[key]
+
+# Shared by the command handlers (coalescing) and the ingest path (invalidation)
+render_cache = SingleFlight(ttl=RENDER_CACHE_TTL)
@@ -0,0 +1,206 @@
+## Module that saves/loads a binary snapshot of the in-memory chat store, so restarts start warm
+##
+## The file is read whole and each section is copied once into the store's columns, which keep
+## growing as stats are logged (so they cannot be views of the file).
+##
+## File layout (little-endian, sections padded to 8 bytes):
+##   header        HEADER       magic, version, chat count, creation time
+##   chat index    CHAT_ENTRY   x chat count (chat id, rows, users, watermark, history generation,
+##                                             data offset, data size)
+##   per chat data block:
+##     users       USER_ENTRY   x users (user id, last_update, string lengths)
+##     counts      uint32       x users * 101  (occurrences of each percentage)
+##     last_seen   uint32       x users * 101  (latest timestamp of each percentage)
+##     percentages uint8        x rows
+##     timestamps  uint32       x rows
+##     user_index  int32        x rows
+##     strings     utf-8        usernames, names and non-numeric user ids, back to back
+import os
+import struct
+import time
+from array import array
+from utils.chat_store import ChatStore, UserStats, install_store, resident_stores, store_lock
+import logging
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"HGBS"
+SNAPSHOT_VERSION = 1
+
+HEADER = struct.Struct("<4sHHIQ4x")      # magic, version, reserved, chat count, created at
+CHAT_ENTRY = struct.Struct("<qIIIIQQ")   # chat id, rows, users, watermark, history generation, data offset, data size
+USER_ENTRY = struct.Struct("<qIHHH6x")   # user id, last_update, username len, name len, str id len
+
+def _pad(n: int):
+    return -n % 8
+
+def _encode_user_id(user_id):
+    """Returns (numeric id, string id bytes); non-numeric ids (e.g. "unknown") are kept as strings."""
+    if isinstance(user_id, int):
+        return user_id, b""
+    return 0, str(user_id).encode("utf-8")
+
+def _pack_chat(store: ChatStore):
+    parts = []
+    strings = bytearray()
+    for user_id, user in zip(store.user_ids, store.users):
+        numeric_id, str_id = _encode_user_id(user_id)
+        username = user.username.encode("utf-8")
+        name = user.name.encode("utf-8")
+        parts.append(USER_ENTRY.pack(numeric_id, user.last_update, len(username), len(name), len(str_id)))
+        strings += username + name + str_id
+
+    for column in [user.counts for user in store.users] + [user.last_seen for user in store.users]:
+        parts.append(column.tobytes())
+
+    for column in (store.percentages, store.timestamps, store.user_index):
+        data = column.tobytes()
+        parts.append(data + bytes(_pad(len(data))))
+
+    parts.append(bytes(strings) + bytes(_pad(len(strings))))
+    return b"".join(parts)
+
+def pack_snapshot(stores: list):
+    """
+    Serializes chat stores into the snapshot format.
+
+    Parameters:
+        stores (list): The ChatStores to serialize.
+
+    Returns:
+        bytes: The snapshot file content.
+    """
+    blocks = [_pack_chat(store) for store in stores]
+    offset = HEADER.size + CHAT_ENTRY.size * len(stores)
+
+    index = []
+    for store, block in zip(stores, blocks):
+        index.append(CHAT_ENTRY.pack(int(store.chat_id), len(store), len(store.users), store.watermark, store.generation, offset, len(block)))
+        offset += len(block)
+
+    header = HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(stores), int(time.time()))
+    return b"".join([header] + index + blocks)
+
+def _unpack_chat(buf, chat_id: int, n_rows: int, n_users: int, watermark: int, generation: int, offset: int):
+    store = ChatStore(str(chat_id))
+
+    entries = []
+    for _ in range(n_users):
+        entries.append(USER_ENTRY.unpack_from(buf, offset))
+        offset += USER_ENTRY.size
+
+    hist_size = 101 * 4
+    counts_offset = offset
+    last_seen_offset = offset + n_users * hist_size
+    offset = last_seen_offset + n_users * hist_size
+
+    for column, itemsize in ((store.percentages, 1), (store.timestamps, 4), (store.user_index, 4)):
+        size = n_rows * itemsize
+        column.frombytes(buf[offset:offset + size])
+        offset += size + _pad(size)
+
+    for i, (numeric_id, last_update, username_len, name_len, str_id_len) in enumerate(entries):
+        username = bytes(buf[offset:offset + username_len]).decode("utf-8")
+        offset += username_len
+        name = bytes(buf[offset:offset + name_len]).decode("utf-8")
+        offset += name_len
+        user_id = bytes(buf[offset:offset + str_id_len]).decode("utf-8") if str_id_len else numeric_id
+        offset += str_id_len
+
+        store.intern_user(user_id)
+        user = UserStats(username, name, last_update)
+        user.counts = array('I')
+        user.counts.frombytes(buf[counts_offset + i * hist_size:counts_offset + (i + 1) * hist_size])
+        user.last_seen = array('I')
+        user.last_seen.frombytes(buf[last_seen_offset + i * hist_size:last_seen_offset + (i + 1) * hist_size])
+        store.users[i] = user
+
+    # Records are not part of the format: rebuilt from the rows when first read
+    store.stale_records = set(range(n_users))
+
+    store.watermark = watermark
+    store.generation = generation
+    # Checked on first query: a chat whose history generation moved on is hydrated again
+    store.reconcile_from = watermark
+    return store
+
+def write_snapshot(path: str, payload: bytes):
+    """
+    Writes snapshot content to disk atomically (temp file + rename).
+
+    Parameters:
+        path (str): The snapshot file path.
+        payload (bytes): The output of pack_snapshot.
+
+    Returns:
+        None
+    """
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        logger.info(f"Saved snapshot to {path} ({len(payload)} bytes).")
+    except Exception as e:
+        logger.error(f"Failed to save snapshot: {e}")
+
+def pack_resident_snapshot():
+    """
+    Serializes every resident chat store while holding store_lock, so no stat is appended
+    between the columns (and counts) of a chat being copied. Call it off the event loop.
+
+    Returns:
+        bytes: The snapshot file content.
+    """
+    with store_lock:
+        return pack_snapshot(resident_stores())
+
+def save_snapshot(path: str):
+    """
+    Writes a snapshot of every resident chat store to disk. Blocking: call it off the event loop.
+
+    Parameters:
+        path (str): The snapshot file path.
+
+    Returns:
+        None
+    """
+    write_snapshot(path, pack_resident_snapshot())
+
+def load_snapshot(path: str):
+    """
+    Loads a snapshot from disk into the chat store. Loaded chats only fetch messages
+    newer than their watermark from Firestore the first time they are queried, unless their
+    history was rewritten since (see bump_history_generation): then they are hydrated again.
+
+    Parameters:
+        path (str): The snapshot file path.
+
+    Returns:
+        int: The number of chats loaded.
+    """
+    if not os.path.exists(path):
+        logger.info(f"No snapshot found at {path}, starting cold.")
+        return 0
+
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, _, chat_count, created_at = HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            logger.warning(f"Ignoring snapshot {path} with unsupported format {magic!r} v{version}.")
+            return 0
+
+        # Slices of a memoryview are not copied: each section is copied once, into its column
+        buf = memoryview(data)
+        for i in range(chat_count):
+            chat_id, n_rows, n_users, watermark, generation, offset, _ = CHAT_ENTRY.unpack_from(buf, HEADER.size + i * CHAT_ENTRY.size)
+            install_store(_unpack_chat(buf, chat_id, n_rows, n_users, watermark, generation, offset))
+
+        logger.info(f"Loaded snapshot of {chat_count} chats from {path} (taken at {created_at}).")
+        return chat_count
+    except Exception as e:
+        logger.error(f"Failed to load snapshot: {e}")
+        return 0
@@ -0,0 +1,221 @@
+## Module that implements a local durable spool (write-ahead queue) in front of Firestore
+## Handlers append entries in microseconds; a background Replayer drains them to the backend
+## with exponential backoff and a circuit breaker, so slow or failing backends neither block
+## handlers nor lose stats.
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+class Spool:
+    """Append-only SQLite queue of JSON entries, drained in insertion order."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        # WAL + NORMAL sync: appends survive process crashes and cost tens of microseconds
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                enqueued_at REAL NOT NULL
+            )
+        """)
+        # Entries that can never be applied (malformed data) are parked here instead of blocking the queue
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS dead_letter (
+                id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                error TEXT
+            )
+        """)
+
+    def append(self, entry: dict):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO spool (payload, enqueued_at) VALUES (?, ?)",
+                (json.dumps(entry), time.time()),
+            )
+
+    def peek(self, limit: int = 100):
+        """Returns up to `limit` oldest entries as (id, entry) without removing them."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, payload FROM spool ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [(entry_id, json.loads(payload)) for entry_id, payload in rows]
+
+    def ack(self, entry_id: int):
+        with self.lock:
+            self.conn.execute("DELETE FROM spool WHERE id = ?", (entry_id,))
+
+    def dead_letter(self, entry_id: int, error: str):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dead_letter (id, payload, error) SELECT id, payload, ? FROM spool WHERE id = ?",
+                (error, entry_id),
+            )
+            self.conn.execute("DELETE FROM spool WHERE id = ?", (entry_id,))
+            self.conn.execute("COMMIT")
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class CircuitBreaker:
+    """
+    Stops calling a failing backend for `reset_timeout` seconds after `threshold`
+    consecutive failures, then lets a single trial call through (half-open).
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def remaining(self):
+        """Seconds until the breaker lets a trial call through."""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Circuit breaker closed, backend recovered.")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit breaker opened after {self.failures} consecutive failures.")
+            self.opened_at = time.monotonic()
+
+class Replayer:
+    """
+    Drains a Spool by calling `apply(entry)` in worker threads. Entries of the same group
+    (see `key`) are applied in order; different groups are applied concurrently.
+
+    Parameters:
+        spool (Spool):        The spool to drain.
+        apply (callable):     Synchronous function applying one entry to the backend; raises on failure.
+        backoff_base (float): First retry delay in seconds, doubled on every consecutive failure.
+        backoff_cap (float):  Maximum retry delay in seconds.
+        breaker (CircuitBreaker): Optional circuit breaker, a default one is created if omitted.
+        on_applied (callable): Optional, called with each entry on the event loop once it is applied.
+        key (callable):       Optional, returns the group of an entry (e.g. its chat); all entries
+                              are one group if omitted.
+        concurrency (int):    How many groups are applied at once.
+    """
+    # Errors caused by the entry itself; retrying them would block the queue forever
+    PERMANENT_ERRORS = (KeyError, TypeError, ValueError)
+
+    def __init__(self, spool: Spool, apply, backoff_base: float = 1.0, backoff_cap: float = 60.0,
+                 breaker: CircuitBreaker = None, on_applied=None, key=None, concurrency: int = 1):
+        self.spool = spool
+        self.apply = apply
+        self.on_applied = on_applied
+        self.key = key
+        self.concurrency = max(1, concurrency)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker or CircuitBreaker()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._applying = set()  # The applies running in their worker threads
+
+    def wake(self):
+        """Signals that new entries were appended."""
+        self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Cancelling does not stop the worker threads: wait for entries being applied (they stay
+        # unacked and are replayed on the next start, which apply must tolerate)
+        if self._applying:
+            applying, self._applying = self._applying, set()
+            await asyncio.wait(applying)
+            for future in applying:
+                if not future.cancelled():
+                    future.exception()  # Retrieved: a failure is just retried next start
+
+    def _backoff(self):
+        delay = min(self.backoff_cap, self.backoff_base * 2 ** max(0, self.breaker.failures - 1))
+        return delay * random.uniform(0.5, 1.0)  # Jitter to avoid retry storms
+
+    async def run(self):
+        logger.info(f"Spool replayer started with {len(self.spool)} pending entries.")
+        while True:
+            entries = self.spool.peek()
+            if not entries:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            groups = {}
+            for entry_id, entry in entries:
+                groups.setdefault(self.key(entry) if self.key else None, []).append((entry_id, entry))
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def apply_group(group):
+                async with semaphore:
+                    return await self._apply_group(group)
+
+            if not all(await asyncio.gather(*(apply_group(group) for group in groups.values()))):
+                delay = self._backoff()
+                logger.warning(f"Retrying failed spool entries in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+
+    async def _apply_group(self, group: list):
+        """Applies (id, entry) pairs in order; returns False at the first failure, leaving the rest for the retry."""
+        for entry_id, entry in group:
+            if self.breaker.is_open:
+                await asyncio.sleep(self.breaker.remaining())
+            applying = asyncio.ensure_future(asyncio.to_thread(self.apply, entry))
+            self._applying.add(applying)
+            applying.add_done_callback(self._applying.discard)
+            try:
+                await asyncio.shield(applying)
+            except self.PERMANENT_ERRORS as e:
+                logger.error(f"Dropping malformed spool entry {entry_id} to dead letter: {e}")
+                self.spool.dead_letter(entry_id, repr(e))
+                continue
+            except Exception as e:
+                self.breaker.record_failure()
+                logger.warning(f"Failed to apply spool entry {entry_id}: {e}")
+                return False  # Retried from the oldest pending entry to keep ordering
+
+            self.breaker.record_success()
+            self.spool.ack(entry_id)
+            if self.on_applied is not None:
+                self.on_applied(entry)
+        return True
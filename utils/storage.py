@@ -1,41 +1,46 @@
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 logger = logging.getLogger(__name__)
 
+def init_schema(conn):
+    """Creates the stats, users and last_update tables of a SQLite database if needed."""
+    cur = conn.cursor()
+
+    # Stats table with composite primary key (chat_id + user_id + timestamp truncated to minute)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS stats (
+        chat_id TEXT,
+        user_id TEXT,
+        percentage INTEGER,
+        timestamp DATETIME,
+        PRIMARY KEY (chat_id, user_id, timestamp),
+        UNIQUE(chat_id, user_id, timestamp)
+    )
+    """)
+
+    # Table to store user information
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id TEXT PRIMARY KEY,
+        username TEXT,
+        name TEXT
+    );
+    """)
+
+    # Store last update timestamp for each chat
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS last_update (
+        chat_id TEXT PRIMARY KEY,
+        last_timestamp TEXT
+    )
+    """)
+    conn.commit()
+
 # Use SQLite connection with thread safety disabled (same as before)
 conn = sqlite3.connect("gayness.db", check_same_thread=False)
 cur = conn.cursor()
-
-# Stats table with composite primary key (chat_id + user_id + timestamp truncated to minute)
-cur.execute("""
-CREATE TABLE IF NOT EXISTS stats (
-    chat_id TEXT,
-    user_id TEXT,
-    percentage INTEGER,
-    timestamp DATETIME,
-    PRIMARY KEY (chat_id, user_id, timestamp),
-    UNIQUE(chat_id, user_id, timestamp)
-)
-""")
-
-# Table to store user information
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id TEXT PRIMARY KEY,
-    username TEXT,
-    name TEXT
-);
-""")
-
-# Store last update timestamp for each chat
-cur.execute("""
-CREATE TABLE IF NOT EXISTS last_update (
-    chat_id TEXT PRIMARY KEY,
-    last_timestamp TEXT
-)
-""")
-conn.commit()
+init_schema(conn)
 
 def log_stat(chat_id, user_id, username, name, percent, ts):
     try:
@@ -67,6 +72,22 @@ def log_stat(chat_id, user_id, username, name, percent, ts):
     except sqlite3.IntegrityError:
         logger.info(f"Duplicate skipped: user_id={user_id} in chat_id={chat_id} at {ts}")
 
+def bulk_log_stat(chat_id, messages, users):
+    """Inserts many stats (unix timestamps, stored as naive UTC) and users in one transaction, skipping duplicates."""
+    cur.executemany("""
+        INSERT OR IGNORE INTO stats (chat_id, user_id, percentage, timestamp)
+        VALUES (?, ?, ?, ?)
+    """, [
+        (chat_id, str(m['user_id']), m['percentage'], datetime.fromtimestamp(m['timestamp'], timezone.utc).replace(tzinfo=None).isoformat())
+        for m in messages
+    ])
+    cur.executemany("""
+        INSERT INTO users (user_id, username, name) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET name = excluded.name
+    """, [(str(u['user_id']), u.get('username') or "unknown", u.get('name') or "") for u in users])
+    conn.commit()
+    logger.info(f"Bulk logged {len(messages)} stats and {len(users)} users for chat_id={chat_id}")
+
 
 INDIVIDUAL_STATS_LABELS = {
         100: "💯 100% GAY 👨‍❤️‍💋‍👨",
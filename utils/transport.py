@@ -0,0 +1,68 @@
+## Module that configures the HTTP transport of the Telegram client
+## Sends (replies, edits, documents) share one pooled client; getUpdates long-polls on its
+## own connection so it never holds a pool slot that a reply is waiting for.
+import os
+from dotenv import load_dotenv
+from telegram.ext import ApplicationBuilder
+from telegram.request import HTTPXRequest
+import logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Concurrent connections for sends; replies are sent concurrently by the outbox workers
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "64"))
+# "1.1" or "2" (HTTP/2 needs the h2 package: pip install "httpx[http2]")
+TELEGRAM_HTTP_VERSION = os.getenv("TELEGRAM_HTTP_VERSION", "1.1")
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "10"))
+TELEGRAM_WRITE_TIMEOUT = float(os.getenv("TELEGRAM_WRITE_TIMEOUT", "10"))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "5"))
+# Seconds getUpdates waits server-side for new updates (long polling)
+TELEGRAM_POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", "30"))
+# Alternative Bot API server, e.g. a self-hosted one or the benchmark's mock server
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
+
+def build_request(connection_pool_size: int = TELEGRAM_POOL_SIZE, http_version: str = TELEGRAM_HTTP_VERSION):
+    """
+    Builds the request object used for every Bot API call except getUpdates.
+
+    Parameters:
+        connection_pool_size (int): Maximum concurrent connections.
+        http_version (str): "1.1" or "2".
+
+    Returns:
+        HTTPXRequest: The configured request object.
+    """
+    return HTTPXRequest(
+        connection_pool_size=connection_pool_size,
+        http_version=http_version,
+        connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=TELEGRAM_READ_TIMEOUT,
+        write_timeout=TELEGRAM_WRITE_TIMEOUT,
+        pool_timeout=TELEGRAM_POOL_TIMEOUT,
+    )
+
+def build_get_updates_request():
+    """
+    Builds the request object used for getUpdates: a single connection, since only one poll
+    runs at a time. PTB adds the long-poll timeout to the read timeout itself.
+    """
+    return HTTPXRequest(
+        connection_pool_size=1,
+        http_version=TELEGRAM_HTTP_VERSION,
+        connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=TELEGRAM_READ_TIMEOUT,
+        write_timeout=TELEGRAM_WRITE_TIMEOUT,
+        pool_timeout=TELEGRAM_POOL_TIMEOUT,
+    )
+
+def configure_transport(builder: ApplicationBuilder):
+    """Applies the transport settings to an ApplicationBuilder and returns it."""
+    builder = builder.request(build_request()).get_updates_request(build_get_updates_request())
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    logger.info(f"Telegram transport: HTTP/{TELEGRAM_HTTP_VERSION}, pool of {TELEGRAM_POOL_SIZE}, "
+                f"long-poll timeout {TELEGRAM_POLL_TIMEOUT}s")
+    return builder